@@ -1,8 +1,13 @@
-import pygame
-import pygame.midi
-from enum import Enum
-from typing import Optional, List, Callable
+from array import array
+from enum import Enum, IntEnum
+from typing import Iterable, Iterator, Optional, List, Callable, Sequence, Tuple
 import threading
+import math
+import time
+import weakref
+
+from midi_backend import MidiBackend, PygameBackend
+from midi_trace import EventTrace, Histogram, Instrumentation, InstrumentedOutput
 
 
 class MidiDeviceType(Enum):
@@ -11,6 +16,96 @@ class MidiDeviceType(Enum):
 # end if
 
 
+class MessageType(IntEnum):
+    # Channel messages are identified by the upper nibble of the status byte, system messages by the whole status byte
+    NOTE_OFF = 0x80
+    NOTE_ON = 0x90
+    POLY_AFTERTOUCH = 0xa0
+    CONTROL_CHANGE = 0xb0
+    PROGRAM_CHANGE = 0xc0
+    CHANNEL_AFTERTOUCH = 0xd0
+    PITCH_BEND = 0xe0
+    SYSTEM_EXCLUSIVE = 0xf0
+    TIME_CODE = 0xf1
+    SONG_POSITION = 0xf2
+    SONG_SELECT = 0xf3
+    TUNE_REQUEST = 0xf6
+    END_OF_EXCLUSIVE = 0xf7
+    CLOCK = 0xf8
+    START = 0xfa
+    CONTINUE = 0xfb
+    STOP = 0xfc
+    ACTIVE_SENSING = 0xfe
+    RESET = 0xff
+
+    @staticmethod
+    def status_bytes(message_type: int, channels: Optional[Iterable[int]] = None) -> List[int]:
+        # All status bytes of a message type (restricted to some channels for channel messages)
+        if message_type >= 0xf0:
+            return [message_type]
+
+        return [message_type | channel for channel in (range(16) if channels is None else channels)]
+    # end def
+# end class
+
+
+class LatencyStats:
+    # Collects latencies (in s) and provides some statistics about them
+
+    def __init__(self) -> None:
+        self._latencies = list()
+    # end def
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(count={self.count}, mean={self.mean * 1e3:.3f} ms, " \
+               f"p99={self.p99 * 1e3:.3f} ms, max={self.max * 1e3:.3f} ms)"
+    # end def
+
+    def __str__(self) -> str:
+        return repr(self)
+    # end def
+
+    def add(self, latency: float) -> None:
+        self._latencies.append(latency)
+    # end def
+
+    def percentile(self, p: float) -> float:
+        if len(self._latencies) == 0:
+            return 0.
+
+        latencies = sorted(self._latencies)
+        index = min(max(int(math.ceil(p / 100. * len(latencies))) - 1, 0), len(latencies) - 1)
+
+        return latencies[index]
+    # end def
+
+    @property
+    def latencies(self) -> List[float]:
+        return self._latencies
+    # end def
+
+    @property
+    def count(self) -> int:
+        return len(self._latencies)
+    # end def
+
+    @property
+    def mean(self) -> float:
+        return sum(self._latencies) / len(self._latencies) if len(self._latencies) > 0 else 0.
+    # end def
+
+    @property
+    def max(self) -> float:
+        return max(self._latencies) if len(self._latencies) > 0 else 0.
+    # end def
+
+    @property
+    def p99(self) -> float:
+        return self.percentile(99.)
+    # end def
+# end class
+
+
 class MidiDeviceInfo:
     # interface: string describing the device interface (e.g. 'ALSA')
     # name: string name of the device (e.g. 'Midi Through Port-0')
@@ -18,6 +113,8 @@ class MidiDeviceInfo:
     # is_output: 1 if the device is an output device, otherwise 0
     # is_opened: 1 if the device is opened, otherwise 0
 
+    __slots__ = ("_device_id", "_interface", "_name", "_is_input", "_is_output", "_is_opened")
+
     def __init__(self, device_id: int, interface: str, name: str, is_input: bool, is_output: bool, is_opened: bool) -> None:
         self._device_id = device_id
         self._interface = interface
@@ -69,6 +166,8 @@ class MidiDeviceInfo:
 
 
 class MidiEvent:
+    __slots__ = ("_status", "_data1", "_data2", "_data3", "_timestamp", "_device_id")
+
     def __init__(self, status: int, data1: int, data2: int, data3: int, timestamp: int, device_id: int) -> None:
         self._status = status
         self._data1 = data1
@@ -119,26 +218,647 @@ class MidiEvent:
 # end class
 
 
+class EventBatch:
+    # All events of one read of an input device, stored column-wise in arrays, so a batch costs a few allocations
+    # instead of one object per event. Iterating yields plain (status, data1, data2, timestamp) tuples; MidiEvent
+    # objects are only created on indexing or by events().
+    __slots__ = ("_status", "_data1", "_data2", "_data3", "_timestamp", "_device_id")
+
+    def __init__(self, raw_events: Sequence[Tuple[Sequence[int], int]], device_id: int) -> None:
+        # Takes the result of pygame.midi.Input.read: [[[status, data1, data2, data3], timestamp], ...]
+        messages, timestamps = zip(*raw_events) if len(raw_events) > 0 else ((), ())
+        status, data1, data2, data3 = zip(*messages) if len(messages) > 0 else ((), (), (), ())
+
+        self._status = array("B", status)
+        self._data1 = array("B", data1)
+        self._data2 = array("B", data2)
+        self._data3 = array("B", data3)
+        self._timestamp = array("q", timestamps)
+        self._device_id = device_id
+    # end def
+
+    def __len__(self) -> int:
+        return len(self._status)
+    # end def
+
+    def __iter__(self) -> Iterator[Tuple[int, int, int, int]]:
+        return zip(self._status, self._data1, self._data2, self._timestamp)
+    # end def
+
+    def __getitem__(self, index: int) -> MidiEvent:
+        return MidiEvent(self._status[index], self._data1[index], self._data2[index], self._data3[index],
+                         self._timestamp[index], self._device_id)
+    # end def
+
+    def __repr__(self) -> str:
+        return f"EventBatch(n_events={len(self)}, device_id={self._device_id})"
+    # end def
+
+    def __str__(self) -> str:
+        return repr(self)
+    # end def
+
+    @property
+    def status(self) -> array:
+        return self._status
+    # end def
+
+    @property
+    def data1(self) -> array:
+        return self._data1
+    # end def
+
+    @property
+    def data2(self) -> array:
+        return self._data2
+    # end def
+
+    @property
+    def data3(self) -> array:
+        return self._data3
+    # end def
+
+    @property
+    def timestamp(self) -> array:
+        return self._timestamp
+    # end def
+
+    @property
+    def device_id(self) -> int:
+        return self._device_id
+    # end def
+
+    def events(self) -> List[MidiEvent]:
+        return list(map(MidiEvent, self._status, self._data1, self._data2, self._data3, self._timestamp,
+                        [self._device_id] * len(self)))
+    # end def
+# end class
+
+
+class ChannelState:
+    # Keeps track of the state (program and controllers) of the 16 channels of an output device, so only changes need
+    # to be sent. Needs to be invalidated whenever the state of the device is unknown (e.g. after (re)opening it).
+    N_CHANNELS = 16
+
+    def __init__(self) -> None:
+        self._programs = [None] * self.N_CHANNELS
+        self._controllers = [dict() for _ in range(self.N_CHANNELS)]
+    # end def
+
+    def __repr__(self) -> str:
+        return f"ChannelState(programs={self._programs}, controllers={self._controllers})"
+    # end def
+
+    def __str__(self) -> str:
+        return repr(self)
+    # end def
+
+    def invalidate(self) -> None:
+        self._programs = [None] * self.N_CHANNELS
+        self._controllers = [dict() for _ in range(self.N_CHANNELS)]
+    # end def
+
+    def program(self, channel: int) -> Optional[int]:
+        return self._programs[channel]
+    # end def
+
+    def controller(self, channel: int, controller: int) -> Optional[int]:
+        return self._controllers[channel].get(controller)
+    # end def
+
+    def update_program(self, channel: int, program: int) -> bool:
+        # Returns True if the program changed (i.e. needs to be sent)
+        if self._programs[channel] == program:
+            return False
+        # end if
+
+        self._programs[channel] = program
+
+        return True
+    # end def
+
+    def update_controller(self, channel: int, controller: int, value: int) -> bool:
+        # Returns True if the controller's value changed (i.e. needs to be sent)
+        if self._controllers[channel].get(controller) == value:
+            return False
+        # end if
+
+        self._controllers[channel][controller] = value
+
+        return True
+    # end def
+# end class
+
+
+class MessageFilter:
+    # Filters and decodes the raw messages of an input device in the reader thread, before any event object is
+    # created. Each status byte is looked up in a table, so dropping whole message classes (e.g. the clock and active
+    # sensing messages many keyboards send continuously) or channels is cheap. Note-ons with velocity 0 are rewritten
+    # to note-offs.
+
+    DEFAULT_DROP = (MessageType.CLOCK, MessageType.ACTIVE_SENSING)
+
+    def __init__(self, accept: Optional[Iterable[MessageType]] = None, drop: Iterable[MessageType] = DEFAULT_DROP,
+                 channels: Optional[Iterable[int]] = None, normalize_note_off: bool = True) -> None:
+        # accept: message types to pass (None: all); drop: message types to drop anyway;
+        # channels: channels of the channel messages to pass (None: all)
+        self._accept = self._table(MessageType if accept is None else accept, channels)
+        for message_type in drop:
+            for status in MessageType.status_bytes(message_type):
+                self._accept[status] = 0
+            # end for
+        # end for
+        self._normalize_note_off = normalize_note_off
+        # --
+        self._n_messages = 0
+        self._n_dropped = 0
+    # end def
+
+    @staticmethod
+    def _table(message_types: Iterable[MessageType], channels: Optional[Iterable[int]] = None) -> bytearray:
+        channels = None if channels is None else list(channels)
+        table = bytearray(256)
+        for message_type in message_types:
+            for status in MessageType.status_bytes(message_type, channels):
+                table[status] = 1
+            # end for
+        # end for
+
+        return table
+    # end def
+
+    @property
+    def n_messages(self) -> int:
+        return self._n_messages
+    # end def
+
+    @property
+    def n_dropped(self) -> int:
+        return self._n_dropped
+    # end def
+
+    def accepts(self, status: int) -> bool:
+        return self._accept[status] == 1
+    # end def
+
+    def apply(self, raw_events: Sequence[Tuple[List[int], int]]) -> List[Tuple[List[int], int]]:
+        # Takes and returns raw messages as read by pygame.midi.Input.read
+        # Normalize first, so a note-on with velocity 0 is filtered like a note-off
+        if self._normalize_note_off:
+            for event in raw_events:
+                message = event[0]
+                if message[0] & 0xf0 == MessageType.NOTE_ON and message[2] == 0:
+                    message[0] = MessageType.NOTE_OFF | message[0] & 0x0f
+                # end if
+            # end for
+        # end if
+
+        accept = self._accept
+        events = [event for event in raw_events if accept[event[0][0]]]
+        self._n_messages += len(raw_events)
+        self._n_dropped += len(raw_events) - len(events)
+
+        return events
+    # end def
+# end class
+
+
+class OverflowPolicy(Enum):
+    BLOCK = 0  # The reader waits until the consumer made room (events might get lost in PortMidi's buffer instead)
+    DROP_OLDEST = 1  # The oldest pending events get dropped
+    COALESCE = 2  # Pending continuous messages (aftertouch, controllers, pitch bend) get replaced by newer values of the same kind, otherwise the oldest pending events get dropped
+# end class
+
+
+class EventQueue:
+    # Bounded ring buffer of events between the reader thread (producer) and one consumer. The consumer always takes
+    # all pending events at once.
+    _CONTINUOUS_MESSAGES = (0xa0, 0xb0, 0xd0, 0xe0)
+
+    def __init__(self, capacity: int = 4096, policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST) -> None:
+        self._capacity = capacity
+        self._policy = policy
+        self._buffer = [None] * capacity
+        self._read_seq = 0  # Absolute sequence numbers, the slot is seq % capacity
+        self._write_seq = 0
+        self._pending_continuous = dict()  # (device id, status, data1) -> seq of a pending continuous message
+        self._closed = False
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        # --
+        self._n_events = 0
+        self._n_dropped = 0
+        self._n_coalesced = 0
+        self._max_size = 0
+    # end def
+
+    def __len__(self) -> int:
+        return self._write_seq - self._read_seq
+    # end def
+
+    @property
+    def n_events(self) -> int:
+        return self._n_events
+    # end def
+
+    @property
+    def n_dropped(self) -> int:
+        return self._n_dropped
+    # end def
+
+    @property
+    def n_coalesced(self) -> int:
+        return self._n_coalesced
+    # end def
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size
+    # end def
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+    # end def
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+        # end with
+    # end def
+
+    def _continuous_key(self, event: MidiEvent) -> Optional[Tuple[int, int, int]]:
+        kind = event.status & 0xf0
+        if kind not in self._CONTINUOUS_MESSAGES:
+            return None
+        # end if
+
+        return event.device_id, event.status, event.data1 if kind in (0xa0, 0xb0) else 0
+    # end def
+
+    def put_batch(self, events: List[MidiEvent]) -> None:
+        with self._lock:
+            for event in events:
+                self._n_events += 1
+                key = self._continuous_key(event) if self._policy == OverflowPolicy.COALESCE else None
+
+                if len(self) == self._capacity:
+                    if key is not None and self._pending_continuous.get(key, -1) >= self._read_seq:
+                        # Replace the pending value by the new one
+                        self._buffer[self._pending_continuous[key] % self._capacity] = event
+                        self._n_coalesced += 1
+                        continue
+                    # end if
+
+                    if self._policy == OverflowPolicy.BLOCK:
+                        while len(self) == self._capacity and not self._closed:
+                            self._not_full.wait()
+                        # end while
+
+                        if self._closed:
+                            return
+                        # end if
+                    else:
+                        self._read_seq += 1
+                        self._n_dropped += 1
+                    # end if
+                # end if
+
+                if key is not None:
+                    self._pending_continuous[key] = self._write_seq
+                # end if
+                self._buffer[self._write_seq % self._capacity] = event
+                self._write_seq += 1
+            # end for
+
+            self._max_size = max(self._max_size, len(self))
+            self._not_empty.notify()
+        # end with
+    # end def
+
+    def get_batch(self, timeout: Optional[float] = None) -> List[MidiEvent]:
+        # Returns all pending events (an empty list on timeout or if the queue got closed)
+        with self._lock:
+            if len(self) == 0 and not self._closed:
+                self._not_empty.wait(timeout)
+            # end if
+
+            begin = self._read_seq % self._capacity
+            end = self._write_seq % self._capacity
+            if len(self) == 0:
+                batch = list()
+            elif begin < end:
+                batch = self._buffer[begin:end]
+                self._buffer[begin:end] = [None] * (end - begin)  # Don't keep the events alive
+            else:
+                batch = self._buffer[begin:] + self._buffer[:end]
+                self._buffer[begin:] = [None] * (self._capacity - begin)
+                self._buffer[:end] = [None] * end
+            # end if
+
+            self._read_seq = self._write_seq
+            if len(self._pending_continuous) > 0:
+                self._pending_continuous.clear()
+            # end if
+            # The queue is empty now, so all blocked producers (e.g. several inputs of one subscription) can continue
+            self._not_full.notify_all()
+        # end with
+
+        return batch
+    # end def
+# end class
+
+
+class Subscription(threading.Thread):
+    # Consumer of the events read by a Midi instance, running in its own thread, so a slow consumer doesn't stall the
+    # reader. All events that are pending at once are passed to cb_events in one call.
+    # Without cb_events, no thread is started and the owner drains the queue itself (e.g. a GUI in its event loop).
+
+    def __init__(self, cb_events: Optional[Callable[[List[MidiEvent]], None]], capacity: int = 4096, policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST) -> None:
+        super().__init__(daemon=True)
+
+        self._cb_events = cb_events
+        self._queue = EventQueue(capacity, policy)
+        self._stopped = False
+
+        if self._cb_events is not None:
+            self.start()
+        # end if
+    # end def
+
+    @property
+    def queue(self) -> EventQueue:
+        return self._queue
+    # end def
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stopped = True
+        self._queue.close()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+        # end if
+    # end def
+
+    def run(self) -> None:
+        while not self._stopped:
+            batch = self._queue.get_batch()
+            if len(batch) > 0:
+                self._cb_events(batch)
+            # end if
+        # end while
+    # end def
+# end class
+
+
+class MidiDeviceRegistry:
+    # Enumerates the MIDI devices once and caches their MidiDeviceInfo records, so devices can be looked up (e.g. by
+    # name, which is stable, unlike the numeric ids) without querying PortMidi again.
+    # PortMidi only detects added or removed devices (e.g. a reconnected USB adapter) when it gets reinitialized, which
+    # invalidates all open devices. rescan() therefore probes the devices first (see MidiBackend.probe_devices) and only
+    # if they changed, it closes the devices of all Midi instances, reinitializes PortMidi and reopens the devices by
+    # name (the ids might have changed).
+    # The devices are provided by a MidiBackend, by default the real ones through PortMidi (see midi_backend).
+
+    def __init__(self, backend: Optional[MidiBackend] = None) -> None:
+        self._backend = backend if backend is not None else PygameBackend()
+        self._devices = None
+        self._lock = threading.RLock()
+        self._midis = weakref.WeakSet()  # Midi instances, whose devices need to be reopened on a rescan
+        self._watch_stop_event = None
+    # end def
+
+    @property
+    def backend(self) -> MidiBackend:
+        return self._backend
+    # end def
+
+    def register(self, midi: "Midi") -> None:
+        self._midis.add(midi)
+    # end def
+
+    def _enumerate(self) -> List[MidiDeviceInfo]:
+        devices = list()
+        for device_id in range(self._backend.get_count()):
+            raw_device_info = self._backend.get_device_info(device_id)
+            devices.append(MidiDeviceInfo(device_id, raw_device_info[0].decode(), raw_device_info[1].decode(),
+                                          *raw_device_info[2:]))
+        # end for
+
+        return devices
+    # end def
+
+    def devices(self, device_type: Optional[MidiDeviceType] = None) -> List[MidiDeviceInfo]:
+        with self._lock:
+            if self._devices is None:
+                self._backend.init()
+                self._devices = self._enumerate()
+            # end if
+            devices = self._devices
+        # end with
+
+        return [device for device in devices
+                if device_type is None or
+                device_type == MidiDeviceType.INPUT and device.is_input or
+                device_type == MidiDeviceType.OUTPUT and device.is_output]
+    # end def
+
+    def get(self, device_id: int) -> Optional[MidiDeviceInfo]:
+        devices = self.devices()
+
+        return devices[device_id] if 0 <= device_id < len(devices) else None
+    # end def
+
+    def find(self, name: str, device_type: Optional[MidiDeviceType] = None) -> Optional[MidiDeviceInfo]:
+        # An exact match of the name wins, otherwise the first device containing name (case-insensitive)
+        devices = self.devices(device_type)
+        for device in devices:
+            if device.name == name:
+                return device
+        # end for
+
+        for device in devices:
+            if name.lower() in device.name.lower():
+                return device
+        # end for
+
+        return None
+    # end def
+
+    @staticmethod
+    def _names(devices: List[MidiDeviceInfo]) -> List[Tuple[str, bool, bool]]:
+        return [(device.name, bool(device.is_input), bool(device.is_output)) for device in devices]
+    # end def
+
+    def rescan(self, force: bool = False) -> bool:
+        # Returns True if the list of devices changed. Unless forced, the open devices are left alone if it didn't.
+        with self._lock:
+            previous_devices = self._devices
+            if not force and previous_devices is not None:
+                probed_devices = self._backend.probe_devices()
+                if probed_devices is not None and [(name.decode(), bool(is_input), bool(is_output))
+                                                   for _, name, is_input, is_output, _ in probed_devices] == self._names(previous_devices):
+                    return False
+                # end if
+            # end if
+
+            midis = list(self._midis)
+            for midi in midis:
+                midi._close_devices()
+            # end for
+
+            self._backend.quit()
+            self._backend.init()
+            self._devices = self._enumerate()
+
+            for midi in midis:
+                midi._open_devices(by_name=True)
+            # end for
+        # end with
+
+        return previous_devices is None or self._names(previous_devices) != self._names(self._devices)
+    # end def
+
+    def watch(self, interval: float, cb_changed: Optional[Callable[[List[MidiDeviceInfo]], None]] = None) -> None:
+        # Rescans every interval seconds in a background thread (the open devices are only closed shortly if the devices
+        # changed, so messages sent right then might get lost)
+        self.stop_watching()
+        stop_event = self._watch_stop_event = threading.Event()
+
+        def watch() -> None:
+            while not stop_event.wait(interval):
+                if self.rescan() and cb_changed is not None:
+                    cb_changed(self.devices())
+                # end if
+            # end while
+        # end def
+
+        threading.Thread(target=watch, daemon=True).start()
+    # end def
+
+    def stop_watching(self) -> None:
+        if self._watch_stop_event is not None:
+            self._watch_stop_event.set()
+            self._watch_stop_event = None
+        # end if
+    # end def
+# end class
+
+
 class Midi(threading.Thread):
-    def __init__(self, midi_input_device_id: Optional[int] = None, midi_output_device_id: Optional[int] = None, cb_event: Optional[Callable[[MidiEvent], None]] = None) -> None:
-        super().__init__()
+    # Maximum number of messages PortMidi accepts in one write call
+    _MAX_WRITE_BATCH_SIZE = 1024
+
+    # Shared by all instances
+    registry = MidiDeviceRegistry()
+
+    def __init__(self, midi_input_device_id: Optional[int] = None, midi_output_device_id: Optional[int] = None, cb_event: Optional[Callable[[MidiEvent], None]] = None,
+                 output_latency: int = 0, poll_interval_min: float = 0.0005, poll_interval_max: float = 0.01,
+                 cb_batch: Optional[Callable[[EventBatch], None]] = None, message_filter: Optional[MessageFilter] = None,
+                 instrumentation: Optional[Instrumentation] = None, collect_stats: bool = False) -> None:
+        super().__init__(daemon=True)
 
         Midi._init_midi()
 
         self._cb_event = cb_event
+        self._cb_batch = cb_batch  # Gets each read as EventBatch in the reader thread, without creating MidiEvent objects
+        self._message_filter = message_filter  # Applied to the input before any callback (None: pass everything)
+        self._instrumentation = instrumentation  # Opt-in, see midi_trace
         self._midi_input_device_id = midi_input_device_id
         self._midi_output_device_id = midi_output_device_id
-        self._input_device = pygame.midi.Input(self._midi_input_device_id) if self._midi_input_device_id is not None else None  # Open a specific midi input device
-        self._output_device = pygame.midi.Output(self._midi_output_device_id) if self._midi_output_device_id is not None else None  # Open a specific midi output device
+        # With a latency > 0 (in ms), PortMidi sends each message at its timestamp + latency, otherwise immediately
+        self._output_latency = output_latency
+        # The devices are reopened by name after a rescan of the registry
+        self._input_device_name = self._device_name(midi_input_device_id)
+        self._output_device_name = self._device_name(midi_output_device_id)
+        self._input_device = None
+        self._output_device = None
+        self._device_lock = threading.RLock()
+        self._channel_state = ChannelState()  # The state of a freshly opened device is unknown
+        # The input gets polled tightly after activity, the interval is doubled up to the maximum while being idle
+        self._poll_interval_min = poll_interval_min
+        self._poll_interval_max = poll_interval_max
+        self._stop_event = threading.Event()
+        # Time between an event's PortMidi timestamp and its callback (fixed size, as an input might run for hours).
+        # Only collected on request, as it costs a histogram update per event.
+        self._collect_stats = collect_stats
+        self._input_stats = Histogram("input latency")
+        self._subscriptions = list()
+
+        self._open_devices()
+        Midi.registry.register(self)
 
         # Start the thread
         self.start()
     # end def
 
     def __del__(self):
-        del self._input_device
-        del self._output_device
-        pygame.midi.quit()
+        self._close_devices()
+    # end def
+
+    @classmethod
+    def _device_name(cls, device_id: Optional[int]) -> Optional[str]:
+        device = cls.registry.get(device_id) if device_id is not None else None
+
+        return device.name if device is not None else None
+    # end def
+
+    def _open_devices(self, by_name: bool = False) -> None:
+        with self._device_lock:
+            if by_name:
+                input_device = Midi.registry.find(self._input_device_name, MidiDeviceType.INPUT) if self._input_device_name is not None else None
+                output_device = Midi.registry.find(self._output_device_name, MidiDeviceType.OUTPUT) if self._output_device_name is not None else None
+                self._midi_input_device_id = input_device.device_id if input_device is not None else None
+                self._midi_output_device_id = output_device.device_id if output_device is not None else None
+            # end if
+
+            backend = Midi.registry.backend
+            self._input_device = backend.open_input(self._midi_input_device_id) if self._midi_input_device_id is not None else None  # Open a specific midi input device
+            self._output_device = backend.open_output(self._midi_output_device_id, self._output_latency) if self._midi_output_device_id is not None else None  # Open a specific midi output device
+            if self._output_device is not None and self._instrumentation is not None:
+                self._output_device = InstrumentedOutput(self._output_device, self._instrumentation)
+            # end if
+            self.invalidate_channel_state()
+        # end with
+    # end def
+
+    def _close_devices(self) -> None:
+        with self._device_lock:
+            for device in (self._input_device, self._output_device):
+                if device is not None:
+                    device.close()
+                # end if
+            # end for
+            self._input_device = None
+            self._output_device = None
+        # end with
+    # end def
+
+    def reopen(self) -> bool:
+        # Rescans the devices (e.g. after reconnecting a USB adapter) and reopens the devices of all Midi instances by
+        # name, even if the list of devices is unchanged. Returns True if all devices of this instance are available
+        # again.
+        Midi.registry.rescan(force=True)
+
+        return self.is_open
+    # end def
+
+    @property
+    def is_open(self) -> bool:
+        return (self._input_device_name is None or self._input_device is not None) and \
+            (self._output_device_name is None or self._output_device is not None)
+    # end def
+
+    @property
+    def input_device_name(self) -> Optional[str]:
+        return self._input_device_name
+    # end def
+
+    @property
+    def output_device_name(self) -> Optional[str]:
+        return self._output_device_name
     # end def
 
     @property
@@ -151,64 +871,259 @@ class Midi(threading.Thread):
         self._cb_event = value
     # end def
 
+    @property
+    def cb_batch(self) -> Optional[Callable[[EventBatch], None]]:
+        return self._cb_batch
+    # end def
+
+    @cb_batch.setter
+    def cb_batch(self, value: Optional[Callable[[EventBatch], None]]) -> None:
+        self._cb_batch = value
+    # end def
+
+    @property
+    def message_filter(self) -> Optional[MessageFilter]:
+        return self._message_filter
+    # end def
+
+    @property
+    def input_stats(self) -> Histogram:
+        return self._input_stats
+    # end def
+
+    @property
+    def collect_stats(self) -> bool:
+        return self._collect_stats
+    # end def
+
+    @collect_stats.setter
+    def collect_stats(self, collect_stats: bool) -> None:
+        self._collect_stats = collect_stats
+    # end def
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        # Stops the input loop and all subscriptions and waits for the threads to end
+        self._stop_event.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+        # end if
+
+        for subscription in list(self._subscriptions):
+            self.unsubscribe(subscription)
+        # end for
+    # end def
+
+    def subscribe(self, cb_events: Optional[Callable[[List[MidiEvent]], None]], capacity: int = 4096,
+                  policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST) -> Subscription:
+        # Each subscription gets all events independently of the others (and of cb_event, which still gets called
+        # synchronously in the reader thread)
+        return self.add_subscription(Subscription(cb_events, capacity, policy))
+    # end def
+
+    def add_subscription(self, subscription: Subscription) -> Subscription:
+        # A subscription can also be fed by several inputs (e.g. a recorder merging them into one file)
+        self._subscriptions = self._subscriptions + [subscription]  # Copy on write, the reader thread iterates the list
+
+        return subscription
+    # end def
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self._subscriptions = [s for s in self._subscriptions if s is not subscription]
+        subscription.stop()
+    # end def
+
+    @property
+    def channel_state(self) -> ChannelState:
+        return self._channel_state
+    # end def
+
+    def invalidate_channel_state(self) -> None:
+        # Needs to be called whenever the device's state is unknown (e.g. after reopening it), so everything gets sent again
+        self._channel_state.invalidate()
+    # end def
+
+    @property
+    def output_latency(self) -> int:
+        return self._output_latency
+    # end def
+
+    @staticmethod
+    def time() -> int:
+        # Current time of the PortMidi clock (or the backend's) in ms, which is the reference for the timestamps of all
+        # messages
+        return Midi.registry.backend.time()
+    # end def
+
+    @staticmethod
+    def note_message(note: int, velocity: int, channel: int = 0, off: bool = False) -> List[int]:
+        return [(0x80 if off else 0x90) | channel, note, velocity]
+    # end def
+
+    @staticmethod
+    def program_change_message(instrument: int, channel: int = 0) -> List[int]:
+        return [0xc0 | channel, instrument]
+    # end def
+
+    def write(self, messages: List[Tuple[List[int], int]]) -> None:
+        # Sends a list of timestamped messages ([[status, data1, data2], timestamp]). The timestamps (see time()) need to
+        # be in ascending order and are only respected if the output got opened with a latency > 0.
+        # While the output device is unavailable (e.g. disconnected), all messages are dropped (applies to all methods).
+        with self._device_lock:
+            if self._output_device is not None:
+                for m in range(0, len(messages), self._MAX_WRITE_BATCH_SIZE):
+                    self._output_device.write(messages[m:m + self._MAX_WRITE_BATCH_SIZE])
+                # end for
+            # end if
+        # end with
+    # end def
+
+    def write_short(self, status: int, data1: int = 0, data2: int = 0) -> None:
+        # Sends a single message immediately (e.g. when forwarding input), keeping the channel state up to date
+        kind = status & 0xf0
+        with self._device_lock:
+            if self._output_device is not None:
+                if kind == 0xc0:
+                    self._channel_state.update_program(status & 0x0f, data1)
+                elif kind == 0xb0:
+                    self._channel_state.update_controller(status & 0x0f, data1, data2)
+                # end if
+                self._output_device.write_short(status, data1, data2)
+            # end if
+        # end with
+    # end def
+
     @staticmethod
     def _init_midi() -> None:
-        # Set up pygame
-        pygame.init()
-        pygame.midi.init()
+        # Only the MIDI subsystem is needed (pygame.init() would set up display, audio etc. as well)
+        Midi.registry.backend.init()
+    # end def
+
+    def set_instrument(self, instrument: int, channel: int = 0) -> None:
+        # Only sent if the channel's program changes
+        with self._device_lock:
+            if self._output_device is not None and self._channel_state.update_program(channel, instrument):
+                # https://stackoverflow.com/questions/29805082/pygame-midi-multi-instrument
+                self._output_device.set_instrument(instrument, channel)
+            # end if
+        # end with
+    # end def
+
+    def set_controller(self, controller: int, value: int, channel: int = 0) -> None:
+        # Only sent if the controller's value changes
+        with self._device_lock:
+            if self._output_device is not None and self._channel_state.update_controller(channel, controller, value):
+                self._output_device.write_short(0xb0 | channel, controller, value)
+            # end if
+        # end with
     # end def
 
     def play_note(self, note: int, velocity: int, channel: int = 0, instrument: Optional[int] = None, off: bool = False) -> None:
         if instrument is not None:
-            # https://stackoverflow.com/questions/29805082/pygame-midi-multi-instrument
-            self._output_device.set_instrument(instrument, channel)
+            self.set_instrument(instrument, channel)
 
-        if not off:
-            self._output_device.note_on(note, velocity, channel)
-        else:
-            self._output_device.note_off(note, velocity, channel)
-        # end if
+        with self._device_lock:
+            if self._output_device is None:
+                pass
+            elif not off:
+                self._output_device.note_on(note, velocity, channel)
+            else:
+                self._output_device.note_off(note, velocity, channel)
+            # end if
+        # end with
     # end def
 
     @staticmethod
     def get_midi_devices(device_type: Optional[MidiDeviceType] = None) -> List[MidiDeviceInfo]:
-        Midi._init_midi()
-
-        devices = list()
+        # Cached, see MidiDeviceRegistry.rescan() to detect added or removed devices
+        return Midi.registry.devices(device_type)
+    # end def
 
-        for d, raw_device in enumerate(range(0, pygame.midi.get_count())):
-            raw_device_info = pygame.midi.get_device_info(raw_device)
-            device = MidiDeviceInfo(d,
-                                    raw_device_info[0].decode(),
-                                    raw_device_info[1].decode(),
-                                    *raw_device_info[2:])
-            if device_type is None or \
-                    device_type == MidiDeviceType.INPUT and device.is_input or \
-                    device_type == MidiDeviceType.OUTPUT and device.is_output:
-                devices.append(device)
-            # end if
-        # end for
+    @staticmethod
+    def find_device(name: str, device_type: Optional[MidiDeviceType] = None) -> Optional[MidiDeviceInfo]:
+        # By exact name or by a part of it (e.g. "USB MIDI")
+        return Midi.registry.find(name, device_type)
+    # end def
 
-        return devices
+    @classmethod
+    def set_backend(cls, backend: MidiBackend) -> None:
+        # Replaces the MIDI I/O of all instances created afterwards (e.g. with a midi_backend.LoopbackBackend for
+        # benchmarks and tests, which don't need any devices)
+        cls.registry = MidiDeviceRegistry(backend)
     # end def
 
     def run(self) -> None:
-        if self._input_device is not None:
+        if self._input_device is not None or self._input_device_name is not None:
+            poll_interval = self._poll_interval_min
+
             # Run the event loop
-            while True:
-                if self._input_device.poll():  # Spelling error in midi signature file
+            while not self._stop_event.is_set():
+                # The device might get reopened by a rescan of the registry in the meantime
+                with self._device_lock:
+                    input_device = self._input_device
                     # No way to find number of messages in queue
-                    events = self._input_device.read(1000)
-                    for event in events:
+                    raw_events = input_device.read(1000) if input_device is not None and input_device.poll() else None  # Spelling error in midi signature file
+                # end with
+
+                if raw_events is not None:
+                    if self._message_filter is not None:
+                        raw_events = self._message_filter.apply(raw_events)
+                        if len(raw_events) == 0:
+                            poll_interval = self._poll_interval_min
+                            continue
+                        # end if
+                    # end if
+
+                    batch = EventBatch(raw_events, self._midi_input_device_id)
+
+                    now = Midi.time()
+                    if self._collect_stats:
+                        for timestamp in batch.timestamp:
+                            self._input_stats.add((now - timestamp) / 1000.)
+                        # end for
+                    # end if
+
+                    instrumentation = self._instrumentation
+                    if instrumentation is not None:
+                        for status, data1, data2, timestamp in batch:
+                            instrumentation.input_latency.add((now - timestamp) / 1000.)
+                            instrumentation.trace.record(EventTrace.INPUT, status, data1, data2, (now - timestamp) / 1000.)
+                        # end for
+                        callback_start_time = time.perf_counter()
+                    # end if
+
+                    if self._cb_batch:
+                        self._cb_batch(batch)
+                    # end if
+
+                    # MidiEvent objects are only created if someone needs them
+                    subscriptions = self._subscriptions
+                    if self._cb_event or len(subscriptions) > 0:
+                        events = batch.events()
+
                         if self._cb_event:
-                            midi_event = MidiEvent(*event[0], event[1], self._midi_input_device_id)
-                            self._cb_event(midi_event)
+                            for event in events:
+                                self._cb_event(event)
+                            # end for
                         # end if
-                    # end for
 
-                    # Wait 10ms - this is arbitrary, but wait(0) still resulted in 100% cpu utilization
-                pygame.time.wait(10)
+                        for subscription in subscriptions:
+                            subscription.queue.put_batch(events)
+                        # end for
+                    # end if
+
+                    if instrumentation is not None:
+                        instrumentation.callback_duration.add(time.perf_counter() - callback_start_time)
+                    # end if
+
+                    # Poll again right away, as more events are likely to follow
+                    poll_interval = self._poll_interval_min
+                    continue
+                # end if
+
+                # Back off while being idle (wait(0) would result in 100% cpu utilization)
+                self._stop_event.wait(poll_interval)
+                poll_interval = min(poll_interval * 2., self._poll_interval_max)
             # end while
-        # end def
-    # end if
+        # end if
+    # end def
 # end class
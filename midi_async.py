@@ -0,0 +1,168 @@
+import asyncio
+import time
+from typing import AsyncIterator, Callable, List, Optional, Sequence, Tuple
+
+from midi import EventQueue, Midi, MidiEvent, OverflowPolicy, Subscription
+from midi_scheduler import Scheduler, SchedulerStats
+from midi_trace import Instrumentation
+
+
+class _AsyncEventQueue(EventQueue):
+    # EventQueue, which wakes up a coroutine waiting on an event loop when events arrive (or the queue gets closed).
+    # The reader thread only calls into the loop if the consumer is actually waiting.
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, capacity: int, policy: OverflowPolicy) -> None:
+        super().__init__(capacity, policy)
+        self._loop = loop
+        self._ready = asyncio.Event()
+        self._waiting = False
+    # end def
+
+    def _wake_up(self) -> None:
+        if self._waiting:
+            self._loop.call_soon_threadsafe(self._ready.set)
+        # end if
+    # end def
+
+    def put_batch(self, events: Sequence[MidiEvent]) -> None:
+        super().put_batch(events)
+        self._wake_up()
+    # end def
+
+    def close(self) -> None:
+        super().close()
+        self._wake_up()
+    # end def
+
+    async def get_batch_async(self) -> List[MidiEvent]:
+        # Returns all pending events, waits for events if there are none (an empty list if the queue got closed)
+        while True:
+            batch = self.get_batch(timeout=0)
+            if len(batch) > 0 or self.closed:
+                return batch
+            # end if
+
+            # Checking again after announcing the wait, so events put in the meantime aren't missed
+            self._ready.clear()
+            self._waiting = True
+            batch = self.get_batch(timeout=0)
+            if len(batch) > 0 or self.closed:
+                self._waiting = False
+                return batch
+            # end if
+            await self._ready.wait()
+            self._waiting = False
+        # end while
+    # end def
+# end class
+
+
+class AsyncSubscription(Subscription):
+    # Subscription consumed by a coroutine: no thread is started, the reader thread of the Midi instance hands the
+    # events over to the event loop through a bounded queue.
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, capacity: int = 4096,
+                 policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST) -> None:
+        super().__init__(None, capacity, policy)
+        self._queue = _AsyncEventQueue(loop, capacity, policy)
+    # end def
+
+    async def get_batch(self) -> List[MidiEvent]:
+        return await self._queue.get_batch_async()
+    # end def
+# end class
+
+
+class AsyncMidi:
+    # asyncio facade of a Midi instance. The input is still read by the instance's reader thread (with all of its
+    # filtering and callbacks), each events()/batches() iterator gets the events through its own AsyncSubscription.
+    # Any number of AsyncMidi instances and playbacks (see AsyncScheduler) can share one event loop.
+
+    def __init__(self, midi: Midi) -> None:
+        self._midi = midi
+    # end def
+
+    @property
+    def midi(self) -> Midi:
+        return self._midi
+    # end def
+
+    async def batches(self, capacity: int = 4096, policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST) -> AsyncIterator[List[MidiEvent]]:
+        # All events pending at once, ends when the Midi instance gets stopped
+        subscription = self._midi.add_subscription(AsyncSubscription(asyncio.get_running_loop(), capacity, policy))
+        try:
+            while True:
+                batch = await subscription.get_batch()
+                if len(batch) == 0:  # Closed
+                    return
+                # end if
+                yield batch
+            # end while
+        finally:
+            self._midi.unsubscribe(subscription)
+        # end try
+    # end def
+
+    async def events(self, capacity: int = 4096, policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST) -> AsyncIterator[MidiEvent]:
+        async for batch in self.batches(capacity, policy):
+            for event in batch:
+                yield event
+            # end for
+        # end for
+    # end def
+
+    async def send_batch(self, messages: List[Tuple[List[int], int]]) -> None:
+        # Timestamped messages as for Midi.write(). PortMidi only queues them, so the write doesn't block the loop
+        # for long; afterwards other tasks get the chance to run.
+        self._midi.write(messages)
+        await asyncio.sleep(0)
+    # end def
+
+    async def send(self, status: int, data1: int = 0, data2: int = 0) -> None:
+        self._midi.write_short(status, data1, data2)
+        await asyncio.sleep(0)
+    # end def
+# end class
+
+
+class AsyncScheduler(Scheduler):
+    # Scheduler for the asyncio event loop: waits for the deadlines with asyncio.sleep() instead of blocking a thread,
+    # so many playbacks can run in one thread. Its precision is the one of the loop's timers (about 1 ms) instead of
+    # spinning; for precise timing use run_batched() with an output latency, which leaves the timing to PortMidi.
+
+    def __init__(self, clock: Callable[[], float] = time.perf_counter, instrumentation: Optional[Instrumentation] = None) -> None:
+        super().__init__(0., clock, instrumentation)
+    # end def
+
+    async def _wait_until_async(self, deadline: float) -> bool:
+        remaining = deadline - self._clock()
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+        # end if
+
+        return not self._stop_event.is_set()
+    # end def
+
+    async def run(self, times: Sequence[float], cb_event: Callable[[int], None], start_time: Optional[float] = None) -> SchedulerStats:
+        # See Scheduler.run()
+        for deadline in self._events(times, cb_event, start_time):
+            if not await self._wait_until_async(deadline):
+                break
+            # end if
+        # end for
+
+        return self._stats
+    # end def
+
+    async def run_batched(self, times: Sequence[float], cb_batch: Callable[[int, int], None], window: float,
+                          start_time: Optional[float] = None) -> SchedulerStats:
+        # See Scheduler.run_batched()
+        for deadline in self._batches(times, cb_batch, window, start_time):
+            if not await self._wait_until_async(deadline):
+                break
+            # end if
+        # end for
+
+        return self._stats
+    # end def
+# end class
@@ -0,0 +1,317 @@
+import ast
+import heapq
+import os
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+# A raw message as returned by read() of an input: [[status, data1, data2, data3], timestamp in ms]
+RawEvent = List[Any]
+
+
+class MidiBackend:
+    # The MIDI I/O used by Midi and MidiDeviceRegistry, modelled on pygame.midi: device enumeration, opening inputs
+    # and outputs and the clock all timestamps refer to. Inputs need poll(), read(n) and close(); outputs write(),
+    # write_short(), set_instrument(), note_on(), note_off() and close(), with the semantics of pygame.midi.
+
+    def init(self) -> None:
+        raise NotImplementedError()
+    # end def
+
+    def quit(self) -> None:
+        raise NotImplementedError()
+    # end def
+
+    def get_count(self) -> int:
+        raise NotImplementedError()
+    # end def
+
+    def get_device_info(self, device_id: int) -> Tuple[bytes, bytes, int, int, int]:
+        # (interface, name, is_input, is_output, is_opened)
+        raise NotImplementedError()
+    # end def
+
+    def probe_devices(self) -> Optional[List[Tuple[bytes, bytes, int, int, int]]]:
+        # The infos of the devices currently present, without affecting the open ones (None if they can only be
+        # detected by reinitializing). By default, the enumeration is up to date.
+        return [self.get_device_info(device_id) for device_id in range(self.get_count())]
+    # end def
+
+    def open_input(self, device_id: int) -> Any:
+        raise NotImplementedError()
+    # end def
+
+    def open_output(self, device_id: int, latency: int = 0) -> Any:
+        raise NotImplementedError()
+    # end def
+
+    def time(self) -> int:
+        # Current time in ms
+        raise NotImplementedError()
+    # end def
+# end class
+
+
+class PygameBackend(MidiBackend):
+    # The real devices, through PortMidi
+
+    # PortMidi only enumerates the devices when it gets initialized, so they are probed by a separate process
+    _PROBE_CODE = "import pygame.midi; pygame.midi.init(); " \
+                  "print(repr([pygame.midi.get_device_info(i) for i in range(pygame.midi.get_count())]))"
+    _PROBE_TIMEOUT = 10.  # s
+
+    def __init__(self) -> None:
+        import pygame.midi
+
+        self._midi = pygame.midi
+    # end def
+
+    def init(self) -> None:
+        self._midi.init()
+    # end def
+
+    def quit(self) -> None:
+        self._midi.quit()
+    # end def
+
+    def get_count(self) -> int:
+        return self._midi.get_count()
+    # end def
+
+    def get_device_info(self, device_id: int) -> Tuple[bytes, bytes, int, int, int]:
+        return self._midi.get_device_info(device_id)
+    # end def
+
+    def probe_devices(self) -> Optional[List[Tuple[bytes, bytes, int, int, int]]]:
+        try:
+            result = subprocess.run([sys.executable, "-c", self._PROBE_CODE], capture_output=True, check=True,
+                                    timeout=self._PROBE_TIMEOUT, env=dict(os.environ, PYGAME_HIDE_SUPPORT_PROMPT="1"))
+            return ast.literal_eval(result.stdout.decode().strip().splitlines()[-1])
+        except (OSError, IndexError, SyntaxError, ValueError, subprocess.SubprocessError):
+            return None
+        # end try
+    # end def
+
+    def open_input(self, device_id: int) -> Any:
+        return self._midi.Input(device_id)
+    # end def
+
+    def open_output(self, device_id: int, latency: int = 0) -> Any:
+        return self._midi.Output(device_id, latency=latency)
+    # end def
+
+    def time(self) -> int:
+        return self._midi.time()
+    # end def
+# end class
+
+
+class LoopbackPort:
+    # A virtual cable: everything written to the port arrives at its input, timestamped messages (with a latency > 0)
+    # when they are due. All messages sent through the port are also logged with the time of the backend's clock
+    # (in s), so tests and benchmarks can check what got sent and when.
+
+    def __init__(self, name: str, clock: Callable[[], float]) -> None:
+        self._name = name
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._pending = list()  # Heap of (due time in ms, sequence number, message)
+        self._sequence = 0
+        self._log = list()  # (time in s, status, data1, data2)
+    # end def
+
+    @property
+    def name(self) -> str:
+        return self._name
+    # end def
+
+    @property
+    def log(self) -> List[Tuple[float, int, int, int]]:
+        return self._log
+    # end def
+
+    def _time_ms(self) -> int:
+        return int(self._clock() * 1000.)
+    # end def
+
+    def send(self, status: int, data1: int = 0, data2: int = 0, due: Optional[int] = None) -> None:
+        due = self._time_ms() if due is None else due
+        with self._lock:
+            heapq.heappush(self._pending, (due, self._sequence, [[status, data1, data2, 0], due]))
+            self._sequence += 1
+            self._log.append((self._clock(), status, data1, data2))
+        # end with
+    # end def
+
+    def poll(self) -> bool:
+        with self._lock:
+            return len(self._pending) > 0 and self._pending[0][0] <= self._time_ms()
+    # end def
+
+    def read(self, n_events: int) -> List[RawEvent]:
+        now = self._time_ms()
+        events = list()
+        with self._lock:
+            while len(events) < n_events and len(self._pending) > 0 and self._pending[0][0] <= now:
+                events.append(heapq.heappop(self._pending)[2])
+            # end while
+        # end with
+
+        return events
+    # end def
+# end class
+
+
+class _LoopbackInput:
+    def __init__(self, port: LoopbackPort) -> None:
+        self._port = port
+    # end def
+
+    def poll(self) -> bool:
+        return self._port.poll()
+    # end def
+
+    def read(self, n_events: int) -> List[RawEvent]:
+        return self._port.read(n_events)
+    # end def
+
+    def close(self) -> None:
+        pass
+    # end def
+# end class
+
+
+class _LoopbackOutput:
+    def __init__(self, port: LoopbackPort, latency: int) -> None:
+        self._port = port
+        self._latency = latency
+    # end def
+
+    def write(self, messages: Sequence) -> None:
+        # Like PortMidi, the timestamps are only respected with a latency > 0
+        for message, timestamp in messages:
+            self._port.send(*message[:3], due=timestamp + self._latency if self._latency > 0 else None)
+        # end for
+    # end def
+
+    def write_short(self, status: int, data1: int = 0, data2: int = 0) -> None:
+        self._port.send(status, data1, data2)
+    # end def
+
+    def set_instrument(self, instrument: int, channel: int = 0) -> None:
+        self._port.send(0xc0 | channel, instrument)
+    # end def
+
+    def note_on(self, note: int, velocity: int, channel: int = 0) -> None:
+        self._port.send(0x90 | channel, note, velocity)
+    # end def
+
+    def note_off(self, note: int, velocity: int = 0, channel: int = 0) -> None:
+        self._port.send(0x80 | channel, note, velocity)
+    # end def
+
+    def close(self) -> None:
+        pass
+    # end def
+# end class
+
+
+class LoopbackBackend(MidiBackend):
+    # In-process backend without any devices or drivers, e.g. for benchmarks and tests. Each port is a virtual cable
+    # with an output device (id 2 * port) and an input device (id 2 * port + 1) named "Loopback <port>". Traffic from
+    # outside (e.g. a keyboard) is simulated by inject() or replay(), which write to a port like an output would.
+
+    def __init__(self, n_ports: int = 2, clock: Callable[[], float] = time.perf_counter) -> None:
+        self._clock = clock
+        self._start_time = clock()
+        self._ports = [LoopbackPort(f"Loopback {port}", self._time) for port in range(n_ports)]
+    # end def
+
+    def _time(self) -> float:
+        return self._clock() - self._start_time
+    # end def
+
+    @property
+    def ports(self) -> List[LoopbackPort]:
+        return self._ports
+    # end def
+
+    @staticmethod
+    def output_device_id(port: int) -> int:
+        return 2 * port
+    # end def
+
+    @staticmethod
+    def input_device_id(port: int) -> int:
+        return 2 * port + 1
+    # end def
+
+    def init(self) -> None:
+        pass
+    # end def
+
+    def quit(self) -> None:
+        pass
+    # end def
+
+    def get_count(self) -> int:
+        return 2 * len(self._ports)
+    # end def
+
+    def get_device_info(self, device_id: int) -> Tuple[bytes, bytes, int, int, int]:
+        is_input = device_id % 2
+
+        return b"Loopback", self._ports[device_id // 2].name.encode(), is_input, 1 - is_input, 0
+    # end def
+
+    def open_input(self, device_id: int) -> Any:
+        return _LoopbackInput(self._ports[device_id // 2])
+    # end def
+
+    def open_output(self, device_id: int, latency: int = 0) -> Any:
+        return _LoopbackOutput(self._ports[device_id // 2], latency)
+    # end def
+
+    def time(self) -> int:
+        return int(self._time() * 1000.)
+    # end def
+
+    def inject(self, port: int, messages: Sequence[Sequence[int]]) -> None:
+        # Sends [status, data1, data2] messages to the input of the port right away
+        for message in messages:
+            self._ports[port].send(*message[:3])
+        # end for
+    # end def
+
+    def replay(self, port: int, events: Sequence[RawEvent], rate: float = 0., speed: float = 1.) -> threading.Thread:
+        # Sends recorded events ([[status, data1, data2, data3], timestamp in ms], as read from an input) to the input
+        # of the port in a background thread, either at a fixed rate (events per second) or at their recorded
+        # timestamps (scaled by 1 / speed). Returns the started thread, join() it to wait for the end.
+        def replay() -> None:
+            # Sends all events that are due, then sleeps until the next one is (instead of spinning, which would hold
+            # the GIL and slow down the threads under test)
+            start_time = self._time()
+            first_timestamp = events[0][1] if len(events) > 0 else 0
+            dues = [start_time + (index / rate if rate > 0 else (timestamp - first_timestamp) / 1000. / speed)
+                    for index, (_, timestamp) in enumerate(events)]
+            index = 0
+            while index < len(events):
+                now = self._time()
+                while index < len(events) and dues[index] <= now:
+                    self._ports[port].send(*events[index][0][:3])
+                    index += 1
+                # end while
+                if index < len(events):
+                    time.sleep(max(dues[index] - self._time(), 0.))
+                # end if
+            # end while
+        # end def
+
+        thread = threading.Thread(target=replay, daemon=True)
+        thread.start()
+
+        return thread
+    # end def
+# end class
@@ -0,0 +1,415 @@
+import argparse
+import contextlib
+import datetime
+import glob
+import io
+import json
+import os
+os.environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "1"  # noqa # Suppresses pygame console output
+import platform
+import random
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from midi import EventBatch, LatencyStats, MessageFilter, Midi, MidiEvent
+from midi_backend import LoopbackBackend
+from midi_trace import Histogram
+
+_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+class _DictMidiEvent:
+    # MidiEvent as it was before using __slots__ (instance dict), as reference for the benchmark
+    def __init__(self, status: int, data1: int, data2: int, data3: int, timestamp: int, device_id: int) -> None:
+        self._status = status
+        self._data1 = data1
+        self._data2 = data2
+        self._data3 = data3
+        self._timestamp = timestamp
+        self._device_id = device_id
+    # end def
+
+    @property
+    def status(self) -> int:
+        return self._status
+    # end def
+
+    @property
+    def data1(self) -> int:
+        return self._data1
+    # end def
+
+    @property
+    def data2(self) -> int:
+        return self._data2
+    # end def
+# end class
+
+
+def _raw_events(n_events: int) -> List:
+    # Same structure as the result of pygame.midi.Input.read, mostly controller and aftertouch traffic
+    rng = random.Random(0)
+
+    return [[[rng.choice((0xb0, 0xd0, 0x90, 0x80)), rng.randrange(128), rng.randrange(128), 0], t] for t in range(n_events)]
+# end def
+
+
+def _consume_dict_events(raw_events: List) -> int:
+    checksum = 0
+    for event in [_DictMidiEvent(*e[0], e[1], 1) for e in raw_events]:
+        checksum += event.status + event.data1 + event.data2
+    # end for
+
+    return checksum
+# end def
+
+
+def _consume_slots_events(raw_events: List) -> int:
+    checksum = 0
+    for event in [MidiEvent(*e[0], e[1], 1) for e in raw_events]:
+        checksum += event.status + event.data1 + event.data2
+    # end for
+
+    return checksum
+# end def
+
+
+def _consume_event_batch(raw_events: List) -> int:
+    checksum = 0
+    for status, data1, data2, _ in EventBatch(raw_events, 1):
+        checksum += status + data1 + data2
+    # end for
+
+    return checksum
+# end def
+
+
+def _measure(function: Callable[[List], int], raw_events: List, n_repeat: int) -> Tuple[float, float]:
+    # Returns the time (in ns) and the peak of allocated memory (in bytes, including temporaries) per event
+    seconds = min(timeit.repeat(lambda: function(raw_events), number=1, repeat=n_repeat))
+
+    tracemalloc.start()
+    function(raw_events)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return seconds / len(raw_events) * 1e9, peak / len(raw_events)
+# end def
+
+
+def bench_events(n_events: int = 1000, n_repeat: int = 200) -> Dict[str, Any]:
+    # Per-event cost of converting one read() result and touching status, data1 and data2 of each event
+    raw_events = _raw_events(n_events)
+    assert _consume_dict_events(raw_events) == _consume_slots_events(raw_events) == _consume_event_batch(raw_events)
+
+    results = dict()
+    print(f"Per-event overhead ({n_events} events per read, best of {n_repeat}):")
+    for name, function in (("MidiEvent (dict)", _consume_dict_events),
+                           ("MidiEvent (__slots__)", _consume_slots_events),
+                           ("EventBatch", _consume_event_batch)):
+        ns, n_bytes = _measure(function, raw_events, n_repeat)
+        results[name] = {"ns_per_event": ns, "peak_bytes_per_event": n_bytes}
+        print(f"  {name:<22} {ns:8.1f} ns/event {n_bytes:8.1f} peak bytes/event")
+    # end for
+
+    return results
+# end def
+
+
+# The startup of each mode of midi_test.py as done by main(), but against the loopback backend: the Midi instances
+# get created (the modules of the real backend are imported as well, to keep the import time comparable), and so do
+# the score and index of the modes using them. Show mode can't open its window without a display, so the modules its
+# run() imports are imported directly.
+_STARTUP_SETUP = """
+import contextlib, io, os, sys, tempfile
+import pygame.midi
+from midi import Midi
+from midi_backend import LoopbackBackend
+Midi.set_backend(LoopbackBackend(2))
+import midi_test
+input_id, output_id = LoopbackBackend.input_device_id(0), LoopbackBackend.output_device_id(1)
+score = {score!r}
+directory = tempfile.mkdtemp()
+with contextlib.redirect_stdout(io.StringIO()):
+"""
+
+# Code creating each mode and heavy modules the mode must not import (regression guard for the lazy imports)
+_STARTUP_MODES = {"thru": ("midi_test.MidiTestThru(input_id, output_id)", ("pandas", "music21", "tkinter")),
+                  "show": ("midi_test.MidiTestShow(input_id, output_id); import tkinter, piano_roll", ("pandas", "music21")),
+                  "play": ("midi_test.MidiTestPlay(output_id, score, use_cache=False, parser='stream', end_time=0.).run()",
+                           ("pandas", "music21", "tkinter")),
+                  "practice": ("midi_test.MidiTestPractice(input_id, None, score, use_cache=False, parser='stream')",
+                               ("pandas", "music21", "tkinter")),
+                  "convert": ("midi_test.MidiTestConvert(directory).run()", ("pandas", "music21", "tkinter")),
+                  "library": ("midi_test.MidiTestLibrary(directory, os.path.join(directory, 'library.sqlite')).run()",
+                              ("pandas", "music21", "tkinter"))}
+
+# Reports the resident memory in MB if psutil is available (there is no portable way without it: ru_maxrss of the
+# resource module is only available on Unix and is in kB on Linux, but in bytes on macOS)
+_STARTUP_REPORT = """
+try:
+    import psutil
+    print(psutil.Process().memory_info().rss / 1024. ** 2)
+except ImportError:
+    print("-")
+print(' '.join(sorted({m.split('.')[0] for m in sys.modules})))
+"""
+
+
+def _startup(mode: str) -> Tuple[float, Optional[float], List[str]]:
+    # Starts the given mode in a fresh interpreter, returns the import time (in ms, as reported by -X importtime), the
+    # resident memory (in MB, None without psutil) and the loaded top-level modules
+    code = _STARTUP_SETUP.format(score=_scores()[0]) + f"    {_STARTUP_MODES[mode][0]}\n" + _STARTUP_REPORT
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, check=True,
+                            cwd=_DIRECTORY)
+
+    # Lines look like "import time:       self [us] |  cumulative | imported package", sum up the self times
+    import_time = sum(int(line.split("|")[0].split(":")[1]) for line in result.stderr.splitlines()
+                      if line.startswith("import time:") and not line.split("|")[0].split(":")[1].strip().startswith("self"))
+    rss, modules = result.stdout.splitlines()[-2:]
+
+    return import_time / 1000., float(rss) if rss != "-" else None, modules.split()
+# end def
+
+
+def bench_startup(n_repeat: int = 3) -> Dict[str, Any]:
+    # Startup cost of each mode of midi_test.py, including the heavy modules a mode imports although it shouldn't
+    results = dict()
+
+    print(f"Startup of midi_test.py (best of {n_repeat}):")
+    for mode, (_, forbidden) in _STARTUP_MODES.items():
+        runs = [_startup(mode) for _ in range(n_repeat)]
+        import_time = min(r[0] for r in runs)
+        rss = min(r[1] for r in runs) if runs[0][1] is not None else None
+        loaded = [module for module in forbidden if module in runs[0][2]]
+
+        results[mode] = {"import_ms": import_time, "rss_mb": rss, "forbidden_imports": loaded}
+        print(f"  {mode:<8} {import_time:8.1f} ms " + (f"{rss:8.1f} MB" if rss is not None else "       - MB") +
+              (f"  FAILED: imports {', '.join(loaded)}" if len(loaded) > 0 else ""))
+    # end for
+
+    return results
+# end def
+
+
+def _summary(stats: Union[LatencyStats, Histogram]) -> Dict[str, float]:
+    return {"count": stats.count, "mean_ms": stats.mean * 1e3, "p50_ms": stats.percentile(50.) * 1e3,
+            "p99_ms": stats.p99 * 1e3, "max_ms": stats.max * 1e3}
+# end def
+
+
+def _note_events(n_events: int) -> List:
+    # Alternating note-ons and note-offs as read from an input
+    return [[[0x90 if n % 2 == 0 else 0x80, 36 + (n // 2) % 60, 100 if n % 2 == 0 else 0, 0], n] for n in range(n_events)]
+# end def
+
+
+def bench_thru(n_events: int = 2000, rate: float = 1000.) -> Dict[str, Any]:
+    # Input-to-output latency of thru mode (an input routed to an output) using the loopback backend: the time
+    # between a message entering the input port and the routed message leaving through the output port
+    from midi_router import Route, Router
+
+    backend = LoopbackBackend(2)
+    Midi.set_backend(backend)
+    midi_input = Midi(backend.input_device_id(0), None, None, message_filter=MessageFilter())
+    midi_output = Midi(None, backend.output_device_id(1), None)
+    Router().add_route(midi_input, Route(midi_output))
+
+    backend.replay(0, _note_events(n_events), rate=rate).join()
+    deadline = time.perf_counter() + 1.
+    while len(backend.ports[1].log) < n_events and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    # end while
+    midi_input.stop()
+    midi_output.stop()
+
+    # Messages are neither dropped nor reordered, so the n-th output belongs to the n-th input
+    latencies = LatencyStats()
+    for (sent, *_), (received, *_) in zip(backend.ports[0].log, backend.ports[1].log):
+        latencies.add(received - sent)
+    # end for
+
+    results = {"n_sent": n_events, "n_received": len(backend.ports[1].log), "latency": _summary(latencies)}
+    print(f"Thru latency ({n_events} events at {rate:.0f} events/s): {latencies}, {results['n_received']} received")
+
+    return results
+# end def
+
+
+def bench_throughput(rate: float = 10000., seconds: float = 2.) -> Dict[str, Any]:
+    # Input callback throughput: events are sent at the given rate, the Midi instance creates a MidiEvent per event
+    # and calls cb_event for it
+    backend = LoopbackBackend(1)
+    Midi.set_backend(backend)
+    n_events = int(rate * seconds)
+    received = list()
+
+    def cb_event(event: MidiEvent) -> None:
+        received.append(time.perf_counter())
+    # end def
+
+    midi_input = Midi(backend.input_device_id(0), None, cb_event, collect_stats=True)
+    cpu_time = time.process_time()
+    start_time = time.perf_counter()
+    backend.replay(0, _note_events(n_events), rate=rate).join()
+    deadline = time.perf_counter() + 1.
+    while len(received) < n_events and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    # end while
+    cpu_time = time.process_time() - cpu_time
+    midi_input.stop()
+
+    duration = received[-1] - start_time if len(received) > 0 else 0.
+    results = {"rate": rate, "n_sent": n_events, "n_received": len(received),
+               "events_per_s": len(received) / duration if duration > 0 else 0., "cpu_s": cpu_time,
+               "input_latency": _summary(midi_input.input_stats)}
+    print(f"Callback throughput ({n_events} events at {rate:.0f} events/s): {results['events_per_s']:.0f} events/s, "
+          f"{len(received)} received, {cpu_time:.2f} s CPU, input latency {midi_input.input_stats}")
+
+    return results
+# end def
+
+
+def _scores() -> List[str]:
+    return sorted(glob.glob(os.path.join(_DIRECTORY, "notes", "*.musicxml")))
+# end def
+
+
+def bench_jitter(seconds: float = 5.) -> Dict[str, Any]:
+    # Scheduling lateness of play mode for the first seconds of each bundled score, played to the loopback backend
+    from midi_test import MidiTestPlay
+
+    results = dict()
+    print(f"Play scheduling lateness (first {seconds:.0f} s of each score):")
+    for musicxml_file in _scores():
+        backend = LoopbackBackend(1)
+        Midi.set_backend(backend)
+        with contextlib.redirect_stdout(io.StringIO()):  # Device list etc.
+            play = MidiTestPlay(backend.output_device_id(0), musicxml_file, use_cache=False, parser="stream",
+                                end_time=seconds)
+            stats = play.run()
+        # end with
+
+        name = os.path.basename(musicxml_file)
+        results[name] = _summary(stats)
+        print(f"  {name:<48} {stats}")
+    # end for
+
+    return results
+# end def
+
+
+def bench_parse(n_repeat: int = 2) -> Dict[str, Any]:
+    # Time needed to parse and compile each bundled score, with both parsers (music21 caches the parsed files itself,
+    # so its best time is usually the one of a cached parse)
+    from midi_test import MidiTestPlay
+    from score import CompiledScore
+
+    results = dict()
+    print(f"Parse time (best of {n_repeat}):")
+    for musicxml_file in _scores():
+        name = os.path.basename(musicxml_file)
+        results[name] = dict()
+        for parser in ("music21", "stream"):
+            seconds = min(timeit.repeat(lambda: CompiledScore.from_score(MidiTestPlay.parse_score(musicxml_file, parser)),
+                                        number=1, repeat=n_repeat))
+            results[name][f"{parser}_s"] = seconds
+        # end for
+        print(f"  {name:<48} music21 {results[name]['music21_s']:7.3f} s   stream {results[name]['stream_s']:7.3f} s")
+    # end for
+
+    return results
+# end def
+
+
+def _flatten(results: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    values = dict()
+    for key, value in results.items():
+        if isinstance(value, dict):
+            values.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[prefix + key] = float(value)
+        # end if
+    # end for
+
+    return values
+# end def
+
+
+def compare(previous: Dict[str, Any], current: Dict[str, Any]) -> None:
+    # Prints the change of each value measured in both runs
+    print(f"Changes since {previous.get('commit', '?')} ({previous.get('date', '?')}):")
+    previous_values = _flatten(previous["results"])
+    for key, value in _flatten(current["results"]).items():
+        if key in previous_values:
+            change = (value / previous_values[key] - 1.) * 100. if previous_values[key] != 0 else 0.
+            print(f"  {key:<70} {previous_values[key]:12.3f} -> {value:12.3f} ({change:+6.1f} %)")
+        # end if
+    # end for
+# end def
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=_DIRECTORY).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    # end try
+# end def
+
+
+def main():
+    # Benchmarks of the MIDI event path, the thru and play modes (using the loopback backend) and the parsers
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_events", type=int, required=False, default=1000, help="Number of events per read.")
+    parser.add_argument("--n_repeat", type=int, required=False, default=200, help="Number of repetitions.")
+    parser.add_argument("--bench", type=str, required=False, default="all",
+                        choices=["all", "events", "startup", "thru", "throughput", "jitter", "parse"],
+                        help="Benchmark to run.")
+    parser.add_argument("--json", type=str, required=False, default=None,
+                        help="Save the results to this JSON file, e.g. to compare them with the ones of another commit.")
+    parser.add_argument("--compare", type=str, required=False, default=None,
+                        help="Print the changes compared to the results saved in this JSON file.")
+    args = parser.parse_args()
+
+    results = dict()
+    if args.bench in ("all", "events"):
+        results["events"] = bench_events(args.n_events, args.n_repeat)
+    if args.bench in ("all", "startup"):
+        results["startup"] = bench_startup()
+    if args.bench in ("all", "thru"):
+        results["thru"] = bench_thru()
+    if args.bench in ("all", "throughput"):
+        results["throughput"] = bench_throughput()
+    if args.bench in ("all", "jitter"):
+        results["jitter"] = bench_jitter()
+    if args.bench in ("all", "parse"):
+        results["parse"] = bench_parse()
+
+    report = {"commit": _commit(), "date": datetime.datetime.now().isoformat(timespec="seconds"),
+              "python": platform.python_version(), "platform": platform.platform(), "results": results}
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        # end with
+    # end if
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+        # end with
+    # end if
+
+    # A mode importing a heavy module it doesn't need is a regression
+    ok = all(len(mode["forbidden_imports"]) == 0 for mode in results.get("startup", dict()).values())
+    sys.exit(0 if ok else 1)
+# end def
+
+
+if __name__ == "__main__":
+    main()
+# end if
@@ -0,0 +1,336 @@
+from __future__ import annotations
+import os
+import struct
+import threading
+import time
+from typing import TYPE_CHECKING, Optional, Sequence
+
+from midi import EventQueue, Midi, MidiEvent, OverflowPolicy, Subscription
+
+if TYPE_CHECKING:
+    from score import CompiledScore
+# end if
+
+# Number of data bytes of the channel messages (by upper nibble of the status byte)
+_N_DATA_BYTES = {0x80: 2, 0x90: 2, 0xa0: 2, 0xb0: 2, 0xc0: 1, 0xd0: 1, 0xe0: 2}
+
+
+def var_len(value: int) -> bytes:
+    # Variable-length quantity as used for delta times and meta event lengths
+    data = bytearray([value & 0x7f])
+    value >>= 7
+    while value > 0:
+        data.insert(0, 0x80 | value & 0x7f)
+        value >>= 7
+    # end while
+
+    return bytes(data)
+# end def
+
+
+def tempo_event(qpm: float) -> bytes:
+    # Set tempo meta event (without delta time)
+    return b"\xff\x51\x03" + struct.pack(">I", int(round(60e6 / qpm)))[1:]
+# end def
+
+
+class MidiFileWriter:
+    # Writes a single-track Standard MIDI File (format 0) incrementally: the events are collected in a buffer, which
+    # gets written to the file in chunks, so the memory usage is constant no matter how long the track gets. The
+    # track's length is only known at the end and gets patched into the track header by close(). A file that didn't
+    # get closed (e.g. after a crash) can be repaired using recover().
+    _HEADER = struct.Struct(">4sIHHH")
+    _TRACK_HEADER = struct.Struct(">4sI")
+    _END_OF_TRACK = b"\xff\x2f\x00"
+
+    def __init__(self, path: str, ticks_per_quarter: int = 480, chunk_size: int = 64 * 1024) -> None:
+        self._path = path
+        self._chunk_size = chunk_size
+        self._file = open(path, "wb")
+        self._buffer = bytearray()
+        self._track_length = 0
+        self._closed = False
+
+        self._file.write(self._HEADER.pack(b"MThd", 6, 0, 1, ticks_per_quarter))
+        self._file.write(self._TRACK_HEADER.pack(b"MTrk", 0))  # Length gets patched by close()
+    # end def
+
+    def __enter__(self) -> "MidiFileWriter":
+        return self
+    # end def
+
+    def __exit__(self, *args) -> None:
+        self.close()
+    # end def
+
+    @property
+    def path(self) -> str:
+        return self._path
+    # end def
+
+    def write_event(self, delta_ticks: int, event: bytes) -> None:
+        # event: MIDI message or meta event (without delta time)
+        self._buffer += var_len(max(delta_ticks, 0))
+        self._buffer += event
+        if len(self._buffer) >= self._chunk_size:
+            self.flush()
+        # end if
+    # end def
+
+    def write_message(self, delta_ticks: int, status: int, data1: int = 0, data2: int = 0) -> None:
+        # Only channel messages, system messages (e.g. SysEx or real-time messages) are skipped
+        n_data_bytes = _N_DATA_BYTES.get(status & 0xf0)
+        if n_data_bytes is None:
+            return
+        # end if
+
+        self.write_event(delta_ticks, bytes((status, data1, data2)[:1 + n_data_bytes]))
+    # end def
+
+    def flush(self) -> None:
+        # Only complete events get written, so recover() can cut a file after the last complete chunk
+        self._file.write(self._buffer)
+        self._file.flush()
+        self._track_length += len(self._buffer)
+        self._buffer.clear()
+    # end def
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        # end if
+
+        self.write_event(0, self._END_OF_TRACK)
+        self.flush()
+        self._file.seek(self._HEADER.size)
+        self._file.write(self._TRACK_HEADER.pack(b"MTrk", self._track_length))
+        self._file.close()
+        self._closed = True
+    # end def
+
+    @classmethod
+    def recover(cls, path: str) -> int:
+        # Repairs a file that didn't get closed: cuts off an incomplete event at the end, appends the end of track and
+        # sets the track length. Returns the number of events recovered.
+        with open(path, "r+b") as f:
+            data = f.read()
+            header = cls._HEADER.size
+            if data[:4] != b"MThd" or data[header:header + 4] != b"MTrk":
+                raise ValueError(f"{path} is not a MIDI file written by MidiFileWriter.")
+            # end if
+
+            start = position = header + cls._TRACK_HEADER.size
+            n_events = 0
+            end_of_track = False
+            while not end_of_track:
+                event_end = cls._parse_event(data, position)
+                if event_end is None:
+                    break
+                # end if
+                end_of_track = data[event_end - 3:event_end] == cls._END_OF_TRACK
+                position = event_end
+                n_events += 1
+            # end while
+
+            f.seek(position)
+            f.truncate()
+            if not end_of_track:
+                f.write(b"\x00" + cls._END_OF_TRACK)
+                position += 1 + len(cls._END_OF_TRACK)
+            # end if
+            f.seek(header)
+            f.write(cls._TRACK_HEADER.pack(b"MTrk", position - start))
+        # end with
+
+        return n_events
+    # end def
+
+    @staticmethod
+    def _parse_event(data: bytes, position: int) -> Optional[int]:
+        # Returns the end of the event starting at position or None if it is incomplete
+        for _ in range(4):  # Delta time
+            if position >= len(data):
+                return None
+            # end if
+            position += 1
+            if data[position - 1] < 0x80:
+                break
+            # end if
+        # end for
+
+        if position >= len(data):
+            return None
+        # end if
+        status = data[position]
+        if status == 0xff:  # Meta event: type, length, data
+            if position + 2 >= len(data):
+                return None
+            # end if
+            length = 0
+            position += 2
+            while position < len(data):
+                length = length << 7 | data[position] & 0x7f
+                position += 1
+                if data[position - 1] < 0x80:
+                    break
+                # end if
+            # end while
+            end = position + length
+        elif status & 0xf0 in _N_DATA_BYTES:
+            end = position + 1 + _N_DATA_BYTES[status & 0xf0]
+        else:
+            return None
+        # end if
+
+        return end if end <= len(data) else None
+    # end def
+# end class
+
+
+class MidiRecorder:
+    # Records the events of one or more Midi inputs into a Standard MIDI File. The events are taken from a
+    # subscription queue by a background thread, which encodes them and writes them in chunks (at least every
+    # flush_interval seconds), so neither the reader thread nor the memory usage depends on the disk.
+    # The delta times are derived from the PortMidi timestamps: with 500 ticks per quarter at 120 bpm, a tick is 1 ms.
+    _TICKS_PER_QUARTER = 500
+    _QPM = 120.
+
+    def __init__(self, path: str, flush_interval: float = 1., capacity: int = 65536) -> None:
+        self._writer = MidiFileWriter(path, self._TICKS_PER_QUARTER)
+        self._writer.write_event(0, tempo_event(self._QPM))
+        self._flush_interval = flush_interval
+        self._subscription = Subscription(None, capacity, OverflowPolicy.DROP_OLDEST)
+        self._last_timestamp = None
+        self._n_events = 0
+        self._stopped = False
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    # end def
+
+    @property
+    def path(self) -> str:
+        return self._writer.path
+    # end def
+
+    @property
+    def n_events(self) -> int:
+        return self._n_events
+    # end def
+
+    @property
+    def queue(self) -> EventQueue:
+        return self._subscription.queue
+    # end def
+
+    def attach(self, midi: Midi) -> None:
+        # Records the input of midi
+        midi.add_subscription(self._subscription)
+    # end def
+
+    def _write(self, events: Sequence[MidiEvent]) -> None:
+        for event in events:
+            if event.status >= 0xf0:  # System messages aren't recorded
+                continue
+            # end if
+
+            # Inputs deliver their events in separate batches, so the timestamps might be slightly out of order
+            delta = 0 if self._last_timestamp is None else max(event.timestamp - self._last_timestamp, 0)
+            self._last_timestamp = max(event.timestamp, self._last_timestamp or 0)
+            self._writer.write_message(delta, event.status, event.data1, event.data2)
+            self._n_events += 1
+        # end for
+    # end def
+
+    def _run(self) -> None:
+        queue = self._subscription.queue
+        next_flush_time = time.monotonic() + self._flush_interval
+        while not self._stopped and not queue.closed:
+            self._write(queue.get_batch(timeout=self._flush_interval))
+            if time.monotonic() >= next_flush_time:
+                self._writer.flush()
+                next_flush_time = time.monotonic() + self._flush_interval
+            # end if
+        # end while
+    # end def
+
+    def close(self) -> None:
+        # Writes the remaining events and finalizes the file
+        self._stopped = True
+        self._subscription.stop()
+        self._thread.join()
+        self._write(self._subscription.queue.get_batch(timeout=0))
+        self._writer.close()
+    # end def
+# end class
+
+
+def write_score(path: str, compiled_score: CompiledScore, default_qpm: float = 120., ticks_per_quarter: int = 480) -> int:
+    # Writes the toggles of a compiled score as a Standard MIDI File (format 0), including its tempo changes and a
+    # program change whenever a channel's program changes. The file is written under a temporary name and renamed
+    # when complete, so an interrupted conversion never leaves a truncated file behind. Returns the number of notes.
+    from score import STATE_OFF
+
+    toggles = compiled_score.toggles
+    tempos = compiled_score.tempos
+
+    # (tick, order, event): at the same tick tempo changes come first, then program changes, then the notes (in the
+    # order of the toggles, i.e. offs before ons)
+    events = [(int(round(offset * ticks_per_quarter)), 0, tempo_event(qpm))
+              for offset, qpm in zip(tempos["offset"].tolist(), tempos["qpm"].tolist())]
+    if len(tempos) == 0 or tempos["offset"][0] > 0:
+        events.insert(0, (0, 0, tempo_event(default_qpm)))
+    # end if
+
+    programs = dict()  # channel -> program
+    for offset, state, pitch, velocity, channel, program in zip(toggles["time"].tolist(), toggles["state"].tolist(),
+                                                                toggles["pitch"].tolist(), toggles["velocity"].tolist(),
+                                                                toggles["channel"].tolist(), toggles["program"].tolist()):
+        tick = int(round(offset * ticks_per_quarter))
+        channel = max(channel, 0)
+        if state == STATE_OFF:
+            events.append((tick, 2, bytes((0x80 | channel, pitch, 0))))
+        else:
+            if program >= 0 and programs.get(channel) != program:
+                programs[channel] = program
+                events.append((tick, 1, bytes((0xc0 | channel, program))))
+            # end if
+            events.append((tick, 2, bytes((0x90 | channel, pitch, min(max(int(velocity * 127), 1), 127)))))
+        # end if
+    # end for
+    events.sort(key=lambda e: e[:2])  # Stable, so the toggles keep their order
+
+    temp_path = path + ".part"
+    try:
+        with MidiFileWriter(temp_path, ticks_per_quarter) as writer:
+            last_tick = 0
+            for tick, _, event in events:
+                writer.write_event(tick - last_tick, event)
+                last_tick = tick
+            # end for
+        # end with
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        # end if
+        raise
+    # end try
+
+    return len(toggles) // 2
+# end def
+
+
+def main():
+    # Repairs MIDI files of recordings that didn't get closed properly (e.g. after a crash)
+    import sys
+
+    for path in sys.argv[1:]:
+        print(f"{path}: {MidiFileWriter.recover(path)} events recovered")
+    # end for
+# end def
+
+
+if __name__ == "__main__":
+    main()
+# end if
@@ -0,0 +1,117 @@
+from typing import List, Optional, Sequence
+
+from midi import LatencyStats
+
+
+class PracticeStats:
+    def __init__(self) -> None:
+        self.n_expected = 0
+        self.n_correct = 0
+        self.n_wrong = 0  # Played notes that aren't expected (within the tolerance)
+        self.n_missed = 0  # Expected notes that weren't played (within the tolerance)
+        self.deviations = LatencyStats()  # Played minus expected time of the correct notes in s (> 0: late)
+    # end def
+
+    def __repr__(self) -> str:
+        return f"PracticeStats(n_expected={self.n_expected}, n_correct={self.n_correct}, n_wrong={self.n_wrong}, " \
+               f"n_missed={self.n_missed}, mean_deviation={self.deviations.mean * 1e3:+.1f} ms, " \
+               f"mean_abs_deviation={self.mean_abs_deviation * 1e3:.1f} ms)"
+    # end def
+
+    def __str__(self) -> str:
+        return repr(self)
+    # end def
+
+    @property
+    def mean_abs_deviation(self) -> float:
+        deviations = self.deviations.latencies
+
+        return sum(abs(d) for d in deviations) / len(deviations) if len(deviations) > 0 else 0.
+    # end def
+# end class
+
+
+class ScoreMatcher:
+    # Matches played notes against the expected notes of a score. The expected notes are indexed by pitch (the notes of
+    # each pitch in the order of time) with a cursor per pitch, which only moves forward, so matching a played note
+    # costs amortized O(1) no matter how long the score is: it matches the first open note of its pitch within
+    # +-tolerance of its time, otherwise it is a wrong note. expire() slides the window along the score and reports the
+    # notes it has passed without a match as missed. The times of the played notes need to be in ascending order.
+
+    def __init__(self, times: Sequence[float], pitches: Sequence[int], tolerance: float = 0.15) -> None:
+        # times (in s, sorted) and pitches of the expected note-ons
+        self._times = list(times)
+        self._pitches = list(pitches)
+        self._tolerance = tolerance
+        # --
+        self._by_pitch = [list() for _ in range(128)]  # pitch -> indices of its notes
+        for index, pitch in enumerate(self._pitches):
+            self._by_pitch[pitch].append(index)
+        # end for
+        self._cursors = [0] * 128  # pitch -> first of its notes that might still be matched
+        self._matched = bytearray(len(self._times))
+        self._expire_cursor = 0  # The notes before it are either matched or missed
+        self._stats = PracticeStats()
+        self._stats.n_expected = len(self._times)
+    # end def
+
+    @property
+    def stats(self) -> PracticeStats:
+        return self._stats
+    # end def
+
+    @property
+    def times(self) -> List[float]:
+        return self._times
+    # end def
+
+    @property
+    def pitches(self) -> List[int]:
+        return self._pitches
+    # end def
+
+    @property
+    def done(self) -> bool:
+        # All expected notes are either matched or missed
+        return self._expire_cursor >= len(self._times)
+    # end def
+
+    def match(self, pitch: int, time: float) -> Optional[int]:
+        # Returns the index of the expected note matched by a note played at time (in s), None for a wrong note
+        indices = self._by_pitch[pitch]
+        cursor = self._cursors[pitch]
+        earliest = time - self._tolerance
+        while cursor < len(indices) and (self._matched[indices[cursor]] or indices[cursor] < self._expire_cursor
+                                         or self._times[indices[cursor]] < earliest):
+            cursor += 1
+        # end while
+        self._cursors[pitch] = cursor
+
+        if cursor < len(indices) and self._times[indices[cursor]] <= time + self._tolerance:
+            index = indices[cursor]
+            self._matched[index] = 1
+            self._cursors[pitch] = cursor + 1
+            self._stats.n_correct += 1
+            self._stats.deviations.add(time - self._times[index])
+            return index
+        # end if
+
+        self._stats.n_wrong += 1
+
+        return None
+    # end def
+
+    def expire(self, time: float) -> List[int]:
+        # Returns the indices of the expected notes, which can't be matched anymore at time (in s)
+        missed = list()
+        while self._expire_cursor < len(self._times) and self._times[self._expire_cursor] < time - self._tolerance:
+            if not self._matched[self._expire_cursor]:
+                missed.append(self._expire_cursor)
+            # end if
+            self._expire_cursor += 1
+        # end while
+        self._stats.n_missed += len(missed)
+
+        return missed
+    # end def
+# end class
@@ -0,0 +1,293 @@
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from midi import EventBatch, MessageType, Midi
+from midi_trace import Histogram
+
+# Short names of the message types used in route specifications (see parse_transforms)
+MESSAGE_TYPE_NAMES = {"note": (MessageType.NOTE_ON, MessageType.NOTE_OFF),
+                      "aftertouch": (MessageType.POLY_AFTERTOUCH, MessageType.CHANNEL_AFTERTOUCH),
+                      "cc": (MessageType.CONTROL_CHANGE,),
+                      "program": (MessageType.PROGRAM_CHANGE,),
+                      "pitchbend": (MessageType.PITCH_BEND,)}
+
+
+class RouteTables:
+    # Lookup tables a route's transforms get compiled into: output status byte for each input status byte, output key
+    # for each input key (note and poly aftertouch messages) and output velocity for each input velocity (note-ons).
+    # -1 drops the message.
+
+    def __init__(self) -> None:
+        # Only channel messages are routed, system messages can't be forwarded message by message (e.g. SysEx)
+        self.status = [status if 0x80 <= status < 0xf0 else -1 for status in range(256)]
+        self.key = list(range(128))
+        self.velocity = list(range(128))
+    # end def
+# end class
+
+
+class Transform:
+    # Base class of all transforms. A transform changes the lookup tables once when the route gets compiled, there is
+    # no code executed per message.
+
+    def compile(self, tables: RouteTables) -> None:
+        raise NotImplementedError()
+    # end def
+# end class
+
+
+class ChannelMap(Transform):
+    def __init__(self, mapping: Dict[int, int]) -> None:
+        # mapping: input channel -> output channel (0-based), channels not in the mapping are kept
+        self._mapping = mapping
+    # end def
+
+    def __repr__(self) -> str:
+        return f"ChannelMap({self._mapping})"
+    # end def
+
+    def compile(self, tables: RouteTables) -> None:
+        tables.status = [status if status < 0 or status >= 0xf0 else
+                         status & 0xf0 | self._mapping.get(status & 0x0f, status & 0x0f) for status in tables.status]
+    # end def
+# end class
+
+
+class Transpose(Transform):
+    def __init__(self, semitones: int) -> None:
+        self._semitones = semitones
+    # end def
+
+    def __repr__(self) -> str:
+        return f"Transpose({self._semitones})"
+    # end def
+
+    def compile(self, tables: RouteTables) -> None:
+        # Keys moved out of the range get dropped
+        tables.key = [key + self._semitones if key >= 0 and 0 <= key + self._semitones < 128 else -1 for key in tables.key]
+    # end def
+# end class
+
+
+class KeyRange(Transform):
+    # Split point: only keys between lowest and highest (inclusive, before any later transpose) pass
+    def __init__(self, lowest: int = 0, highest: int = 127) -> None:
+        self._lowest = lowest
+        self._highest = highest
+    # end def
+
+    def __repr__(self) -> str:
+        return f"KeyRange({self._lowest}, {self._highest})"
+    # end def
+
+    def compile(self, tables: RouteTables) -> None:
+        tables.key = [key if self._lowest <= key <= self._highest else -1 for key in tables.key]
+    # end def
+# end class
+
+
+class VelocityCurve(Transform):
+    # velocity' = 127 * (velocity / 127) ** gamma * scale (gamma < 1 is more sensitive, > 1 less sensitive), a note-on
+    # never becomes a note-off
+    def __init__(self, gamma: float = 1., scale: float = 1.) -> None:
+        self._gamma = gamma
+        self._scale = scale
+    # end def
+
+    def __repr__(self) -> str:
+        return f"VelocityCurve(gamma={self._gamma}, scale={self._scale})"
+    # end def
+
+    def compile(self, tables: RouteTables) -> None:
+        tables.velocity = [0 if velocity == 0 else
+                           min(max(int(round(127. * (velocity / 127.) ** self._gamma * self._scale)), 1), 127)
+                           for velocity in tables.velocity]
+    # end def
+# end class
+
+
+class MessageTypes(Transform):
+    # Only the given message types pass
+    def __init__(self, message_types: Iterable[MessageType]) -> None:
+        self._message_types = set(message_types)
+    # end def
+
+    def __repr__(self) -> str:
+        return f"MessageTypes({sorted(t.name for t in self._message_types)})"
+    # end def
+
+    def compile(self, tables: RouteTables) -> None:
+        tables.status = [status if status >= 0 and status & 0xf0 in self._message_types else -1 for status in tables.status]
+    # end def
+# end class
+
+
+class RouteStats:
+    def __init__(self) -> None:
+        self.n_messages = 0  # Messages received
+        self.n_sent = 0
+        self.n_dropped = 0
+        self.max_input_latency = 0  # Largest time between a message's timestamp and its forwarding (in ms)
+        self.processing_time = Histogram("processing time")  # Time needed to forward a batch (in s, fixed size)
+    # end def
+
+    def __repr__(self) -> str:
+        return f"RouteStats(n_messages={self.n_messages}, n_sent={self.n_sent}, n_dropped={self.n_dropped}, " \
+               f"max_input_latency={self.max_input_latency} ms, processing_time={self.processing_time})"
+    # end def
+
+    def __str__(self) -> str:
+        return repr(self)
+    # end def
+# end class
+
+
+class Route:
+    # Connects an input to an output, passing the messages through the route's transforms, which are compiled once
+    # into lookup tables. Forwarding runs in the reader thread of the input and doesn't create any objects per message.
+
+    def __init__(self, output: Midi, transforms: Sequence[Transform] = (), name: Optional[str] = None) -> None:
+        self._output = output
+        self._transforms = list(transforms)
+        self._name = name
+        self._stats = RouteStats()
+
+        tables = RouteTables()
+        for transform in self._transforms:
+            transform.compile(tables)
+        # end for
+        self._status_table = tables.status
+        self._key_table = tables.key
+        self._velocity_table = tables.velocity
+    # end def
+
+    def __repr__(self) -> str:
+        return f"Route(name={self._name}, output={self._output.output_device_name}, transforms={self._transforms})"
+    # end def
+
+    def __str__(self) -> str:
+        return repr(self)
+    # end def
+
+    @property
+    def name(self) -> Optional[str]:
+        return self._name
+    # end def
+
+    @property
+    def stats(self) -> RouteStats:
+        return self._stats
+    # end def
+
+    def forward(self, batch: EventBatch) -> None:
+        start_time = time.perf_counter()
+        status_table = self._status_table
+        key_table = self._key_table
+        velocity_table = self._velocity_table
+        write_short = self._output.write_short
+        n_sent = 0
+
+        for status, data1, data2, _ in batch:
+            status = status_table[status]
+            if status < 0:
+                continue
+            # end if
+
+            kind = status & 0xf0
+            if kind <= 0xa0:  # Note-off, note-on, poly aftertouch
+                data1 = key_table[data1]
+                if data1 < 0:
+                    continue
+                # end if
+                if kind == 0x90:
+                    data2 = velocity_table[data2]
+                # end if
+            # end if
+
+            write_short(status, data1, data2)
+            n_sent += 1
+        # end for
+
+        stats = self._stats
+        stats.n_messages += len(batch)
+        stats.n_sent += n_sent
+        stats.n_dropped += len(batch) - n_sent
+        stats.max_input_latency = max(stats.max_input_latency, Midi.time() - batch.timestamp[0])
+        stats.processing_time.add(time.perf_counter() - start_time)
+    # end def
+# end class
+
+
+class Router:
+    # Connects N inputs to M outputs. Each input can have several routes, each output can be fed by several routes.
+
+    def __init__(self) -> None:
+        self._routes = dict()  # input Midi -> [Route]
+    # end def
+
+    @property
+    def routes(self) -> List[Tuple[Midi, Route]]:
+        return [(midi_input, route) for midi_input, routes in self._routes.items() for route in routes]
+    # end def
+
+    def add_route(self, midi_input: Midi, route: Route) -> Route:
+        routes = self._routes.get(midi_input)
+        if routes is None:
+            routes = self._routes[midi_input] = list()
+            midi_input.cb_batch = lambda batch: self._forward(routes, batch)
+        # end if
+        routes.append(route)
+
+        return route
+    # end def
+
+    @staticmethod
+    def _forward(routes: List[Route], batch: EventBatch) -> None:
+        for route in routes:
+            route.forward(batch)
+        # end for
+    # end def
+# end class
+
+
+def parse_transforms(spec: str) -> List[Transform]:
+    # Comma separated transforms, e.g. "keys=0-59,transpose=12,channel=0:1,velocity=0.7,types=note+cc":
+    # * keys=LOWEST-HIGHEST: split point
+    # * transpose=SEMITONES
+    # * channel=OUT or channel=IN:OUT: all channels or one channel (0-based)
+    # * velocity=GAMMA or velocity=GAMMA*SCALE: velocity curve
+    # * types=TYPE+TYPE+...: message types passed (note, aftertouch, cc, program, pitchbend)
+    transforms = list()
+    for item in filter(None, (item.strip() for item in spec.split(","))):
+        name, _, value = item.partition("=")
+        if name == "keys":
+            lowest, _, highest = value.partition("-")
+            transforms.append(KeyRange(int(lowest), int(highest)))
+        elif name == "transpose":
+            transforms.append(Transpose(int(value)))
+        elif name == "channel":
+            if ":" in value:
+                src, _, dst = value.partition(":")
+                transforms.append(ChannelMap({int(src): int(dst)}))
+            else:
+                transforms.append(ChannelMap({channel: int(value) for channel in range(16)}))
+            # end if
+        elif name == "velocity":
+            gamma, _, scale = value.partition("*")
+            transforms.append(VelocityCurve(float(gamma), float(scale) if scale != "" else 1.))
+        elif name == "types":
+            type_names = value.split("+")
+            for type_name in type_names:
+                if type_name not in MESSAGE_TYPE_NAMES:
+                    raise ValueError(f"Unknown message type \"{type_name}\" in \"{item}\" "
+                                     f"(known types: {', '.join(MESSAGE_TYPE_NAMES)}).")
+                # end if
+            # end for
+            transforms.append(MessageTypes(t for type_name in type_names for t in MESSAGE_TYPE_NAMES[type_name]))
+        else:
+            raise ValueError(f"Unknown transform \"{item}\".")
+        # end if
+    # end for
+
+    return transforms
+# end def
@@ -0,0 +1,149 @@
+import bisect
+import threading
+import time
+from typing import Callable, Iterator, Optional, Sequence
+
+from midi import LatencyStats
+from midi_trace import EventTrace, Instrumentation
+
+
+class SchedulerStats(LatencyStats):
+    # Lateness (time between an event's deadline and its actual dispatch) of each event
+    pass
+# end class
+
+
+class Scheduler:
+    # Dispatches events at precomputed deadlines (in seconds, relative to the start of the playback).
+    # The event times need to be sorted. Instead of polling in fixed intervals, the scheduler sleeps until shortly
+    # before the next deadline and spins for the remaining time to hit the deadline as precisely as possible.
+
+    def __init__(self, spin_time: float = 0.002, clock: Callable[[], float] = time.perf_counter,
+                 instrumentation: Optional[Instrumentation] = None) -> None:
+        self._spin_time = spin_time
+        self._clock = clock
+        self._instrumentation = instrumentation  # Opt-in, see midi_trace
+        self._stop_event = threading.Event()
+        self._stats = SchedulerStats()
+    # end def
+
+    @property
+    def stats(self) -> SchedulerStats:
+        return self._stats
+    # end def
+
+    def stop(self) -> None:
+        self._stop_event.set()
+    # end def
+
+    def _record(self, index: int, lateness: float) -> None:
+        # The index of the event is recorded in the data bytes of the trace. The histograms only take durations, an
+        # event dispatched in advance (negative lateness) is recorded with its lead time.
+        if lateness >= 0.:
+            self._instrumentation.scheduler_lateness.add(lateness)
+        else:
+            self._instrumentation.dispatch_lead.add(-lateness)
+        # end if
+        self._instrumentation.trace.record(EventTrace.SCHEDULED, 0, (index >> 7) & 0x7f, index & 0x7f, lateness)
+    # end def
+
+    def _wait_until(self, deadline: float) -> bool:
+        # Sleep until shortly before the deadline (interruptible by stop())
+        remaining = deadline - self._clock()
+        if remaining > self._spin_time:
+            if self._stop_event.wait(remaining - self._spin_time):
+                return False
+            # end if
+        # end if
+
+        # Spin for the rest of the time
+        while self._clock() < deadline:
+            pass
+        # end while
+
+        return not self._stop_event.is_set()
+    # end def
+
+    def _events(self, times: Sequence[float], cb_event: Callable[[int], None],
+                start_time: Optional[float]) -> Iterator[float]:
+        # The dispatching of run(): yields each deadline to wait for, the events due by then are handled when it gets
+        # resumed. The waiting is left to the caller (see AsyncScheduler).
+        self._stop_event.clear()
+        self._stats = SchedulerStats()
+
+        start_time = self._clock() if start_time is None else start_time
+        n_events = len(times)
+        cursor = 0
+
+        while cursor < n_events:
+            yield start_time + times[cursor]
+
+            # Handle all events that are due by now (e.g. all notes of a chord)
+            td = self._clock() - start_time
+            while cursor < n_events and times[cursor] <= td:
+                lateness = self._clock() - start_time - times[cursor]
+                self._stats.add(lateness)
+                if self._instrumentation is not None:
+                    self._record(cursor, lateness)
+                # end if
+                cb_event(cursor)
+                cursor += 1
+            # end while
+        # end while
+    # end def
+
+    def _batches(self, times: Sequence[float], cb_batch: Callable[[int, int], None], window: float,
+                 start_time: Optional[float]) -> Iterator[float]:
+        # The dispatching of run_batched(), see _events()
+        self._stop_event.clear()
+        self._stats = SchedulerStats()
+
+        start_time = self._clock() if start_time is None else start_time
+        n_events = len(times)
+        cursor = 0
+        td = -window
+
+        while cursor < n_events:
+            # Wake up when the next event enters the window, but at most every half window, so the events are
+            # dispatched in large batches (each one at least half a window in advance)
+            yield start_time + max(times[cursor] - window, td + window / 2.)
+
+            td = self._clock() - start_time
+            end = max(bisect.bisect_right(times, td + window, cursor), cursor + 1)
+            for index in range(cursor, end):
+                self._stats.add(td - times[index])
+                if self._instrumentation is not None:
+                    self._record(index, td - times[index])
+                # end if
+            # end for
+
+            cb_batch(cursor, end)
+            cursor = end
+        # end while
+    # end def
+
+    def run(self, times: Sequence[float], cb_event: Callable[[int], None], start_time: Optional[float] = None) -> SchedulerStats:
+        # Calls cb_event with the index of each event as soon as its deadline is reached
+        for deadline in self._events(times, cb_event, start_time):
+            if not self._wait_until(deadline):
+                break
+            # end if
+        # end for
+
+        return self._stats
+    # end def
+
+    def run_batched(self, times: Sequence[float], cb_batch: Callable[[int, int], None], window: float,
+                    start_time: Optional[float] = None) -> SchedulerStats:
+        # Calls cb_batch with the index range [begin, end) of all events, whose deadline lies within the next window
+        # seconds, e.g. to send them in advance to an output that does the precise timing itself. The lateness is
+        # recorded relative to the events' deadlines, so it is negative for events that are dispatched in advance.
+        for deadline in self._batches(times, cb_batch, window, start_time):
+            if not self._wait_until(deadline):
+                break
+            # end if
+        # end for
+
+        return self._stats
+    # end def
+# end class
@@ -0,0 +1,194 @@
+import collections
+from typing import Any, List, Sequence, Tuple
+
+# A timestamped message as used by pygame.midi.Output.write: [[status, data1, data2], timestamp in ms]
+TimedMessage = Tuple[List[int], int]
+
+
+class ShaperStats:
+    def __init__(self) -> None:
+        self.n_messages = 0
+        self.n_bytes = 0
+        self.n_running_status = 0  # Number of messages sent without status byte
+        self.n_delayed = 0  # Number of messages sent after their timestamp
+        self.max_delay = 0.  # In ms
+        self.max_queue_length = 0  # Maximum number of messages waiting for the link at the same time
+    # end def
+
+    def __repr__(self) -> str:
+        return f"ShaperStats(n_messages={self.n_messages}, n_bytes={self.n_bytes}, " \
+               f"n_running_status={self.n_running_status}, n_delayed={self.n_delayed}, " \
+               f"max_delay={self.max_delay:.3f} ms, max_queue_length={self.max_queue_length})"
+    # end def
+
+    def __str__(self) -> str:
+        return repr(self)
+    # end def
+# end class
+
+
+class OutputShaper:
+    # Output stage for slow MIDI links (e.g. a 31.25 kbaud DIN cable, which carries 3125 bytes/s, i.e. about 1000
+    # three-byte messages per second). Sits in front of an output, which accepts timestamped messages (e.g. Midi or
+    # pygame.midi.Output opened with a latency > 0), and
+    # * sorts messages with the same timestamp in a defined order: note-offs first, then controllers/program changes,
+    #   then note-ons, each grouped by status byte (ascending by key within a group), so running status applies,
+    #   if the link uses it (PortMidi and the drivers send every status byte, and USB-MIDI never uses running status,
+    #   so it is only assumed with running_status=True, e.g. for a DIN interface known to strip repeated status bytes),
+    # * optionally sends note-offs as note-ons with velocity 0, so they share the status byte with the note-ons,
+    # * spreads bursts deterministically by moving timestamps back until the link has capacity for the message.
+    # The link state is kept between calls, so consecutive batches need to be in ascending order of time.
+
+    BANDWIDTH_DIN = 3125.  # bytes/s
+
+    def __init__(self, output: Any, bandwidth: float = BANDWIDTH_DIN, running_status: bool = False,
+                 note_off_as_note_on: bool = True) -> None:
+        self._output = output
+        self._bandwidth = bandwidth / 1000.  # bytes/ms
+        self._running_status = running_status
+        self._note_off_as_note_on = note_off_as_note_on
+        # --
+        self._status = None  # Current running status
+        self._link_free_time = None  # Time in ms at which the link is free again
+        self._send_end_times = collections.deque()  # End times of the messages still on the link (ascending)
+        self._stats = ShaperStats()
+    # end def
+
+    @property
+    def stats(self) -> ShaperStats:
+        return self._stats
+    # end def
+
+    def reset(self) -> None:
+        self._status = None
+        self._link_free_time = None
+        self._send_end_times = collections.deque()
+        self._stats = ShaperStats()
+    # end def
+
+    @staticmethod
+    def _priority(message: List[int]) -> int:
+        kind = message[0] & 0xf0
+        if kind == 0x80 or kind == 0x90 and len(message) > 2 and message[2] == 0:  # Note-off
+            return 0
+        elif kind == 0x90:  # Note-on
+            return 2
+        else:
+            return 1
+        # end if
+    # end def
+
+    def _n_bytes(self, message: List[int]) -> int:
+        status = message[0]
+        n_data_bytes = 1 if status & 0xf0 in (0xc0, 0xd0) else 2
+
+        if status >= 0xf8:  # Real-time messages don't affect the running status
+            return 1
+        elif status >= 0xf0:  # System messages cancel the running status
+            self._status = None
+            return len(message)
+        elif self._running_status and status == self._status:
+            self._stats.n_running_status += 1
+            return n_data_bytes
+        # end if
+
+        self._status = status
+
+        return 1 + n_data_bytes
+    # end def
+
+    def shape(self, messages: Sequence[TimedMessage]) -> List[TimedMessage]:
+        # Returns the messages reordered and with timestamps adjusted to the bandwidth of the link
+        if self._note_off_as_note_on:
+            messages = [([0x90 | (m[0] & 0x0f), m[1], 0] if m[0] & 0xf0 == 0x80 else m, t) for m, t in messages]
+        # end if
+
+        messages = sorted(messages, key=lambda mt: (mt[1], self._priority(mt[0]), mt[0][0], mt[0][1:]))
+
+        shaped = list()
+        for message, timestamp in messages:
+            n_bytes = self._n_bytes(message)
+
+            start = timestamp if self._link_free_time is None else max(timestamp, self._link_free_time)
+            self._link_free_time = start + n_bytes / self._bandwidth
+
+            # Number of messages still on the link when this one is due
+            while len(self._send_end_times) > 0 and self._send_end_times[0] <= timestamp:
+                self._send_end_times.popleft()
+            # end while
+            queue_length = len(self._send_end_times)
+            self._send_end_times.append(self._link_free_time)
+
+            self._stats.n_messages += 1
+            self._stats.n_bytes += n_bytes
+            self._stats.max_queue_length = max(self._stats.max_queue_length, queue_length)
+            if start > timestamp:
+                self._stats.n_delayed += 1
+                self._stats.max_delay = max(self._stats.max_delay, start - timestamp)
+            # end if
+
+            shaped.append((message, int(start)))
+        # end for
+
+        return shaped
+    # end def
+
+    def write(self, messages: Sequence[TimedMessage]) -> None:
+        self._output.write([[message, timestamp] for message, timestamp in self.shape(messages)])
+    # end def
+# end class
+
+
+class MemoryOutput:
+    # In-memory output with the interface of pygame.midi.Output.write, which records all messages, e.g. to check the
+    # byte throughput of an OutputShaper.
+
+    def __init__(self) -> None:
+        self._messages = list()
+    # end def
+
+    @property
+    def messages(self) -> List[TimedMessage]:
+        return self._messages
+    # end def
+
+    def write(self, messages: Sequence[TimedMessage]) -> None:
+        timestamp = self._messages[-1][1] if len(self._messages) > 0 else None
+        for message, t in messages:
+            if timestamp is not None and t < timestamp:
+                raise ValueError("Timestamps need to be in ascending order.")
+            # end if
+            timestamp = t
+            self._messages.append((list(message), t))
+        # end for
+    # end def
+
+    def max_byte_rate(self, window: int = 100, running_status: bool = False) -> float:
+        # Maximum number of bytes per second within any time window of the given length (in ms)
+        n_bytes = list()
+        status = None
+        for message, _ in self._messages:
+            if running_status and message[0] == status:
+                n_bytes.append(len(message) - 1)
+            else:
+                n_bytes.append(len(message))
+                status = message[0] if message[0] < 0xf0 else None
+            # end if
+        # end for
+
+        timestamps = [t for _, t in self._messages]
+        max_bytes = 0
+        begin = 0
+        window_bytes = 0
+        for end, t in enumerate(timestamps):
+            window_bytes += n_bytes[end]
+            while timestamps[begin] <= t - window:
+                window_bytes -= n_bytes[begin]
+                begin += 1
+            # end while
+            max_bytes = max(max_bytes, window_bytes)
+        # end for
+
+        return max_bytes * 1000. / window
+    # end def
+# end class
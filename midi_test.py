@@ -1,20 +1,29 @@
 #!/usr/bin/env python
 
 from __future__ import annotations
-from typing import List, Optional
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
 import os
 os.environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "1"  # noqa # Suppresses pygame console output
-import tkinter as tk
 import argparse
 import datetime
-import pandas as pd
-import music21 as m21
+import math
 import time
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import IntEnum
 import signal
-
-from midi import Midi, MidiDeviceType, MidiEvent
+import sys
+
+from midi import MessageFilter, MessageType, Midi, MidiDeviceInfo, MidiDeviceType, MidiEvent, OverflowPolicy
+from midi_scheduler import Scheduler, SchedulerStats
+from midi_shaper import OutputShaper
+from midi_trace import Instrumentation
+
+# Heavy dependencies (numpy, pandas, music21, tkinter) are imported by the modes that need them, so each mode starts
+# as fast as possible (see midi_bench.py --startup)
+if TYPE_CHECKING:
+    import numpy as np
+    from score import CompiledScore, Score
+# end if
 
 signal.signal(signal.SIGINT, signal.SIG_DFL)
 
@@ -23,72 +32,73 @@ class MidiTestBase:
     _notes = ["c", "c#", "d", "d#", "e", "f", "f#", "g", "g#", "a", "a#", "h"]
 
     @staticmethod
-    def _choose_input_device(input_device_id: Optional[int]):
-        # List all available MIDI input devices for the user
-        print("Available MIDI input devices")
-        device_ids = list()
-        for device in Midi.get_midi_devices(MidiDeviceType.INPUT):
+    def _choose_device(device_type: MidiDeviceType, device_id: Optional[int], device_name: Optional[str]) -> int:
+        label = "input" if device_type == MidiDeviceType.INPUT else "output"
+
+        # A device given by name (or a part of it) doesn't need to be confirmed
+        if device_name is not None:
+            device = Midi.find_device(device_name, device_type)
+            if device is not None:
+                print(f"Using {label} device [{device.device_id}] \"{device.name}\"")
+                return device.device_id
+            # end if
+            print(f"There is no {label} device named \"{device_name}\".")
+        # end if
+
+        # List all available MIDI devices for the user
+        print(f"Available MIDI {label} devices")
+        devices = Midi.get_midi_devices(device_type)
+        for device in devices:
             print(f"* [{device.device_id}] \"{device.name}\" (interface: \"{device.interface}\")")
-            device_ids.append(device.device_id)
         # end for
+        print("")
 
-        # Let the user choose which device to use
-        if input_device_id is None:
-            device_id_str = ""
-            while True:
-                try:
-                    device_id_str = input("Select input device id: ")
-                    device_id = int(device_id_str)
-
-                    if device_id in device_ids:
-                        input_device_id = device_id
-                        break
-                    # end if
-
-                    print(f"{device_id} is not in the list of device-IDs.")
-                except ValueError:
-                    print(f"\"{device_id_str}\" is not a valid number.")
-                    continue
-                # end try
-            # end while
-        # end if
+        # Let the user choose which device to use (by id or by name)
+        device_ids = [device.device_id for device in devices]
+        while device_id is None:
+            device_str = input(f"Select {label} device id or name: ").strip()
+            try:
+                if int(device_str) in device_ids:
+                    device_id = int(device_str)
+                else:
+                    print(f"{device_str} is not in the list of device-IDs.")
+                # end if
+            except ValueError:
+                device = Midi.find_device(device_str, device_type) if device_str != "" else None
+                if device is not None:
+                    device_id = device.device_id
+                else:
+                    print(f"\"{device_str}\" is neither a valid number nor the name of a device.")
+                # end if
+            # end try
+        # end while
 
-        return input_device_id
+        return device_id
     # end def
 
     @staticmethod
-    def _choose_output_device(output_device_id: Optional[int]):
-        # List all available MIDI output devices for the user
-        print("Available MIDI output devices")
-        device_ids = list()
-        for device in Midi.get_midi_devices(MidiDeviceType.OUTPUT):
-            print(f"* [{device.device_id}] \"{device.name}\" (interface: \"{device.interface}\")")
-            device_ids.append(device.device_id)
-        # end for
-
-        # Let the user choose which device to use
-        print("")
-        if output_device_id is None:
-            device_id_str = ""
-            while True:
-                try:
-                    device_id_str = input("Select output device id: ")
-                    device_id = int(device_id_str)
-
-                    if device_id in device_ids:
-                        output_device_id = device_id
-                        break
-                    # end if
+    def _device_id(device_ref: str, device_type: MidiDeviceType) -> int:
+        # By id or by name
+        if device_ref.strip().isdigit():
+            return int(device_ref)
+        # end if
 
-                    print(f"{device_id} is not in the list of device-IDs.")
-                except ValueError:
-                    print(f"\"{device_id_str}\" is not a valid number.")
-                    continue
-                # end try
-            # end while
+        device = Midi.find_device(device_ref.strip(), device_type)
+        if device is None:
+            raise ValueError(f"There is no MIDI device named \"{device_ref}\".")
         # end if
 
-        return output_device_id
+        return device.device_id
+    # end def
+
+    @staticmethod
+    def _choose_input_device(input_device_id: Optional[int], input_device_name: Optional[str] = None) -> int:
+        return MidiTestBase._choose_device(MidiDeviceType.INPUT, input_device_id, input_device_name)
+    # end def
+
+    @staticmethod
+    def _choose_output_device(output_device_id: Optional[int], output_device_name: Optional[str] = None) -> int:
+        return MidiTestBase._choose_device(MidiDeviceType.OUTPUT, output_device_id, output_device_name)
     # end def
 # end class
 
@@ -110,79 +120,557 @@ class MidiTestPlay(MidiTestBase):
     # end class
 
     @dataclass
-    class NoteToggle:
-        time: float
-        state: MidiTestPlay.NoteState
-        pitch: int
-        velocity: float
-        channel: int
-        instrument: int
-        instrument_name: str
+    class OutputRoute:
+        # Sends the parts whose instrument name contains name (case-insensitive) or the given channels to an output
+        name: Optional[str]
+        channels: Optional[List[int]]
+        output: int  # Index of the output
+    # end class
+
+    @dataclass
+    class Playback:
+        # The prepared playback loop: chase, events and release of all outputs. The delay compensation might move
+        # steps beyond the end of the loop, these are played in the following passes (at the same absolute time), so
+        # they don't delay the start of the next pass. If the playback gets interrupted, cb_release turns off all notes
+        # of the loop.
+        times: List[float]  # Of each step, relative to the start of the pass it is played in (sorted)
+        laps: List[int]  # Number of passes each step is played after the one it belongs to
+        length: float  # Of the loop in s
+        repeat: int  # Number of passes, 0 means endless
+        cb_event: Optional[Callable[[int], None]]  # Immediate output of a step
+        cb_batch: Optional[Callable[[List[int]], None]]  # Timestamped output of some steps (latency > 0)
+        window: float  # Lookahead of cb_batch in s
+        outputs: List[Any]
+        cb_release: Callable[[], float]  # Returns the time in s until the release is sent
+        _passes: Dict[Tuple[int, int], Tuple[List[float], List[int]]] = field(default_factory=dict, repr=False)
+
+        @property
+        def n_passes(self) -> int:
+            # Including the passes only playing the steps moved beyond the last loop (0: endless)
+            return self.repeat + max(self.laps + [0]) if self.repeat > 0 else 0
+        # end def
+
+        def pass_steps(self, n: int) -> Tuple[List[float], List[int]]:
+            # Times and indices of the steps played in the n-th pass: the ones of the loops n - lap that get played
+            first_lap = max(n - self.repeat + 1, 0) if self.repeat > 0 else 0
+            key = (first_lap, min(n, max(self.laps + [0])))  # Range of the laps played
+            if key not in self._passes:
+                steps = [index for index, lap in enumerate(self.laps) if key[0] <= lap <= key[1]]
+                self._passes[key] = ([self.times[index] for index in steps], steps)
+            # end if
+
+            return self._passes[key]
+        # end def
     # end class
 
-    def __init__(self, output_device_id: int = None, musicxml_file: Optional[str] = None, bpm: int = 120) -> None:
-        self._output_device_id = self._choose_output_device(output_device_id)
+    # Needs to be increased whenever the compilation of the note list changes, as this invalidates the score cache
+    _PARSER_VERSION = 4
+
+    def __init__(self, output_device_id: int = None, musicxml_file: Optional[str] = None, bpm: int = 120,
+                 use_cache: bool = True, rebuild_cache: bool = False, parser: str = "music21",
+                 tempo_scale: float = 1., use_score_tempo: bool = True, latency: int = 0, lookahead: int = 100,
+                 bandwidth: float = 0., running_status: bool = False, output_device_name: Optional[str] = None,
+                 instrumentation: Optional[Instrumentation] = None, start_measure: Optional[int] = None,
+                 end_measure: Optional[int] = None, start_time: Optional[float] = None, end_time: Optional[float] = None,
+                 repeat: int = 1, routes: Optional[List[str]] = None) -> None:
+        # With routes, the default output is optional: the notes of the parts that aren't routed are dropped without it
+        self._output_device_id = None
+        if not routes or output_device_id is not None or output_device_name is not None:
+            self._output_device_id = self._choose_output_device(output_device_id, output_device_name)
+        # end if
         self._musicxml_file = musicxml_file
         self._bpm = bpm
+        self._tempo_scale = tempo_scale
+        self._use_score_tempo = use_score_tempo
+        self._latency = latency
+        self._lookahead = lookahead
+        self._bandwidth = bandwidth
+        self._running_status = running_status
+        self._use_cache = use_cache
+        self._rebuild_cache = rebuild_cache
+        self._parser = parser
+        self._start_measure = start_measure
+        self._end_measure = end_measure
+        self._start_time = start_time
+        self._end_time = end_time
+        self._repeat = repeat
         # --
-
-        # Initialize the MIDI interface
-        print(f"Initializing MIDI interface... ", end="")
-        self._midi = Midi(None, self._output_device_id, None)
+        self._midi_start_time = 0  # PortMidi time of the current pass (timestamped output)
+
+        # Initialize the MIDI interface: each output device is opened once, no matter how many routes use it, so all
+        # routes to a device share its handle and channel state. All outputs are driven by one scheduler.
+        print("Initializing MIDI interface... ", end="")
+        self._instrumentation = instrumentation
+        self._outputs = list()  # Midi
+        self._output_delays = list()  # Delay of each output in ms (e.g. of a software synth), compensated when playing
+        self._output_indices = dict()  # device id -> index of the output
+        self._midi = None  # Default output
+        if self._output_device_id is not None:
+            self._midi = self._outputs[self._open_output(self._output_device_id)]
+        # end if
+        self._routes = [self._parse_route(spec) for spec in routes or list()]
         print("Done")
     # end def
 
-    def print_note_list(self, note_list: List):
-        df = pd.DataFrame(
-            map(lambda n: (n.time, "on" if n.state == MidiTestPlay.NoteState.ON else "off", f"{n.pitch} ({self._notes[int(n.pitch % 12)].upper() + str(n.pitch // 12 - 1)})", n.velocity, n.instrument), note_list),
-            columns=["Time", "State", "Pitch (Note)", "Velocity", "Instrument"])
+    def _open_output(self, device_id: int, delay: float = 0.) -> int:
+        # Returns the index of the output. A device given several times gets the largest delay given for it.
+        if device_id not in self._output_indices:
+            self._output_indices[device_id] = len(self._outputs)
+            self._outputs.append(Midi(None, device_id, None, output_latency=self._latency, instrumentation=self._instrumentation))
+            self._output_delays.append(0.)
+        # end if
+        index = self._output_indices[device_id]
+        self._output_delays[index] = max(self._output_delays[index], delay)
+
+        return index
+    # end def
+
+    def _parse_route(self, spec: str) -> MidiTestPlay.OutputRoute:
+        # "PART|OUTPUT|DELAY": the part given by (a part of) its instrument name or as channel=CHANNEL[+CHANNEL...]
+        # (0-based), the output device by id or name and the delay of the device in ms (optional)
+        part, output_ref, delay = (spec.split("|") + [""])[:3]
+        part = part.strip()
+        output = self._open_output(self._device_id(output_ref, MidiDeviceType.OUTPUT), float(delay) if delay.strip() != "" else 0.)
+        if part.startswith("channel="):
+            return MidiTestPlay.OutputRoute(None, [int(channel) for channel in part[len("channel="):].split("+")], output)
+        # end if
+
+        return MidiTestPlay.OutputRoute(part.lower(), None, output)
+    # end def
+
+    def print_note_list(self, toggles: np.ndarray) -> None:
+        import numpy as np
+        import pandas as pd
+
+        pitch_names = np.array([f"{p} ({self._notes[p % 12].upper() + str(p // 12 - 1)})" for p in range(128)])
+        program = toggles["program"]
+        df = pd.DataFrame({"Time": toggles["time"],
+                           "State": np.where(toggles["state"] == MidiTestPlay.NoteState.ON, "on", "off"),
+                           "Pitch (Note)": pitch_names[toggles["pitch"]],
+                           "Velocity": toggles["velocity"],
+                           "Instrument": pd.arrays.IntegerArray(program.astype(np.int16), program < 0)})
         pd.set_option("display.max_rows", None, "display.max_columns", None)
         print(df)
     # end def
 
-    def run(self, show_note_list: bool = False):
-        if self._musicxml_file is not None:
-            xml_data = m21.converter.parse(self._musicxml_file)
-            xml_list = self._xml_to_list(xml_data)
-            xml_list.sort(key=lambda n: n.start)
+    @staticmethod
+    def parse_score(musicxml_file: str, parser: str = "music21") -> Score:
+        from score import Score
+
+        if parser == "stream":
+            from musicxml_reader import MusicXmlReader
+
+            reader = MusicXmlReader(musicxml_file)
+            notes = list(reader.notes())
+
+            return Score.from_notes(notes, reader.tempos, reader.measures)
+        # end if
+
+        import music21 as m21  # Only needed when the score is not in the cache
+
+        xml_data = m21.converter.parse(musicxml_file)
+
+        return Score.from_notes(((n.start, n.duration, n.pitch, n.velocity, n.channel, n.instrument, n.instrument_name)
+                                 for n in MidiTestPlay._xml_to_list(xml_data)),
+                                MidiTestPlay._xml_to_tempos(musicxml_file), MidiTestPlay._xml_to_measures(xml_data))
+    # end def
+
+    def _load_compiled_score(self) -> CompiledScore:
+        return self.load_compiled_score(self._musicxml_file, self._parser, self._use_cache, self._rebuild_cache)
+    # end def
+
+    @staticmethod
+    def load_compiled_score(musicxml_file: str, parser: str = "music21", use_cache: bool = True,
+                            rebuild_cache: bool = False) -> CompiledScore:
+        from score import CompiledScore
+        from score_cache import ScoreCache
+
+        if not use_cache:
+            return CompiledScore.from_score(MidiTestPlay.parse_score(musicxml_file, parser))
+        # end if
+
+        cache = ScoreCache(parser_version=f"{parser}:{MidiTestPlay._PARSER_VERSION}")
+        if not rebuild_cache:
+            compiled_score = cache.load(musicxml_file)
+            if compiled_score is not None:
+                return compiled_score
+            # end if
+        # end if
+
+        compiled_score = CompiledScore.from_score(MidiTestPlay.parse_score(musicxml_file, parser))
+        cache.store(musicxml_file, compiled_score)
+
+        return compiled_score
+    # end def
+
+    def _segment(self, compiled_score: CompiledScore, tempo_map) -> Tuple[float, Optional[float]]:
+        # Start and end offset (in quarter lengths) of the part to play, given by measure or by time (in s). An end of
+        # None plays until the end of the score.
+        import numpy as np
+
+        start = 0.
+        if self._start_measure is not None:
+            start = compiled_score.measure_offset(self._start_measure)
+        elif self._start_time is not None:
+            start = float(tempo_map.offsets(np.array([self._start_time]))[0])
+        # end if
+
+        end = None
+        if self._end_measure is not None:
+            end = compiled_score.measure_offset(self._end_measure, end=True)
+        elif self._end_time is not None:
+            end = float(tempo_map.offsets(np.array([self._end_time]))[0])
+        # end if
+
+        return start, end
+    # end def
+
+    def _route(self, compiled_score: CompiledScore) -> np.ndarray:
+        # Index of the output of each toggle (-1: not played), the first matching route wins
+        import numpy as np
+
+        toggles = compiled_score.toggles
+        default = 0 if self._midi is not None else -1
+        outputs = np.full(len(toggles), default, dtype=np.int16)
+        names = [name.lower() for name in compiled_score.instrument_names] + [""]  # Index -1: no instrument name
+        for route in reversed(self._routes):
+            if route.channels is not None:
+                matches = np.isin(toggles["channel"], route.channels)
+            else:
+                matches = np.array([route.name in name for name in names])[toggles["name"]]
+            # end if
+            outputs[matches] = route.output
+        # end for
+
+        return outputs
+    # end def
+
+    @staticmethod
+    def _sounding_outputs(toggles: np.ndarray, outputs: np.ndarray, index: int) -> Dict[Tuple[int, int], int]:
+        # Output of the notes sounding before index: the one of the last ON of each channel and pitch
+        import numpy as np
+
+        ons = toggles["state"][:index] == MidiTestPlay.NoteState.ON
+        keys = np.maximum(toggles["channel"][:index], 0).astype(np.int32)[ons] * 128 + toggles["pitch"][:index][ons]
+        keys, last = np.unique(keys[::-1], return_index=True)
+
+        return {(key // 128, key % 128): output for key, output in zip(keys.tolist(), outputs[:index][ons][::-1][last].tolist())}
+    # end def
+
+    def _prepare(self, show_note_list: bool = False) -> Optional[MidiTestPlay.Playback]:
+        if self._musicxml_file is None:
+            return None
+        # end if
+
+        import numpy as np
+
+        compiled_score = self._load_compiled_score()
+        toggles = compiled_score.toggles
+
+        if show_note_list:
+            self.print_note_list(toggles)
+
+        # Precompute the time of each event in seconds (taking the tempo changes into account) and all arguments for the
+        # MIDI output, so no arithmetic is left for the playback loop
+        tempo_map = compiled_score.tempo_map(self._bpm, self._tempo_scale, self._use_score_tempo)
+        times = tempo_map.seconds(toggles["time"]).tolist()
+        pitches = toggles["pitch"].tolist()
+        velocities = (toggles["velocity"] * 127).astype(int).tolist()
+        channels = np.maximum(toggles["channel"], 0).tolist()
+        instruments = [None if p < 0 else p for p in toggles["program"].tolist()]
+        offs = (toggles["state"] == MidiTestPlay.NoteState.OFF).tolist()
+        routed_outputs = self._route(compiled_score)
+
+        # The part to play [begin, end) is found by binary search. Starting mid-piece, the programs and the notes
+        # still sounding at that point are sent first (chase); at the end, the notes still sounding are released.
+        # Both are part of the loop, which gets built once and can be repeated (A-B loop) without any preparation.
+        start_offset, end_offset = self._segment(compiled_score, tempo_map)
+        begin, programs, sounding = compiled_score.seek(start_offset)
+        end, _, releasing = compiled_score.seek(end_offset) if end_offset is not None else (len(toggles), None, [])
+        start_second = float(tempo_map.seconds(np.array([start_offset]))[0])
+        end_second = float(tempo_map.seconds(np.array([end_offset]))[0]) if end_offset is not None else max(times[-1:] + [start_second])
+        length = end_second - start_second
+        repeat = self._repeat if length > 0 else 1
+
+        # The outputs are aligned to the slowest one: the events of the others are delayed by the difference
+        max_delay = max(self._output_delays + [0.])
+        compensations = [(max_delay - delay) / 1000. for delay in self._output_delays]
+
+        # The loop as steps (time, output, messages), sorted by time. Program changes are only inserted where a
+        # channel's program changes on an output. Each pass starts from the chased programs or else from the ones the
+        # output's channel state knows to be set (see Midi.channel_state), so a program already set is not resent.
+        entry_programs = dict()  # (output, channel) -> program at the start of each pass
+        sounding_outputs = self._sounding_outputs(toggles, routed_outputs, begin) if len(sounding) > 0 else dict()
+        segment_channels = np.maximum(toggles["channel"][begin:end], 0)
+        for output, midi in enumerate(self._outputs):
+            used_channels = set(np.unique(segment_channels[routed_outputs[begin:end] == output]).tolist())
+            used_channels.update(channel for channel, pitch, _ in sounding if sounding_outputs[channel, pitch] == output)
+            for channel in sorted(used_channels):
+                program = programs.get(channel, midi.channel_state.program(channel))
+                if program is not None:
+                    entry_programs[output, channel] = program
+                # end if
+            # end for
+        # end for
+        current_programs = dict(entry_programs)  # (output, channel) -> program
+        event_steps = list()
+        event_outputs = routed_outputs.tolist()
+        for index in range(begin, end):
+            output = event_outputs[index]
+            if output < 0:
+                continue
+            # end if
+            messages = [Midi.note_message(pitches[index], velocities[index], channels[index], offs[index])]
+            instrument = instruments[index]
+            if instrument is not None and current_programs.get((output, channels[index])) != instrument:
+                current_programs[output, channels[index]] = instrument
+                messages.insert(0, Midi.program_change_message(instrument, channels[index]))
+            # end if
+            event_steps.append((times[index] - start_second + compensations[output], output, messages))
+        # end for
+        # The chase sends the entry programs, unless the output has them already. Repeated, a program the loop changes
+        # has to be reset for the next pass.
+        steps = list()
+        for output, midi in enumerate(self._outputs):
+            messages = [Midi.program_change_message(program, channel) for (o, channel), program in entry_programs.items()
+                        if o == output and (midi.channel_state.program(channel) != program
+                                            or repeat != 1 and current_programs[o, channel] != program)]
+            messages += [Midi.note_message(pitch, int(velocity * 127), channel) for channel, pitch, velocity in sounding
+                         if sounding_outputs[channel, pitch] == output]
+            steps.append((compensations[output], output, messages))
+        # end for
+        steps += event_steps
+        releasing_outputs = self._sounding_outputs(toggles, routed_outputs, end) if len(releasing) > 0 else dict()
+        for output in range(len(self._outputs)):
+            steps.append((length + compensations[output], output,
+                          [Midi.note_message(pitch, 0, channel, off=True) for channel, pitch, _ in releasing
+                           if releasing_outputs[channel, pitch] == output]))
+        # end for
+        # Steps beyond the end of the loop are played in the following passes. At the same time, the steps of an
+        # earlier loop go first, e.g. the release of a loop before the chase of the next one.
+        laps = [int(math.ceil(step[0] / length)) - 1 if length > 0 and step[0] > length else 0 for step in steps]
+        steps = [(t - lap * length, lap, output, messages) for (t, output, messages), lap in zip(steps, laps)]
+        steps.sort(key=lambda step: (step[0], -step[1]))  # Stable, so the events keep their order
+        loop_times = [step[0] for step in steps]
+        laps = [step[1] for step in steps]
+        step_outputs = [step[2] for step in steps]
+        step_messages = [step[3] for step in steps]
+
+        # Note-offs of all notes the loop turns on, per output
+        loop_notes = sorted({(output, message[0] & 0x0f, message[1]) for output, messages in zip(step_outputs, step_messages)
+                             for message in messages if message[0] & 0xf0 == 0x90})
+        release_messages = [list() for _ in self._outputs]
+        for output, channel, pitch in loop_notes:
+            release_messages[output].append(Midi.note_message(pitch, 0, channel, off=True))
+        # end for
+
+        if self._latency > 0:
+            # PortMidi does the precise timing: queue the events of the lookahead window as timestamped batches. All
+            # outputs share the PortMidi clock, so their timestamps are comparable.
+            timestamps = [int(round(t * 1000.)) for t in loop_times]
+            last_timestamp = [0]  # Of the messages queued so far
+
+            # On slow links, bursts get spread according to the link's bandwidth
+            outputs = [OutputShaper(midi, self._bandwidth, self._running_status) if self._bandwidth > 0 else midi
+                       for midi in self._outputs]
+
+            def cb_batch(indices: List[int]) -> None:
+                batches = [list() for _ in outputs]
+                for index in indices:
+                    timestamp = self._midi_start_time + timestamps[index]
+                    batches[step_outputs[index]] += [[message, timestamp] for message in step_messages[index]]
+                    last_timestamp[0] = timestamp
+                # end for
+                for output, batch in zip(outputs, batches):
+                    if len(batch) > 0:
+                        output.write(batch)
+                    # end if
+                # end for
+            # end def
+
+            def cb_release() -> float:
+                # The release has to follow the messages already queued, which PortMidi sends in any case
+                timestamp = max(last_timestamp[0], Midi.time())
+                for output, messages in zip(outputs, release_messages):
+                    if len(messages) > 0:
+                        output.write([[message, timestamp] for message in messages])
+                    # end if
+                # end for
+                max_delay = max([output.stats.max_delay for output in outputs if isinstance(output, OutputShaper)] + [0.])
+
+                return max(timestamp + math.ceil(max_delay) + self._latency - Midi.time(), 0) / 1000.
+            # end def
 
-            note_list = list()
-            for item in xml_list:
-                note_list.append(MidiTestPlay.NoteToggle(item.start, MidiTestPlay.NoteState.ON, item.pitch, item.velocity, item.channel, item.instrument, item.instrument_name))
-                note_list.append(MidiTestPlay.NoteToggle(item.start + item.duration, MidiTestPlay.NoteState.OFF, item.pitch, item.velocity, item.channel, item.instrument, item.instrument_name))
+            return MidiTestPlay.Playback(loop_times, laps, length, repeat, None, cb_batch,
+                                         min(self._lookahead, self._latency) / 1000., outputs, cb_release)
+        # end if
+
+        outputs = self._outputs
+
+        def cb_event(index: int) -> None:
+            output = outputs[step_outputs[index]]
+            for message in step_messages[index]:
+                output.write_short(*message)
+            # end for
+        # end def
+
+        def cb_release() -> float:
+            for output, messages in zip(outputs, release_messages):
+                for message in messages:
+                    output.write_short(*message)
+                # end for
             # end for
 
-            note_list.sort(key=lambda n: (n.time, n.state == MidiTestPlay.NoteState.ON))
+            return 0.
+        # end def
+
+        return MidiTestPlay.Playback(loop_times, laps, length, repeat, cb_event, None, 0., outputs, cb_release)
+    # end def
+
+    def _pending_time(self, playback: MidiTestPlay.Playback, times: List[float]) -> float:
+        # Time in s until the last timestamped message queued at PortMidi is sent (0 for immediate output): it is due
+        # at its timestamp (moved back by the shaper, if the link was busy) + the latency. Takes the times of the
+        # last pass.
+        if playback.cb_batch is None or len(times) == 0:
+            return 0.
+        # end if
+
+        last_start_time = self._midi_start_time - int(round(playback.length * 1000.))  # Start of the last pass
+        max_delay = max([output.stats.max_delay for output in playback.outputs if isinstance(output, OutputShaper)] + [0.])
+        last_due = last_start_time + int(round(times[-1] * 1000.)) + math.ceil(max_delay) + self._latency
 
-            if show_note_list:
-                self.print_note_list(note_list)
+        return max(last_due - Midi.time(), 0) / 1000.
+    # end def
 
-            start_time = datetime.datetime.now()
+    def _finish(self, playback: MidiTestPlay.Playback, show_stats: bool) -> None:
+        if playback.cb_batch is not None:
+            for midi in self._outputs:
+                midi.invalidate_channel_state()  # The programs were sent as timestamped messages
+            # end for
+        # end if
+        if show_stats:
+            for midi, output in zip(self._outputs, playback.outputs):
+                if isinstance(output, OutputShaper):
+                    print(f"\"{midi.output_device_name}\": {output.stats}")
+                # end if
+            # end for
+        # end if
+    # end def
 
-            while True:
-                td = datetime.datetime.now() - start_time
-                td = td.seconds + td.microseconds / 1e6
+    def run(self, show_note_list: bool = False, show_stats: bool = False) -> Optional[SchedulerStats]:
+        # Returns the scheduling statistics of the last pass
+        playback = self._prepare(show_note_list)
+        if playback is None:
+            return None
+        # end if
 
-                # Handle all outstanding events
-                while len(note_list) > 0:
-                    note = note_list[0]
-                    if td >= float(note.time) / self._bpm * 60.:
-                        self._midi.play_note(note.pitch, int(note.velocity * 127), note.channel, instrument=note.instrument, off=note.state == MidiTestPlay.NoteState.OFF)
-                        del note_list[0]
+        scheduler = Scheduler(instrumentation=self._instrumentation)
+        start_time = time.perf_counter()
+        self._midi_start_time = Midi.time()
+        stats = None
+        times = list()
+        n = 0
+        # Ctrl+C ends the playback (e.g. an endless loop) with the release of the notes (the default handler would kill
+        # the process, leaving them hanging)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        try:
+            try:
+                while playback.repeat <= 0 or n < playback.n_passes:
+                    times, steps = playback.pass_steps(n)
+                    if playback.cb_batch is not None:
+                        stats = scheduler.run_batched(times, lambda begin, end: playback.cb_batch(steps[begin:end]),
+                                                      playback.window, start_time=start_time)
                     else:
-                        break
+                        stats = scheduler.run(times, lambda index: playback.cb_event(steps[index]), start_time=start_time)
+                    # end if
+                    start_time += playback.length
+                    self._midi_start_time += int(round(playback.length * 1000.))
+                    n += 1
+                    if show_stats:
+                        print(stats)
                     # end if
                 # end while
+                pending_time = self._pending_time(playback, times)
+            except KeyboardInterrupt:
+                scheduler.stop()
+                pending_time = playback.cb_release()
+            # end try
+            # Return only after all queued messages are sent, e.g. before the outputs get closed
+            time.sleep(pending_time)
+        finally:
+            self._finish(playback, show_stats)
+        # end try
+
+        return stats
+    # end def
 
-                # Leave when done
-                if len(note_list) == 0:
-                    break
-                # end if
+    async def run_async(self, show_note_list: bool = False, show_stats: bool = False) -> Optional[SchedulerStats]:
+        # Same as run(), but waits for the deadlines on the running asyncio event loop instead of blocking a thread, so
+        # several playbacks and inputs can share one loop (see midi_async)
+        import asyncio
 
-                # Polling
-                time.sleep(0.01)  # 10 ms
-            # end while
+        from midi_async import AsyncScheduler
+
+        playback = self._prepare(show_note_list)
+        if playback is None:
+            return None
         # end if
+
+        scheduler = AsyncScheduler(instrumentation=self._instrumentation)
+        start_time = time.perf_counter()
+        self._midi_start_time = Midi.time()
+        stats = None
+        times = list()
+        n = 0
+        try:
+            try:
+                while playback.repeat <= 0 or n < playback.n_passes:
+                    times, steps = playback.pass_steps(n)
+                    if playback.cb_batch is not None:
+                        stats = await scheduler.run_batched(times, lambda begin, end: playback.cb_batch(steps[begin:end]),
+                                                            playback.window, start_time=start_time)
+                    else:
+                        stats = await scheduler.run(times, lambda index: playback.cb_event(steps[index]), start_time=start_time)
+                    # end if
+                    start_time += playback.length
+                    self._midi_start_time += int(round(playback.length * 1000.))
+                    n += 1
+                    if show_stats:
+                        print(stats)
+                    # end if
+                # end while
+            except asyncio.CancelledError:
+                # Cancelled, e.g. by asyncio.run() on Ctrl+C: the notes get released before passing on the cancellation
+                scheduler.stop()
+                await asyncio.sleep(playback.cb_release())
+                raise
+            # end try
+            # Return only after all queued messages are sent, e.g. before the outputs get closed
+            await asyncio.sleep(self._pending_time(playback, times))
+        finally:
+            self._finish(playback, show_stats)
+        # end try
+
+        return stats
+    # end def
+
+    @staticmethod
+    def _xml_to_tempos(musicxml_file: str) -> List[Tuple[float, float]]:
+        # music21 ignores <sound tempo="...">, which defines the playback tempo (e.g. a tempo change without a
+        # metronome mark), so the tempo marks are read the same way as by the streaming parser
+        from musicxml_reader import MusicXmlReader
+
+        return [(float(offset), qpm) for offset, qpm in MusicXmlReader.read_tempos(musicxml_file)]
+    # end def
+
+    @staticmethod
+    def _xml_to_measures(xml_data) -> List[Tuple[float, Optional[int]]]:
+        # Offset and number of the measures of the first part
+        if len(xml_data.parts) == 0:
+            return list()
+        # end if
+
+        return [(float(measure.offset), measure.number) for measure in xml_data.parts[0].getElementsByClass("Measure")]
     # end def
 
     @staticmethod
@@ -206,6 +694,12 @@ class MidiTestPlay(MidiTestBase):
                         velocity = note.volume.realized
                         xml_list.append(MidiTestPlay.Note(start, duration, pitch, velocity, channel, instrument, instrument_name))
 
+                elif not hasattr(note, "pitch"):  # Unpitched percussion: the instrument defines the key to be played
+                    pitch = getattr(part.getInstrument(), "percMapPitch", None)
+                    if pitch is not None:
+                        xml_list.append(MidiTestPlay.Note(note.offset, note.quarterLength, pitch, note.volume.realized, channel, instrument, instrument_name))
+                    # end if
+
                 else:
                     start = note.offset
                     duration = note.quarterLength
@@ -221,17 +715,26 @@ class MidiTestPlay(MidiTestBase):
 
 
 class MidiTestShow(MidiTestBase):
-    def __init__(self, input_device_id: int = None, output_device_id: int = None, use_computer_keyboard: bool = False) -> None:
+    _FRAME_RATE = 60  # Frames per second
+
+    def __init__(self, input_device_id: int = None, output_device_id: int = None, use_computer_keyboard: bool = False,
+                 input_device_name: Optional[str] = None, output_device_name: Optional[str] = None,
+                 instrumentation: Optional[Instrumentation] = None, record_file: Optional[str] = None,
+                 print_events: bool = False) -> None:
         super().__init__()
-        self._input_device_id = self._choose_input_device(input_device_id)
-        self._output_device_id = self._choose_output_device(output_device_id)
+        self._input_device_id = self._choose_input_device(input_device_id, input_device_name)
+        self._output_device_id = self._choose_output_device(output_device_id, output_device_name)
         self._use_computer_keyboard = use_computer_keyboard
+        self._print_events = print_events
         self._octave = 5
         self._velocity = 127
-        self._start_time = datetime.datetime.now()
         # --
+        self._recorder = None
         self._root = None
-        self._label = None
+        self._piano_roll = None
+        self._frame_stats = None
+        self._frame_interval = 1. / self._FRAME_RATE
+        self._next_frame_time = None
         self._computer_keyboard_keys = ("a", "w", "s", "e", "d", "f", "t", "g", "z", "h", "u", "j", "k")
         self._key_mapping = {key: k for k, key in enumerate(self._computer_keyboard_keys)}
         self._currently_pressed_keys = list()
@@ -240,23 +743,67 @@ class MidiTestShow(MidiTestBase):
             print("Using computer keyboard.")
 
         # Initialize the MIDI interface
-        print(f"Initializing MIDI interface... ", end="")
-        self._midi = Midi(self._input_device_id, self._output_device_id, self._cb_event)
+        print("Initializing MIDI interface... ", end="")
+        # Only notes are of interest (keyboards also send e.g. active sensing messages continuously). The notes are
+        # played directly in the reader thread, the GUI drains its queue on the Tk thread once per frame.
+        self._midi = Midi(self._input_device_id, self._output_device_id, self._cb_event,
+                          message_filter=MessageFilter(accept=(MessageType.NOTE_ON, MessageType.NOTE_OFF)),
+                          instrumentation=instrumentation)
+        self._events = self._midi.subscribe(None, policy=OverflowPolicy.DROP_OLDEST).queue
         print("Done")
+
+        if record_file is not None:
+            from midi_file import MidiRecorder
+            self._recorder = MidiRecorder(record_file)
+            self._recorder.attach(self._midi)
+        # end if
     # end def
 
     def _cb_event(self, event: MidiEvent) -> None:
-        print(event)
-        self._label["text"] = self._notes[event.data1 % 12].upper()
         if self._output_device_id is not None:
-            self._midi.play_note(event.data1, event.data2)
+            self._midi.play_note(event.data1, event.data2, event.status & 0x0f,
+                                 off=event.status & 0xf0 == MessageType.NOTE_OFF)
+        # end if
     # end def
 
-    def _get_time_since_start(self) -> int:
-        dt = datetime.datetime.now() - self._start_time
-        diff = int(dt.seconds * 1000 + dt.microseconds / 1000)
+    def _cb_frame(self) -> None:
+        # Runs on the Tk thread: draws all events since the last frame at once
+        events = self._events.get_batch(timeout=0)
+        for event in events:
+            if self._print_events:
+                print(event)
+            # end if
+            if event.status & 0xf0 == MessageType.NOTE_OFF:
+                self._piano_roll.note_off(event.data1)
+            else:
+                self._piano_roll.note_on(event.data1, event.data2)
+            # end if
+        # end for
 
-        return diff
+        now = time.perf_counter()
+        self._piano_roll.redraw(now)
+
+        self._frame_stats.n_frames += 1
+        self._frame_stats.n_events += len(events)
+        self._frame_stats.n_coalesced += max(len(events) - 1, 0)
+
+        # Keep the frame rate (without drift); if the frame came late, skip the frames that were missed
+        self._next_frame_time += self._frame_interval
+        if now > self._next_frame_time:
+            n_missed = int((now - self._next_frame_time) / self._frame_interval) + 1
+            self._frame_stats.n_dropped += n_missed
+            self._next_frame_time += n_missed * self._frame_interval
+        # end if
+        self._root.after(max(int((self._next_frame_time - now) * 1000.), 1), self._cb_frame)
+    # end def
+
+    def _key_event(self, event: MidiEvent) -> None:
+        # Computer keyboard events are played right away and drawn (and recorded) like all other events
+        self._cb_event(event)
+        self._events.put_batch([event])
+        if self._recorder is not None:
+            self._recorder.queue.put_batch([event])
+        # end if
     # end def
 
     def _cb_key_press(self, event):
@@ -276,57 +823,246 @@ class MidiTestShow(MidiTestBase):
             # Prevent automatic repetition of the key_press-event by the keyboard driver
             if event.char not in self._currently_pressed_keys:
                 self._currently_pressed_keys.append(event.char)
-                self._cb_event(MidiEvent(0, self._octave * 12 + self._key_mapping[event.char],
-                                         self._velocity, 0, self._get_time_since_start(), -1))
+                self._key_event(MidiEvent(MessageType.NOTE_ON, self._octave * 12 + self._key_mapping[event.char],
+                                          self._velocity, 0, Midi.time(), -1))
             # end if
         # end if
     # end def
 
     def _cb_key_release(self, event):
-        # Switch key off by settings its velocity to 0
         if event.char in self._computer_keyboard_keys:
             self._currently_pressed_keys.remove(event.char)
-            self._cb_event(MidiEvent(0, self._octave * 12 + self._key_mapping[event.char],
-                                     0, 0, self._get_time_since_start(), -1))
+            self._key_event(MidiEvent(MessageType.NOTE_OFF, self._octave * 12 + self._key_mapping[event.char],
+                                      0, 0, Midi.time(), -1))
         # end if
     # end def
 
-    def run(self) -> None:
-        # GUI
-        self._root = tk.Tk()
-        self._root.title("Press a key on the keyboard to show its note in the window")
-        self._root.geometry("500x500")  # Width x height
+    def run(self, show_stats: bool = False) -> None:
+        import tkinter as tk
+        from piano_roll import FrameStats, PianoRoll
+
+        self._midi.collect_stats = show_stats
+        # Ctrl+C in the terminal closes the window (the default handler would kill the process, leaving the recording
+        # unfinished)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        try:
+            try:
+                # GUI
+                self._root = tk.Tk()
+                self._root.title("Press a key on the keyboard to show its note in the window")
+
+                self._piano_roll = PianoRoll(self._root)
+                self._piano_roll.pack(padx=20, pady=20)
+
+                if self._use_computer_keyboard:
+                    self._root.bind_all("<KeyPress>", self._cb_key_press)
+                    self._root.bind_all("<KeyRelease>", self._cb_key_release)
+                # end if
 
-        self._label = tk.Label(self._root, text="", font=("Arial", 250, ""))  # Create a text label
-        self._label.pack(padx=20, pady=20)  # Pack it into the window
+                self._frame_stats = FrameStats()
+                self._next_frame_time = time.perf_counter()
+                self._root.after(0, self._cb_frame)
+                self._root.mainloop()
+            except KeyboardInterrupt:
+                if self._root is not None:
+                    self._root.destroy()
+                # end if
+            # end try
+        finally:
+            # The window got closed, the recording is finalized in any case, so it is a valid file
+            self._midi.stop()
+            if self._recorder is not None:
+                self._recorder.close()
+                print(f"Recorded {self._recorder.n_events} events to {self._recorder.path}")
+            # end if
+        # end try
 
-        if self._use_computer_keyboard:
-            self._root.bind_all("<KeyPress>", self._cb_key_press)
-            self._root.bind_all("<KeyRelease>", self._cb_key_release)
+        if show_stats:
+            print(self._midi.input_stats)
+            print(self._frame_stats)
+            print(f"Events dropped by the GUI queue: {self._events.n_dropped}")
+        # end if
+    # end def
+# end class
+
+
+class MidiTestPractice(MidiTestBase):
+    # Compares the notes played on the input with the notes of a score and reports correct, wrong and missed notes and
+    # the timing deviation live. The score starts with the first note played. The reader thread only forwards the
+    # notes to the output; matching (see midi_practice.ScoreMatcher) and printing are done by the main thread, which
+    # takes the events from a queue and uses their PortMidi timestamps, so its own delays don't affect the timing.
+    _POLL_INTERVAL = 0.02  # Interval (in s) of checking for missed notes while no notes are played
+
+    def __init__(self, input_device_id: int = None, output_device_id: int = None, musicxml_file: Optional[str] = None,
+                 bpm: int = 120, tempo_scale: float = 1., use_score_tempo: bool = True, parser: str = "music21",
+                 use_cache: bool = True, rebuild_cache: bool = False, tolerance: int = 150, part: Optional[str] = None,
+                 input_device_name: Optional[str] = None, output_device_name: Optional[str] = None,
+                 instrumentation: Optional[Instrumentation] = None) -> None:
+        from midi_practice import ScoreMatcher
+        import numpy as np
+
+        super().__init__()
+        self._input_device_id = self._choose_input_device(input_device_id, input_device_name)
+        # The output is optional (a keyboard usually sounds itself)
+        self._output_device_id = None
+        if output_device_id is not None or output_device_name is not None:
+            self._output_device_id = self._choose_output_device(output_device_id, output_device_name)
+        # end if
+
+        # The expected notes: the note-ons of the part (given by a part of its instrument name) with their time in s.
+        # Notes with the same pitch at the same time (e.g. doubled by two voices) are only expected once.
+        compiled_score = MidiTestPlay.load_compiled_score(musicxml_file, parser, use_cache, rebuild_cache)
+        toggles = compiled_score.toggles
+        ons = toggles[toggles["state"] == MidiTestPlay.NoteState.ON]
+        if part is not None:
+            names = [part.lower() in name.lower() for name in compiled_score.instrument_names] + [False]
+            ons = ons[np.array(names)[ons["name"]]]
+        # end if
+        times = compiled_score.tempo_map(bpm, tempo_scale, use_score_tempo).seconds(ons["time"])
+        notes = np.unique(np.rec.fromarrays([times, ons["pitch"]], names="time,pitch"))  # Sorted by time and pitch
+        self._matcher = ScoreMatcher(notes["time"].tolist(), notes["pitch"].tolist(), tolerance / 1000.)
+        self._origin = None  # PortMidi time (in ms) of the start of the score
+
+        # Initialize the MIDI interface
+        print("Initializing MIDI interface... ", end="")
+        self._midi = Midi(self._input_device_id, self._output_device_id, self._cb_event,
+                          message_filter=MessageFilter(accept=(MessageType.NOTE_ON, MessageType.NOTE_OFF)),
+                          instrumentation=instrumentation)
+        self._events = self._midi.subscribe(None, policy=OverflowPolicy.DROP_OLDEST).queue  # The reader never waits
+        print("Done")
+    # end def
+
+    def _cb_event(self, event: MidiEvent) -> None:
+        if self._output_device_id is not None:
+            self._midi.play_note(event.data1, event.data2, event.status & 0x0f,
+                                 off=event.status & 0xf0 == MessageType.NOTE_OFF)
         # end if
+    # end def
 
-        self._root.mainloop()
+    def _note_name(self, pitch: int) -> str:
+        return f"{self._notes[pitch % 12].upper() + str(pitch // 12 - 1):<3} ({pitch:3d})"
+    # end def
+
+    def _process(self, events: List[MidiEvent]) -> None:
+        matcher = self._matcher
+        for event in events:
+            if event.status & 0xf0 != MessageType.NOTE_ON:
+                continue
+            # end if
+
+            if self._origin is None:
+                self._origin = event.timestamp - int(round(matcher.times[0] * 1000.)) if len(matcher.times) > 0 else event.timestamp
+            # end if
+            played = (event.timestamp - self._origin) / 1000.
+
+            # Notes the window has passed before this one are reported first
+            self._print_missed(matcher.expire(played))
+            index = matcher.match(event.data1, played)
+            if index is not None:
+                print(f"{played:8.3f} s  ok      {self._note_name(event.data1)}  {(played - matcher.times[index]) * 1e3:+5.0f} ms")
+            else:
+                print(f"{played:8.3f} s  wrong   {self._note_name(event.data1)}")
+            # end if
+        # end for
+    # end def
+
+    def _print_missed(self, indices: List[int]) -> None:
+        for index in indices:
+            print(f"{self._matcher.times[index]:8.3f} s  missed  {self._note_name(self._matcher.pitches[index])}")
+        # end for
+    # end def
+
+    def run(self, show_stats: bool = False) -> None:
+        self._midi.collect_stats = show_stats
+        print(f"{len(self._matcher.times)} notes expected, start playing (the score starts with the first note)...")
+        signal.signal(signal.SIGINT, signal.default_int_handler)  # Ctrl+C ends the practice early (with the summary)
+        try:
+            while not self._matcher.done:
+                self._process(self._events.get_batch(timeout=self._POLL_INTERVAL))
+                if self._origin is not None:
+                    self._print_missed(self._matcher.expire((Midi.time() - self._origin) / 1000.))
+                # end if
+            # end while
+        except KeyboardInterrupt:
+            pass
+        # end try
+
+        self._midi.stop()
+        print(self._matcher.stats)
+        if show_stats:
+            print(self._midi.input_stats)
+            print(f"Events dropped by the queue: {self._events.n_dropped}")
+        # end if
     # end def
 # end class
 
 
 class MidiTestThru(MidiTestBase):
-    def __init__(self, input_device_id: int = None, output_device_id: int = None) -> None:
+    def __init__(self, input_device_id: int = None, output_device_id: int = None,
+                 input_device_name: Optional[str] = None, output_device_name: Optional[str] = None,
+                 rescan_interval: float = 0., routes: Optional[List[str]] = None,
+                 instrumentation: Optional[Instrumentation] = None, record_file: Optional[str] = None,
+                 print_events: bool = False) -> None:
+        from midi_router import Route, Router, parse_transforms
+
         super().__init__()
-        self._input_device_id = self._choose_input_device(input_device_id)
-        self._output_device_id = self._choose_output_device(output_device_id)
+        self._instrumentation = instrumentation
+        self._print_events = print_events
+        self._recorder = None
+        if record_file is not None:
+            from midi_file import MidiRecorder
+            self._recorder = MidiRecorder(record_file)  # All inputs are merged into one track
+        # end if
+        self._rescan_interval = rescan_interval
         self._start_time = datetime.datetime.now()
+        self._inputs = dict()  # device id -> Midi
+        self._outputs = dict()  # device id -> Midi
+        self._router = Router()
+
+        # Routes: "INPUT|OUTPUT|TRANSFORMS" with devices given by id or name, without routes the input and output
+        # device are chosen interactively and connected directly
+        if not routes:
+            routes = [f"{self._choose_input_device(input_device_id, input_device_name)}|"
+                      f"{self._choose_output_device(output_device_id, output_device_name)}"]
+        # end if
 
         # Initialize the MIDI interface
-        print(f"Initializing MIDI interface... ", end="")
-        self._midi = Midi(self._input_device_id, self._output_device_id, self._cb_event)
+        print("Initializing MIDI interface... ", end="")
+        for spec in routes:
+            input_ref, output_ref, transforms = (spec.split("|") + [""])[:3]
+            midi_input = self._open(self._inputs, self._device_id(input_ref, MidiDeviceType.INPUT), MidiDeviceType.INPUT)
+            midi_output = self._open(self._outputs, self._device_id(output_ref, MidiDeviceType.OUTPUT), MidiDeviceType.OUTPUT)
+            self._router.add_route(midi_input, Route(midi_output, parse_transforms(transforms), name=spec))
+        # end for
         print("Done")
     # end def
 
-    def _cb_event(self, event: MidiEvent) -> None:
-        print(event)
-        if self._output_device_id is not None:
-            self._midi.play_note(event.data1, event.data2)
+    def _open(self, midis: Dict[int, Midi], device_id: int, device_type: MidiDeviceType) -> Midi:
+        # Each device is opened once, no matter how many routes use it
+        if device_id not in midis:
+            if device_type == MidiDeviceType.INPUT:
+                # The events are forwarded by the router directly in the reader thread to keep the latency low.
+                # Printing is slow, so it is done by a subscriber, which drops the oldest events if it can't keep up.
+                midis[device_id] = Midi(device_id, None, None, message_filter=MessageFilter(),
+                                        instrumentation=self._instrumentation)
+                if self._print_events:
+                    midis[device_id].subscribe(self._cb_events, policy=OverflowPolicy.DROP_OLDEST)
+                # end if
+                if self._recorder is not None:
+                    self._recorder.attach(midis[device_id])
+                # end if
+            else:
+                midis[device_id] = Midi(None, device_id, None, instrumentation=self._instrumentation)
+            # end if
+        # end if
+
+        return midis[device_id]
+    # end def
+
+    def _cb_events(self, events: List[MidiEvent]) -> None:
+        for event in events:
+            print(event)
+        # end for
     # end def
 
     def _get_time_since_start(self) -> int:
@@ -336,10 +1072,190 @@ class MidiTestThru(MidiTestBase):
         return diff
     # end def
 
-    def run(self) -> None:
-        while True:
-            time.sleep(1)
-        # end while
+    def _cb_devices_changed(self, devices: List[MidiDeviceInfo]) -> None:
+        for midi in list(self._inputs.values()) + list(self._outputs.values()):
+            name = midi.input_device_name if midi.input_device_name is not None else midi.output_device_name
+            print(f"MIDI devices changed, \"{name}\": {'reopened' if midi.is_open else 'not available'}")
+        # end for
+    # end def
+
+    def run(self, show_stats: bool = False) -> None:
+        for midi in self._inputs.values():
+            midi.collect_stats = show_stats
+        # end for
+        if self._rescan_interval > 0:
+            Midi.registry.watch(self._rescan_interval, self._cb_devices_changed)
+        # end if
+
+        # Runs until Ctrl+C, which ends thru mode with the shutdown below (the default handler would kill the process)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        try:
+            try:
+                while True:
+                    time.sleep(1)
+                # end while
+            except KeyboardInterrupt:
+                pass
+            # end try
+
+            for midi in list(self._inputs.values()) + list(self._outputs.values()):
+                midi.stop()
+            # end for
+        finally:
+            # The recording is finalized in any case, so it is a valid file
+            if self._recorder is not None:
+                self._recorder.close()
+                print(f"Recorded {self._recorder.n_events} events to {self._recorder.path}")
+            # end if
+        # end try
+
+        if show_stats:
+            for midi in self._inputs.values():
+                print(f"\"{midi.input_device_name}\": {midi.input_stats}")
+            # end for
+            for _, route in self._router.routes:
+                print(f"\"{route.name}\": {route.stats}")
+            # end for
+        # end if
+    # end def
+# end class
+
+
+class MidiTestConvert(MidiTestBase):
+    # Converts all MusicXML files of a directory (recursively) to Standard MIDI Files. Parsing is CPU-bound and
+    # music21 is single-threaded, so the files are spread across a pool of processes. Files whose MIDI file is newer
+    # than the MusicXML file are skipped; a score that can't be converted is reported and doesn't stop the others.
+    _EXTENSIONS = (".musicxml", ".xml", ".mxl")
+
+    def __init__(self, directory: str, output_directory: Optional[str] = None, bpm: int = 120,
+                 parser: str = "music21", n_jobs: int = 0, force: bool = False) -> None:
+        self._directory = directory
+        self._output_directory = output_directory if output_directory is not None else directory
+        self._bpm = bpm
+        self._parser = parser
+        self._n_jobs = n_jobs if n_jobs > 0 else os.cpu_count()
+        self._force = force
+    # end def
+
+    def _jobs(self) -> List[Tuple[str, str]]:
+        # (MusicXML file, MIDI file) of all scores, keeping the directory structure in the output directory
+        jobs = list()
+        for root, _, files in os.walk(self._directory):
+            for file in sorted(files):
+                if os.path.splitext(file)[1].lower() in self._EXTENSIONS:
+                    musicxml_file = os.path.join(root, file)
+                    midi_file = os.path.join(self._output_directory, os.path.relpath(root, self._directory),
+                                             os.path.splitext(file)[0] + ".mid")
+                    jobs.append((musicxml_file, os.path.normpath(midi_file)))
+                # end if
+            # end for
+        # end for
+
+        return sorted(jobs)
+    # end def
+
+    @staticmethod
+    def _is_up_to_date(musicxml_file: str, midi_file: str) -> bool:
+        return os.path.exists(midi_file) and os.path.getmtime(midi_file) >= os.path.getmtime(musicxml_file)
+    # end def
+
+    @staticmethod
+    def _convert(musicxml_file: str, midi_file: str, bpm: int, parser: str) -> Tuple[int, float]:
+        # Runs in a worker process, returns the number of notes and the time needed (in s)
+        from midi_file import write_score
+        from score import CompiledScore
+
+        start_time = time.perf_counter()
+        compiled_score = CompiledScore.from_score(MidiTestPlay.parse_score(musicxml_file, parser))
+        os.makedirs(os.path.dirname(midi_file) or ".", exist_ok=True)
+        n_notes = write_score(midi_file, compiled_score, bpm)
+
+        return n_notes, time.perf_counter() - start_time
+    # end def
+
+    def run(self) -> int:
+        # Returns the number of files that couldn't be converted
+        from process_pool import imap_unordered
+
+        jobs = self._jobs()
+        pending = [(musicxml_file, midi_file) for musicxml_file, midi_file in jobs
+                   if self._force or not self._is_up_to_date(musicxml_file, midi_file)]
+        print(f"{len(jobs)} scores found in {self._directory}, {len(jobs) - len(pending)} up to date, "
+              f"converting {len(pending)} using {min(self._n_jobs, max(len(pending), 1))} processes")
+
+        n_failed = 0
+        start_time = time.perf_counter()
+        # A score crashing its worker process fails with BrokenProcessPool, the other ones are converted by a new pool
+        jobs = [(musicxml_file, midi_file, self._bpm, self._parser) for musicxml_file, midi_file in pending]
+        for n, (index, result, e) in enumerate(imap_unordered(self._convert, jobs, self._n_jobs), 1):
+            musicxml_file, midi_file = pending[index]
+            if e is None:
+                n_notes, seconds = result
+                print(f"[{n}/{len(pending)}] {musicxml_file} -> {midi_file}: {n_notes} notes, {seconds:.2f} s")
+            else:
+                n_failed += 1
+                print(f"[{n}/{len(pending)}] {musicxml_file}: FAILED ({type(e).__name__}: {e})")
+            # end if
+        # end for
+
+        print(f"Converted {len(pending) - n_failed} scores, {n_failed} failed, {time.perf_counter() - start_time:.2f} s")
+
+        return n_failed
+    # end def
+# end class
+
+
+class MidiTestLibrary(MidiTestBase):
+    # Lists and searches the scores of a directory using a persistent index (see score_library.ScoreLibrary), which
+    # gets updated incrementally before (only the new and modified files are parsed, in parallel processes)
+    def __init__(self, directory: str, database: Optional[str] = None, parser: str = "music21", n_jobs: int = 0,
+                 scan: bool = True) -> None:
+        self._directory = directory
+        self._database = database
+        self._parser = parser
+        self._n_jobs = n_jobs
+        self._scan = scan
+    # end def
+
+    @staticmethod
+    def _format_duration(seconds: float) -> str:
+        return f"{int(seconds) // 60}:{int(seconds) % 60:02d}"
+    # end def
+
+    def run(self, search: Optional[str] = None, show_stats: bool = False) -> int:
+        # Returns the number of files that couldn't be indexed
+        from score_library import ScoreLibrary
+
+        library = ScoreLibrary(self._database)
+        failures = list()
+        if self._scan:
+            stats, failures = library.scan(self._directory, MidiTestConvert._EXTENSIONS, self._parser,
+                                           MidiTestPlay._PARSER_VERSION, self._n_jobs)
+            for path, error in failures:
+                print(f"{path}: FAILED ({error})")
+            # end for
+            if show_stats:
+                print(stats)
+            # end if
+        # end if
+
+        entries = library.search(search, self._directory)
+        library.close()
+        for entry in entries:
+            title = entry["title"] or os.path.splitext(os.path.basename(entry["path"]))[0]
+            composer = f" ({entry['composer']})" if entry["composer"] else ""
+            tempo = f"{entry['qpm']:.0f} qpm" if entry["qpm"] is not None else "no tempo"
+            print(f"{title}{composer}: {self._format_duration(entry['duration'])}, {entry['n_notes']} notes, "
+                  f"{entry['n_parts']} parts, {tempo}")
+            print(f"    {entry['path']}")
+            for name, program, channel, n_notes in entry["instruments"]:
+                print(f"    * {name or '-'}: program {'-' if program is None else program}, "
+                      f"channel {'-' if channel is None else channel}, {n_notes} notes")
+            # end for
+        # end for
+        print(f"{len(entries)} scores")
+
+        return len(failures)
     # end def
 # end class
 
@@ -349,10 +1265,33 @@ def main():
     parser_input_device_id = argparse.ArgumentParser(add_help=False)
     parser_input_device_id.add_argument("--input_device_id", type=int, required=False, default=None,
                                         help="MIDI input device ID.")
+    parser_input_device_id.add_argument("--input_device_name", type=str, required=False, default=None,
+                                        help="MIDI input device name or a part of it (e.g. \"USB MIDI\"), "
+                                             "which is stable unlike the ID.")
 
     parser_output_device_id = argparse.ArgumentParser(add_help=False)
     parser_output_device_id.add_argument("--output_device_id", type=int, required=False, default=None,
                                          help="MIDI output device ID.")
+    parser_output_device_id.add_argument("--output_device_name", type=str, required=False, default=None,
+                                         help="MIDI output device name or a part of it (e.g. \"USB MIDI\"), "
+                                              "which is stable unlike the ID.")
+
+    parser_show_stats = argparse.ArgumentParser(add_help=False)
+    parser_show_stats.add_argument("--show_stats", type=int, required=False, default=0,
+                                   help="Print timing statistics (mean/p99/max) at the end: the scheduling lateness "
+                                        "when playing, the input-to-callback latency otherwise.")
+    parser_show_stats.add_argument("--trace", type=int, required=False, default=0,
+                                   help="Record latency histograms and the last n events (input, output, scheduling), "
+                                        "which are printed on SIGUSR1 and at exit. 0 disables the instrumentation.")
+
+    parser_record = argparse.ArgumentParser(add_help=False)
+    parser_record.add_argument("--record", type=str, required=False, default=None,
+                               help="Record the input events to this Standard MIDI File (written while playing, "
+                                    "a file left incomplete by a crash can be repaired by \"python midi_file.py FILE\").")
+
+    parser_print_events = argparse.ArgumentParser(add_help=False)
+    parser_print_events.add_argument("--print_events", type=int, required=False, default=0,
+                                     help="Print each input event (slow with dense input, e.g. from controllers).")
 
     # create the top-level parser
     # ---------------------------
@@ -361,23 +1300,132 @@ def main():
                                        help="Mode.")
 
     # create the parser for the "play" command
-    parser_play = subparsers.add_parser("play", aliases=["p"], parents=[parser_output_device_id],
+    parser_play = subparsers.add_parser("play", aliases=["p"], parents=[parser_output_device_id, parser_show_stats],
                                         help="Play xmlmusic mode.")
     parser_play.add_argument("--musicxml_file", type=str, required=False, default=None,
                              help="The MusicXML file to play.")
     parser_play.add_argument("--bpm", type=int, required=False, default=80,
-                             help="Beats per minute to play xmlmusic file.")
+                             help="Beats per minute to play xmlmusic file (until the first tempo mark in the file).")
+    parser_play.add_argument("--tempo_scale", type=float, required=False, default=1.,
+                             help="Factor applied to all tempos (e.g. 0.5 plays at half speed).")
+    parser_play.add_argument("--use_score_tempo", type=int, required=False, default=1,
+                             help="Use the tempo marks of the xmlmusic file. Otherwise the whole file is played using --bpm.")
+    parser_play.add_argument("--latency", type=int, required=False, default=0,
+                             help="Output latency in ms. If > 0, the notes are sent in advance as timestamped batches "
+                                  "and PortMidi takes care of the precise timing.")
+    parser_play.add_argument("--lookahead", type=int, required=False, default=100,
+                             help="Time window in ms of the notes sent in advance in one batch (limited to --latency).")
+    parser_play.add_argument("--bandwidth", type=float, required=False, default=0.,
+                             help="Bandwidth of the MIDI link in bytes/s (e.g. 3125 for a DIN cable), used to spread bursts "
+                                  "of notes (requires --latency > 0). 0 means unlimited.")
+    parser_play.add_argument("--running_status", type=int, required=False, default=0,
+                             help="Assume the MIDI link uses running status (omits repeated status bytes) when computing "
+                                  "its load for --bandwidth. Only true for some DIN interfaces, never for USB-MIDI.")
+    parser_play.add_argument("--no_cache", type=int, required=False, default=0,
+                             help="Do not use the compiled score cache (always parse the MusicXML file).")
+    parser_play.add_argument("--rebuild_cache", type=int, required=False, default=0,
+                             help="Parse the MusicXML file again and replace its entry in the compiled score cache.")
+    parser_play.add_argument("--parser", type=str, required=False, default="music21", choices=["music21", "stream"],
+                             help="Parser used to read the MusicXML file: music21 or the lightweight streaming parser.")
+    parser_play.add_argument("--start_measure", type=int, required=False, default=None,
+                             help="Start playing at this measure (the notes still sounding there are played as well).")
+    parser_play.add_argument("--end_measure", type=int, required=False, default=None,
+                             help="Stop playing after this measure.")
+    parser_play.add_argument("--start_time", type=float, required=False, default=None,
+                             help="Start playing at this time in s (instead of --start_measure).")
+    parser_play.add_argument("--end_time", type=float, required=False, default=None,
+                             help="Stop playing at this time in s (instead of --end_measure).")
+    parser_play.add_argument("--use_asyncio", type=int, required=False, default=0,
+                             help="Play on an asyncio event loop (see midi_async) instead of a blocking scheduler thread.")
+    parser_play.add_argument("--route", type=str, required=False, action="append", default=None,
+                             help="Route \"PART|OUTPUT|DELAY\" (can be given several times) sending a part, given by "
+                                  "(a part of) its instrument name or as channel=CHANNEL[+CHANNEL...] (0-based), to an "
+                                  "output device given by id or name. DELAY is the device's own delay in ms (e.g. of a "
+                                  "software synth), the other outputs are delayed to stay aligned. "
+                                  "E.g. --route=\"Piano|PSR\" --route=\"channel=2+3|FluidSynth|30\". "
+                                  "The other parts are played on --output_device_id (not at all if it isn't given).")
+    parser_play.add_argument("--repeat", type=int, required=False, default=1,
+                             help="Number of times to play the selected part, e.g. an A-B loop given by "
+                                  "--start_measure/--end_measure. 0 repeats it until the program gets stopped.")
 
     # create the parser for the "show" command
-    parser_show = subparsers.add_parser("show", aliases=["s"], parents=[parser_input_device_id, parser_output_device_id],
+    parser_show = subparsers.add_parser("show", aliases=["s"], parents=[parser_input_device_id, parser_output_device_id, parser_show_stats, parser_record, parser_print_events],
                                         help="Show keyboard events mode.")
     parser_show.add_argument("--use_computer_keyboard", type=int, required=False, default=True,
                              help="Use the computer keyboard in addition to a MIDI input device "
                                   "(especially interesting for testing purposes when no MIDI input device is available).")
 
+    # create the parser for the "practice" command
+    parser_practice = subparsers.add_parser("practice", aliases=["pr"], parents=[parser_input_device_id, parser_output_device_id, parser_show_stats],
+                                            help="Practice mode: compare the notes played with a musicxml file.")
+    parser_practice.add_argument("--musicxml_file", type=str, required=True,
+                                 help="The MusicXML file to practice.")
+    parser_practice.add_argument("--part", type=str, required=False, default=None,
+                                 help="Only expect the notes of the parts whose instrument name contains this text "
+                                      "(e.g. \"Piano\"). Default: all parts.")
+    parser_practice.add_argument("--bpm", type=int, required=False, default=80,
+                                 help="Beats per minute (until the first tempo mark in the file).")
+    parser_practice.add_argument("--tempo_scale", type=float, required=False, default=1.,
+                                 help="Factor applied to all tempos (e.g. 0.5 to practice at half speed).")
+    parser_practice.add_argument("--use_score_tempo", type=int, required=False, default=1,
+                                 help="Use the tempo marks of the xmlmusic file. Otherwise the whole file uses --bpm.")
+    parser_practice.add_argument("--tolerance", type=int, required=False, default=150,
+                                 help="Maximum deviation in ms of a note played from its time in the score.")
+    parser_practice.add_argument("--no_cache", type=int, required=False, default=0,
+                                 help="Do not use the compiled score cache (always parse the MusicXML file).")
+    parser_practice.add_argument("--rebuild_cache", type=int, required=False, default=0,
+                                 help="Parse the MusicXML file again and replace its entry in the compiled score cache.")
+    parser_practice.add_argument("--parser", type=str, required=False, default="music21", choices=["music21", "stream"],
+                                 help="Parser used to read the MusicXML file: music21 or the lightweight streaming parser.")
+
     # create the parser for the "thru" command
-    parser_thru = subparsers.add_parser("thru", aliases=["t"], parents=[parser_input_device_id, parser_output_device_id],
+    parser_thru = subparsers.add_parser("thru", aliases=["t"], parents=[parser_input_device_id, parser_output_device_id, parser_show_stats, parser_record, parser_print_events],
                                         help="Pass-through keyboard events mode.")
+    parser_thru.add_argument("--rescan_interval", type=float, required=False, default=0.,
+                             help="Rescan the MIDI devices every n seconds and reopen the devices by name, "
+                                  "e.g. to continue after reconnecting a USB adapter. 0 means never.")
+    parser_thru.add_argument("--route", type=str, required=False, action="append", default=None,
+                             help="Route \"INPUT|OUTPUT|TRANSFORMS\" (can be given several times) with the devices "
+                                  "given by id or name and comma separated transforms: keys=LOWEST-HIGHEST, "
+                                  "transpose=SEMITONES, channel=[IN:]OUT, velocity=GAMMA[*SCALE], "
+                                  "types=note+aftertouch+cc+program+pitchbend. "
+                                  "E.g. --route=\"USB MIDI|LoopBe|keys=0-59,channel=1\". "
+                                  "Replaces --input_device_id/--output_device_id.")
+
+    # create the parser for the "convert" command
+    parser_convert = subparsers.add_parser("convert", aliases=["c"], help="Convert MusicXML files to MIDI files mode.")
+    parser_convert.add_argument("--directory", type=str, required=False, default="notes",
+                                help="Directory containing the MusicXML files (searched recursively).")
+    parser_convert.add_argument("--output_directory", type=str, required=False, default=None,
+                                help="Directory the MIDI files are written to (same structure as --directory). "
+                                     "Default: next to the MusicXML files.")
+    parser_convert.add_argument("--bpm", type=int, required=False, default=120,
+                                help="Beats per minute until the first tempo mark in the file.")
+    parser_convert.add_argument("--parser", type=str, required=False, default="music21", choices=["music21", "stream"],
+                                help="Parser used to read the MusicXML files: music21 or the lightweight streaming parser.")
+    parser_convert.add_argument("--jobs", type=int, required=False, default=0,
+                                help="Number of processes. 0 means one per CPU.")
+    parser_convert.add_argument("--force", type=int, required=False, default=0,
+                                help="Also convert the files whose MIDI file is up to date.")
+
+    # create the parser for the "library" command
+    parser_library = subparsers.add_parser("library", aliases=["l"], help="List and search the scores of a directory mode.")
+    parser_library.add_argument("--directory", type=str, required=False, default="notes",
+                                help="Directory containing the MusicXML files (searched recursively).")
+    parser_library.add_argument("--search", type=str, required=False, default=None,
+                                help="Only list the scores whose title, composer, path or instrument names contain "
+                                     "this text (case-insensitive).")
+    parser_library.add_argument("--scan", type=int, required=False, default=1,
+                                help="Update the index before listing (only new and modified files get parsed). "
+                                     "With 0, the index is only read.")
+    parser_library.add_argument("--database", type=str, required=False, default=None,
+                                help="SQLite file of the index. Default: library.sqlite in the score cache directory.")
+    parser_library.add_argument("--parser", type=str, required=False, default="music21", choices=["music21", "stream"],
+                                help="Parser used to read the MusicXML files: music21 or the lightweight streaming parser.")
+    parser_library.add_argument("--jobs", type=int, required=False, default=0,
+                                help="Number of processes. 0 means one per CPU.")
+    parser_library.add_argument("--show_stats", type=int, required=False, default=0,
+                                help="Print the statistics of the scan (unchanged, parsed and removed files, time).")
 
     # test command lines
     cmd_line = None
@@ -395,14 +1443,61 @@ def main():
     else:
         args = parser.parse_args()
 
+    if args.mode in ["p", "play"] and args.bandwidth > 0 and args.latency <= 0:
+        # The shaper spreads the timestamps of the messages, which are only respected with a latency
+        parser_play.error("--bandwidth requires --latency > 0")
+    # end if
+
+    instrumentation = None
+    if getattr(args, "trace", 0) > 0:  # Not available in convert mode
+        instrumentation = Instrumentation(args.trace)
+        instrumentation.install_dump_handlers()
+    # end if
+
     if args.mode in ["p", "play"]:
-        MidiTestPlay(args.output_device_id, args.musicxml_file, bpm=args.bpm).run(show_note_list=False)
+        play = MidiTestPlay(args.output_device_id, args.musicxml_file, bpm=args.bpm,
+                            use_cache=not args.no_cache, rebuild_cache=args.rebuild_cache, parser=args.parser,
+                            tempo_scale=args.tempo_scale, use_score_tempo=args.use_score_tempo,
+                            latency=args.latency, lookahead=args.lookahead, bandwidth=args.bandwidth,
+                            running_status=args.running_status,
+                            output_device_name=args.output_device_name, instrumentation=instrumentation,
+                            start_measure=args.start_measure, end_measure=args.end_measure, start_time=args.start_time,
+                            end_time=args.end_time, repeat=args.repeat, routes=args.route)
+        if args.use_asyncio:
+            import asyncio
+            # With the default handler, asyncio.run() cancels the playback on Ctrl+C and raises KeyboardInterrupt
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            try:
+                asyncio.run(play.run_async(show_note_list=False, show_stats=args.show_stats))
+            except KeyboardInterrupt:
+                pass
+            # end try
+        else:
+            play.run(show_note_list=False, show_stats=args.show_stats)
+        # end if
 
     elif args.mode in ["s", "show"]:
-        MidiTestShow(args.input_device_id, args.output_device_id, args.use_computer_keyboard).run()
+        MidiTestShow(args.input_device_id, args.output_device_id, args.use_computer_keyboard,
+                     args.input_device_name, args.output_device_name, instrumentation, args.record,
+                     args.print_events).run(show_stats=args.show_stats)
+
+    elif args.mode in ["pr", "practice"]:
+        MidiTestPractice(args.input_device_id, args.output_device_id, args.musicxml_file, args.bpm, args.tempo_scale,
+                         args.use_score_tempo, args.parser, not args.no_cache, args.rebuild_cache, args.tolerance,
+                         args.part, args.input_device_name, args.output_device_name, instrumentation).run(show_stats=args.show_stats)
 
     elif args.mode in ["t", "thru"]:
-        MidiTestThru(args.input_device_id, args.output_device_id).run()
+        MidiTestThru(args.input_device_id, args.output_device_id, args.input_device_name, args.output_device_name,
+                     args.rescan_interval, args.route, instrumentation, args.record,
+                     args.print_events).run(show_stats=args.show_stats)
+
+    elif args.mode in ["c", "convert"]:
+        n_failed = MidiTestConvert(args.directory, args.output_directory, args.bpm, args.parser, args.jobs, args.force).run()
+        sys.exit(1 if n_failed > 0 else 0)
+
+    elif args.mode in ["l", "library"]:
+        n_failed = MidiTestLibrary(args.directory, args.database, args.parser, args.jobs, args.scan).run(args.search, args.show_stats)
+        sys.exit(1 if n_failed > 0 else 0)
 # end def
 
 
@@ -0,0 +1,238 @@
+import atexit
+import bisect
+import math
+import signal
+import sys
+import threading
+import time
+from array import array
+from typing import Any, List, Sequence, TextIO
+
+
+class Histogram:
+    # Fixed-size histogram of durations (in s) with logarithmic buckets, so recording a value never allocates memory.
+    # The percentiles are estimated by the upper bound of the bucket containing them.
+
+    def __init__(self, name: str, lowest: float = 1e-6, highest: float = 10., n_buckets_per_decade: int = 10) -> None:
+        n_decades = int(round(math.log10(highest / lowest)))
+        self._name = name
+        self._bounds = [lowest * 10. ** (b / n_buckets_per_decade) for b in range(n_decades * n_buckets_per_decade + 1)]
+        self._counts = array("q", bytes(8 * (len(self._bounds) + 1)))  # The last bucket takes everything above highest
+        self._count = 0
+        self._sum = 0.
+        self._max = 0.
+    # end def
+
+    def __repr__(self) -> str:
+        return f"Histogram({self._name}: count={self._count}, mean={self.mean * 1e3:.3f} ms, " \
+               f"p50={self.percentile(50.) * 1e3:.3f} ms, p99={self.percentile(99.) * 1e3:.3f} ms, " \
+               f"max={self._max * 1e3:.3f} ms)"
+    # end def
+
+    def __str__(self) -> str:
+        return repr(self)
+    # end def
+
+    @property
+    def name(self) -> str:
+        return self._name
+    # end def
+
+    @property
+    def count(self) -> int:
+        return self._count
+    # end def
+
+    @property
+    def mean(self) -> float:
+        return self._sum / self._count if self._count > 0 else 0.
+    # end def
+
+    @property
+    def max(self) -> float:
+        return self._max
+    # end def
+
+    @property
+    def p99(self) -> float:
+        return self.percentile(99.)
+    # end def
+
+    def add(self, value: float) -> None:
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self._count += 1
+        self._sum += value
+        if value > self._max:
+            self._max = value
+        # end if
+    # end def
+
+    def percentile(self, p: float) -> float:
+        if self._count == 0:
+            return 0.
+
+        rank = p / 100. * self._count
+        n = 0
+        for bucket, count in enumerate(self._counts):
+            n += count
+            if n >= rank and count > 0:
+                return min(self._bounds[bucket], self._max) if bucket < len(self._bounds) else self._max
+            # end if
+        # end for
+
+        return self._max
+    # end def
+
+    def buckets(self) -> List[tuple]:
+        # (upper bound, count) of all non-empty buckets
+        return [(self._bounds[b] if b < len(self._bounds) else float("inf"), count)
+                for b, count in enumerate(self._counts) if count > 0]
+    # end def
+# end class
+
+
+class EventTrace:
+    # The last capacity events in a preallocated ring buffer (one array per field), for post-mortem analysis
+
+    # Kinds of events
+    INPUT = 0  # Received from an input device (value: latency)
+    OUTPUT = 1  # Sent to an output device (value: duration of the output call)
+    SCHEDULED = 2  # Dispatched by the scheduler (value: lateness)
+    _KIND_NAMES = ("input", "output", "scheduled")
+
+    def __init__(self, capacity: int = 4096) -> None:
+        self._capacity = capacity
+        self._time = array("d", bytes(8 * capacity))
+        self._kind = array("B", bytes(capacity))
+        self._status = array("B", bytes(capacity))
+        self._data1 = array("B", bytes(capacity))
+        self._data2 = array("B", bytes(capacity))
+        self._value = array("d", bytes(8 * capacity))
+        self._n_events = 0
+    # end def
+
+    def __len__(self) -> int:
+        return min(self._n_events, self._capacity)
+    # end def
+
+    def record(self, kind: int, status: int, data1: int, data2: int, value: float = 0.) -> None:
+        index = self._n_events % self._capacity
+        self._time[index] = time.perf_counter()
+        self._kind[index] = kind
+        self._status[index] = status
+        self._data1[index] = data1
+        self._data2[index] = data2
+        self._value[index] = value
+        self._n_events += 1
+    # end def
+
+    def dump(self, file: TextIO = sys.stderr) -> None:
+        # Oldest event first, times relative to the last event
+        n_events = self._n_events
+        first = max(n_events - self._capacity, 0)
+        last_time = self._time[(n_events - 1) % self._capacity] if n_events > 0 else 0.
+
+        print(f"Last {n_events - first} of {n_events} events:", file=file)
+        for n in range(first, n_events):
+            index = n % self._capacity
+            print(f"  {(self._time[index] - last_time) * 1e3:12.3f} ms {self._KIND_NAMES[self._kind[index]]:<9} "
+                  f"{self._status[index]:02x} {self._data1[index]:3d} {self._data2[index]:3d} "
+                  f"{self._value[index] * 1e3:9.3f} ms", file=file)
+        # end for
+    # end def
+# end class
+
+
+class Instrumentation:
+    # Opt-in instrumentation of the hot paths (Midi, Scheduler), which take an Instrumentation or None. When None
+    # is passed, the only cost is a check per batch or call.
+
+    def __init__(self, trace_capacity: int = 4096) -> None:
+        self.input_latency = Histogram("input latency")  # Time between an input event's timestamp and its dispatch
+        self.callback_duration = Histogram("callback duration")  # Time needed by the callbacks of an input batch
+        self.scheduler_lateness = Histogram("scheduler lateness")  # Time between an event's deadline and its dispatch
+        # Time an event is dispatched before its deadline (batches of timestamped events, see Scheduler.run_batched)
+        self.dispatch_lead = Histogram("dispatch lead")
+        self.output_call_time = Histogram("output call time")  # Duration of a call to the output device
+        self.trace = EventTrace(trace_capacity)
+        self._dump_lock = threading.RLock()  # Signal handlers run in the main thread, which might be dumping already
+    # end def
+
+    @property
+    def histograms(self) -> List[Histogram]:
+        return [self.input_latency, self.callback_duration, self.scheduler_lateness, self.dispatch_lead,
+                self.output_call_time]
+    # end def
+
+    def dump(self, file: TextIO = sys.stderr) -> None:
+        with self._dump_lock:
+            for histogram in self.histograms:
+                if histogram.count > 0:
+                    print(histogram, file=file)
+                # end if
+            # end for
+            self.trace.dump(file)
+        # end with
+    # end def
+
+    def install_dump_handlers(self, file: TextIO = sys.stderr) -> None:
+        # Dumps on SIGUSR1 (where available, i.e. not on Windows) and at exit
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.dump(file))
+        # end if
+        atexit.register(self.dump, file)
+    # end def
+# end class
+
+
+class InstrumentedOutput:
+    # Wraps a pygame.midi.Output and records the duration of each call (and the messages sent). Only used if
+    # instrumentation is enabled, so the uninstrumented output path stays unchanged.
+
+    def __init__(self, output: Any, instrumentation: Instrumentation) -> None:
+        self._output = output
+        self._histogram = instrumentation.output_call_time
+        self._trace = instrumentation.trace
+    # end def
+
+    def _record(self, start_time: float, status: int, data1: int, data2: int) -> None:
+        duration = time.perf_counter() - start_time
+        self._histogram.add(duration)
+        self._trace.record(EventTrace.OUTPUT, status & 0xff, data1 & 0x7f, data2 & 0x7f, duration)
+    # end def
+
+    def write(self, messages: Sequence) -> None:
+        start_time = time.perf_counter()
+        self._output.write(messages)
+        message = messages[0][0] if len(messages) > 0 else (0, 0, 0)
+        self._record(start_time, message[0], message[1] if len(message) > 1 else 0, message[2] if len(message) > 2 else 0)
+    # end def
+
+    def write_short(self, status: int, data1: int = 0, data2: int = 0) -> None:
+        start_time = time.perf_counter()
+        self._output.write_short(status, data1, data2)
+        self._record(start_time, status, data1, data2)
+    # end def
+
+    def set_instrument(self, instrument: int, channel: int = 0) -> None:
+        start_time = time.perf_counter()
+        self._output.set_instrument(instrument, channel)
+        self._record(start_time, 0xc0 | channel, instrument, 0)
+    # end def
+
+    def note_on(self, note: int, velocity: int, channel: int = 0) -> None:
+        start_time = time.perf_counter()
+        self._output.note_on(note, velocity, channel)
+        self._record(start_time, 0x90 | channel, note, velocity)
+    # end def
+
+    def note_off(self, note: int, velocity: int = 0, channel: int = 0) -> None:
+        start_time = time.perf_counter()
+        self._output.note_off(note, velocity, channel)
+        self._record(start_time, 0x80 | channel, note, velocity)
+    # end def
+
+    def close(self) -> None:
+        self._output.close()
+    # end def
+# end class
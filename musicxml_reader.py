@@ -0,0 +1,375 @@
+import io
+import os
+import re
+import xml.etree.ElementTree as ET
+import zipfile
+from fractions import Fraction
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+
+def musicxml_source(musicxml_file: str) -> Union[str, IO[bytes]]:
+    # The source to parse: the file itself or, for a compressed MusicXML file (.mxl), the score given by its container
+    # (read into memory, scores are small)
+    if os.path.splitext(musicxml_file)[1].lower() != ".mxl":
+        return musicxml_file
+    # end if
+
+    with zipfile.ZipFile(musicxml_file) as archive:
+        names = archive.namelist()
+        root_file = None
+        if "META-INF/container.xml" in names:
+            root_file = ET.fromstring(archive.read("META-INF/container.xml")).find(".//{*}rootfile")
+        # end if
+        if root_file is not None and root_file.get("full-path") in names:
+            return io.BytesIO(archive.read(root_file.get("full-path")))
+        # end if
+
+        score_file = next(name for name in names if not name.startswith("META-INF/") and name.endswith("xml"))
+
+        return io.BytesIO(archive.read(score_file))
+    # end with
+# end def
+
+
+class MusicXmlReader:
+    # Lightweight streaming reader for partwise MusicXML files, which extracts only the information needed for
+    # playback (offset, duration, pitch, velocity, channel and program of each note) without building the music21
+    # object model. The file is parsed incrementally and the notes are emitted measure by measure.
+    #
+    # To be interchangeable with the music21 based extraction (MidiTestPlay._xml_to_list), the values are derived the
+    # same way music21 does it:
+    # * Offsets and durations are in quarter lengths, tied notes are reported separately (not merged).
+    # * Pitches are the written pitches (<transpose> is not applied), unpitched notes use <midi-unpitched>.
+    # * Channel and program are the first <midi-instrument> of the part (0-based).
+    # * Tempo marks are collected in tempos: <sound tempo="..."> or, if missing, the <metronome> mark.
+    # * The velocity (0..1) is derived from the <dynamics> marks (per staff), the note's dynamics attribute and its
+    #   articulations. Like music21, <sound dynamics="..."> is ignored by default; with use_sound_dynamics it is used
+    #   for directions without a <dynamics> mark.
+
+    _STEPS = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+
+    # Same values as used by music21 (dynamics.dynamicStrToScalar and the articulations' volumeShift)
+    _DYNAMICS = {None: 0.5, "n": 0.0, "pppp": 0.1, "ppp": 0.15, "pp": 0.25, "p": 0.35, "mp": 0.45, "mf": 0.55,
+                 "f": 0.7, "fp": 0.75, "sf": 0.85, "ff": 0.85, "fff": 0.9, "ffff": 0.95}
+    _ARTICULATIONS = {"accent": 0.1, "strong-accent": 0.15, "staccato": 0.05, "staccatissimo": 0.05,
+                      "tenuto": -0.05, "stress": 0.05, "unstress": -0.05}
+    _BEAT_UNITS = {"whole": 4., "half": 2., "quarter": 1., "eighth": 0.5, "16th": 0.25, "32nd": 0.125}  # In quarter lengths
+    _BASE_LEVEL = 0.5
+    _DEFAULT_VELOCITY_SHIFT = 0.20866
+
+    class _PartInfo:
+        def __init__(self, part_id: str) -> None:
+            self.part_id = part_id
+            self.part_name = None
+            self.instrument_name = None
+            self.channel = None
+            self.program = None
+            self.unpitched = dict()  # instrument id -> key
+        # end def
+    # end class
+
+    def __init__(self, musicxml_file: str, use_sound_dynamics: bool = False) -> None:
+        self._musicxml_file = musicxml_file
+        self._use_sound_dynamics = use_sound_dynamics
+        self._parts = dict()
+        self._tempos = list()
+        self._measures = list()
+    # end def
+
+    @property
+    def parts(self) -> Dict[str, Any]:
+        return self._parts
+    # end def
+
+    @property
+    def tempos(self) -> List[Tuple[Fraction, float]]:
+        # (offset, quarter notes per minute) of all tempo marks read so far (in all parts, so there might be duplicates)
+        return self._tempos
+    # end def
+
+    @property
+    def measures(self) -> List[Tuple[Fraction, Optional[int]]]:
+        # (offset, number) of the measures of the first part read so far (the number is None if it isn't numeric)
+        return self._measures
+    # end def
+
+    @classmethod
+    def _metronome_qpm(cls, metronome: ET.Element) -> Optional[float]:
+        beat_unit = metronome.findtext("beat-unit")
+        per_minute = re.match(r"\s*(\d+(\.\d*)?)", metronome.findtext("per-minute", ""))
+        if beat_unit not in cls._BEAT_UNITS or per_minute is None:
+            return None
+        # end if
+
+        # Only the dots of the first beat unit count (a second beat unit is a metric modulation)
+        n_dots = 0
+        children = list(metronome)
+        for child in children[children.index(metronome.find("beat-unit")) + 1:]:
+            if child.tag != "beat-unit-dot":
+                break
+            n_dots += 1
+        # end for
+
+        return float(per_minute.group(1)) * cls._BEAT_UNITS[beat_unit] * (2. - 0.5 ** n_dots)
+    # end def
+
+    @classmethod
+    def _dynamic_scalar(cls, value: str) -> float:
+        if value in cls._DYNAMICS:
+            return cls._DYNAMICS[value]
+        # end if
+
+        # Ignore leading s (like in sf) and closing z (like in fz)
+        if "s" in value:
+            value = value[1:]
+        if value.endswith("z"):
+            value = value[:-1]
+
+        return cls._DYNAMICS.get(value, cls._DYNAMICS[None])
+    # end def
+
+    @classmethod
+    def _velocity(cls, dynamics_attr: Optional[str], dynamic: Optional[float], articulations: List[str]) -> float:
+        if dynamics_attr is not None:
+            velocity = cls._BASE_LEVEL * (float(dynamics_attr) * 90. / 12700. * 2.)
+        else:
+            velocity = cls._BASE_LEVEL + cls._DEFAULT_VELOCITY_SHIFT
+        # end if
+
+        if dynamic is not None:
+            velocity *= dynamic * 2.
+
+        for articulation in articulations:
+            velocity += cls._ARTICULATIONS.get(articulation, 0.)
+
+        return min(max(velocity, 0.), 1.)
+    # end def
+
+    def _read_score_part(self, elem: ET.Element) -> None:
+        part = MusicXmlReader._PartInfo(elem.get("id"))
+        part.part_name = elem.findtext("part-name")
+
+        score_instrument = elem.find("score-instrument")
+        if score_instrument is not None:
+            part.instrument_name = score_instrument.findtext("instrument-name")
+        # end if
+
+        for m, midi_instrument in enumerate(elem.iter("midi-instrument")):
+            channel = midi_instrument.findtext("midi-channel")
+            program = midi_instrument.findtext("midi-program")
+            unpitched = midi_instrument.findtext("midi-unpitched")
+
+            if unpitched is not None:
+                part.unpitched[midi_instrument.get("id")] = int(unpitched) - 1
+            # end if
+
+            if m == 0:
+                part.channel = int(channel) - 1 if channel is not None else None
+                # Percussion instruments have no program
+                part.program = int(program) - 1 if program is not None and unpitched is None else None
+            # end if
+        # end for
+
+        if part.instrument_name is None:
+            part.instrument_name = part.part_name
+        # end if
+
+        self._parts[part.part_id] = part
+    # end def
+
+    @classmethod
+    def read_tempos(cls, musicxml_file: str) -> List[Tuple[Fraction, float]]:
+        # Only the tempo marks, e.g. for the music21 based extraction (music21 ignores <sound tempo="...">)
+        reader = cls(musicxml_file)
+        for _ in reader.notes():
+            pass
+        # end for
+
+        return reader.tempos
+    # end def
+
+    def notes(self, note_type: Optional[Callable[..., Any]] = None) -> Iterator[Any]:
+        # Yields (start, duration, pitch, velocity, channel, instrument, instrument_name) for each note,
+        # either as tuple or converted using note_type
+        part = None
+        divisions = 1
+        measure_start = Fraction(0)
+        position = Fraction(0)
+        measure_length = Fraction(0)
+        last_start = Fraction(0)
+        dynamics = dict()  # staff -> [(offset, scalar)], sorted by offset
+        pending = list()  # notes of the current measure waiting for their velocity
+        first_part_id = None  # The measures are taken from the first part
+        in_direction = False
+
+        for event, elem in ET.iterparse(musicxml_source(self._musicxml_file), events=("start", "end")):
+            tag = elem.tag
+
+            if event == "start":
+                if tag == "part":
+                    part = self._parts.get(elem.get("id"), MusicXmlReader._PartInfo(elem.get("id")))
+                    first_part_id = part.part_id if first_part_id is None else first_part_id
+                    divisions = 1
+                    measure_start = position = measure_length = last_start = Fraction(0)
+                    dynamics = dict()
+                elif tag == "direction":
+                    in_direction = True
+                # end if
+                continue
+            # end if
+
+            if tag == "score-part":
+                self._read_score_part(elem)
+
+            elif tag == "divisions" and elem.text is not None:
+                divisions = int(elem.text)
+
+            elif tag == "backup":
+                position -= Fraction(elem.findtext("duration")) / divisions
+
+            elif tag == "forward":
+                position += Fraction(elem.findtext("duration")) / divisions
+                measure_length = max(measure_length, position)
+
+            elif tag == "sound" and not in_direction:
+                if elem.get("tempo") is not None:
+                    self._tempos.append((measure_start + position, float(elem.get("tempo"))))
+                # end if
+
+            elif tag == "direction":
+                in_direction = False
+                offset = elem.findtext("offset")
+                offset = measure_start + position + (Fraction(offset) / divisions if offset is not None else 0)
+                staff = elem.findtext("staff", "1")
+
+                # The sound's tempo defines the playback, the metronome mark is only used if there is none
+                sound = elem.find("sound")
+                if sound is not None and sound.get("tempo") is not None:
+                    self._tempos.append((offset, float(sound.get("tempo"))))
+                else:
+                    for metronome in elem.iter("metronome"):
+                        qpm = self._metronome_qpm(metronome)
+                        if qpm is not None:
+                            self._tempos.append((offset, qpm))
+                        # end if
+                    # end for
+                # end if
+
+                marks = [self._dynamic_scalar(d.tag if d.tag != "other-dynamic" else (d.text or "").strip())
+                         for dynamics_elem in elem.iter("dynamics") for d in dynamics_elem]
+                if len(marks) == 0 and self._use_sound_dynamics:
+                    if sound is not None and sound.get("dynamics") is not None:
+                        marks.append(float(sound.get("dynamics")) / 200.)  # Percentage of the default velocity (90)
+                    # end if
+                # end if
+
+                for mark in marks:
+                    staff_dynamics = dynamics.setdefault(staff, list())
+                    staff_dynamics.append((offset, mark))
+                    staff_dynamics.sort(key=lambda d: d[0])
+                # end for
+
+            elif tag == "note":
+                duration = elem.findtext("duration")
+                duration = Fraction(duration) / divisions if duration is not None else Fraction(0)
+
+                if elem.find("chord") is not None:
+                    start = last_start
+                else:
+                    start = position
+                    position += duration
+                    measure_length = max(measure_length, position)
+                # end if
+                last_start = start
+
+                if elem.find("rest") is None and elem.find("grace") is None:  # music21 reports grace notes with a duration of 0
+                    pitch = None
+                    pitch_elem = elem.find("pitch")
+                    if pitch_elem is not None:
+                        pitch = int((int(pitch_elem.findtext("octave")) + 1) * 12 + self._STEPS[pitch_elem.findtext("step")] +
+                                    float(pitch_elem.findtext("alter", "0")))
+                    elif elem.find("unpitched") is not None:
+                        instrument = elem.find("instrument")
+                        if instrument is not None and instrument.get("id") in part.unpitched:
+                            pitch = part.unpitched[instrument.get("id")]
+                        elif len(part.unpitched) > 0:
+                            pitch = next(iter(part.unpitched.values()))
+                        # end if
+                    # end if
+
+                    if pitch is not None:
+                        articulations = [a.tag for notations in elem.iter("notations")
+                                         for articulation_elem in notations.iter("articulations") for a in articulation_elem]
+                        pending.append((measure_start + start, duration, pitch, elem.findtext("staff", "1"),
+                                        elem.get("dynamics"), articulations))
+                    # end if
+                # end if
+
+            elif tag == "measure":
+                # Resolve the velocities (dynamics may follow a note in document order, e.g. after a <backup>)
+                for start, duration, pitch, staff, dynamics_attr, articulations in pending:
+                    dynamic = None
+                    for offset, scalar in dynamics.get(staff, ()):
+                        if offset > start:
+                            break
+                        dynamic = scalar
+                    # end for
+
+                    note = (start, duration, pitch, self._velocity(dynamics_attr, dynamic, articulations),
+                            part.channel, part.program, part.instrument_name)
+                    yield note if note_type is None else note_type(*note)
+                # end for
+                pending.clear()
+
+                if part.part_id == first_part_id:
+                    number = elem.get("number", "")
+                    self._measures.append((measure_start, int(number) if number.isdigit() else None))
+                # end if
+
+                measure_start += measure_length
+                position = measure_length = last_start = Fraction(0)
+                elem.clear()  # Keep the memory usage constant
+            # end if
+        # end for
+    # end def
+# end class
+
+
+def main():
+    # Conformance check: compares the notes of all MusicXML files in a directory with the music21 based extraction
+    import glob
+    import sys
+    import music21 as m21
+    from midi_test import MidiTestPlay
+
+    directory = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "notes")
+
+    def key(n):
+        return float(n.start), float(n.duration), n.pitch, round(n.velocity, 6), n.channel, n.instrument, n.instrument_name
+    # end def
+
+    n_failed = 0
+    for musicxml_file in sorted(glob.glob(os.path.join(directory, "*.musicxml"))):
+        xml_data = m21.converter.parse(musicxml_file)
+        reader = MusicXmlReader(musicxml_file)
+        expected = sorted(map(key, MidiTestPlay._xml_to_list(xml_data)))
+        actual = sorted(map(key, reader.notes(MidiTestPlay.Note)))
+        measures_ok = MidiTestPlay._xml_to_measures(xml_data) == [(float(offset), number) for offset, number in reader.measures]
+
+        ok = expected == actual and measures_ok
+        n_failed += not ok
+        print(f"{'OK    ' if ok else 'FAILED'} {os.path.basename(musicxml_file)} ({len(expected)} vs. {len(actual)} notes"
+              f"{'' if measures_ok else ', measures differ'})")
+        if not ok:
+            print(f"  only music21: {sorted(set(expected) - set(actual))[:5]}")
+            print(f"  only reader:  {sorted(set(actual) - set(expected))[:5]}")
+        # end if
+    # end for
+
+    sys.exit(1 if n_failed > 0 else 0)
+# end def
+
+
+if __name__ == "__main__":
+    main()
+# end if
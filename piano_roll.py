@@ -0,0 +1,145 @@
+import time
+import tkinter as tk
+from typing import Optional
+
+
+class FrameStats:
+    def __init__(self) -> None:
+        self.n_frames = 0  # Number of redraws
+        self.n_events = 0
+        self.n_coalesced = 0  # Number of events drawn together with other events in the same frame
+        self.n_dropped = 0  # Number of frames missed, because a frame came late (e.g. the Tk thread was busy)
+    # end def
+
+    def __repr__(self) -> str:
+        return f"FrameStats(n_frames={self.n_frames}, n_events={self.n_events}, n_coalesced={self.n_coalesced}, " \
+               f"n_dropped={self.n_dropped})"
+    # end def
+
+    def __str__(self) -> str:
+        return repr(self)
+    # end def
+# end class
+
+
+class PianoRoll(tk.Canvas):
+    # Keyboard with a piano roll above it: pressed keys are highlighted and each note draws a bar, which grows while
+    # the key is held and scrolls upwards. All canvas items are created once and reused (the bars from a pool, the
+    # oldest bar gets recycled when the pool is exhausted); note_on()/note_off() only record the changes, which get
+    # drawn at once by redraw(), so the canvas is updated at most once per frame no matter how many events arrive.
+
+    _BLACK_KEYS = (1, 3, 6, 8, 10)
+    _NOTE_NAMES = ["c", "c#", "d", "d#", "e", "f", "f#", "g", "g#", "a", "a#", "h"]
+
+    def __init__(self, master: tk.Misc, lowest: int = 21, highest: int = 108, key_width: int = 10,
+                 keyboard_height: int = 80, roll_height: int = 320, speed: float = 120., n_bars: int = 256) -> None:
+        super().__init__(master, width=(highest - lowest + 1) * key_width, height=roll_height + keyboard_height,
+                         background="black", highlightthickness=0)
+
+        self._lowest = lowest
+        self._highest = highest
+        self._key_width = key_width
+        self._roll_height = roll_height
+        self._speed = speed  # Pixels per second
+        # --
+        self._keys = dict()  # pitch -> canvas item
+        self._bars = list()  # Pool of canvas items
+        self._next_bar = 0
+        self._held_bars = dict()  # pitch -> canvas item of the bar growing while the key is held
+        self._pressed = set()
+        self._dirty_keys = set()  # Keys, whose state changed since the last frame
+        self._last_note = None
+        self._last_redraw = None
+
+        # Keys
+        for pitch in range(lowest, highest + 1):
+            x = (pitch - lowest) * key_width
+            self._keys[pitch] = self.create_rectangle(x, roll_height, x + key_width, roll_height + keyboard_height,
+                                                      fill=self._key_color(pitch, False), outline="gray")
+        # end for
+
+        # Bars (hidden until used) and the name of the last note played
+        for _ in range(n_bars):
+            self._bars.append(self.create_rectangle(0, 0, 0, 0, fill="", outline="", tags=("bar",)))
+        # end for
+        self._label = self.create_text((highest - lowest + 1) * key_width / 2, roll_height / 2, text="",
+                                       fill="gray30", font=("Arial", 120, ""))
+        self.tag_lower(self._label)
+    # end def
+
+    def _key_color(self, pitch: int, pressed: bool) -> str:
+        if pressed:
+            return "orange"
+
+        return "black" if pitch % 12 in self._BLACK_KEYS else "white"
+    # end def
+
+    @staticmethod
+    def _bar_color(velocity: int) -> str:
+        level = 80 + velocity  # The louder the brighter
+        return f"#{level:02x}{level // 2:02x}00"
+    # end def
+
+    def note_on(self, pitch: int, velocity: int) -> None:
+        self._last_note = pitch
+        if not self._lowest <= pitch <= self._highest:
+            return
+
+        self._note_off(pitch)
+        self._pressed.add(pitch)
+        self._dirty_keys.add(pitch)
+
+        # Reuse the oldest bar, starting with height 0 at the upper edge of the keyboard
+        bar = self._bars[self._next_bar]
+        self._next_bar = (self._next_bar + 1) % len(self._bars)
+        for held_pitch, held_bar in list(self._held_bars.items()):
+            if held_bar == bar:
+                del self._held_bars[held_pitch]
+            # end if
+        # end for
+
+        x = (pitch - self._lowest) * self._key_width
+        self.coords(bar, x + 1, self._roll_height, x + self._key_width - 1, self._roll_height)
+        self.itemconfigure(bar, fill=self._bar_color(velocity))
+        self._held_bars[pitch] = bar
+    # end def
+
+    def note_off(self, pitch: int) -> None:
+        if self._lowest <= pitch <= self._highest:
+            self._note_off(pitch)
+        # end if
+    # end def
+
+    def _note_off(self, pitch: int) -> None:
+        if pitch in self._pressed:
+            self._pressed.discard(pitch)
+            self._dirty_keys.add(pitch)
+        # end if
+        self._held_bars.pop(pitch, None)
+    # end def
+
+    def redraw(self, now: Optional[float] = None) -> None:
+        now = time.perf_counter() if now is None else now
+        dy = 0. if self._last_redraw is None else (now - self._last_redraw) * self._speed
+        self._last_redraw = now
+
+        # Scroll all bars at once, then stretch the held ones down to the keyboard again
+        if dy > 0:
+            self.move("bar", 0, -dy)
+        # end if
+        for bar in self._held_bars.values():
+            x0, y0, x1, _ = self.coords(bar)
+            self.coords(bar, x0, y0, x1, self._roll_height)
+        # end for
+
+        for pitch in self._dirty_keys:
+            self.itemconfigure(self._keys[pitch], fill=self._key_color(pitch, pitch in self._pressed))
+        # end for
+        self._dirty_keys.clear()
+
+        if self._last_note is not None:
+            self.itemconfigure(self._label, text=self._NOTE_NAMES[self._last_note % 12].upper())
+            self._last_note = None
+        # end if
+    # end def
+# end class
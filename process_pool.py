@@ -0,0 +1,47 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Iterator, Optional, Sequence, Tuple
+
+
+def imap_unordered(function: Callable[..., Any], jobs: Sequence[Tuple], n_workers: int) \
+        -> Iterator[Tuple[int, Any, Optional[Exception]]]:
+    # Calls function(*job) for each job in a pool of processes and yields (index of the job, result, None) as the jobs
+    # complete, or (index, None, exception) if the function raised an exception.
+    # A worker process that crashes (e.g. a segfault or running out of memory) breaks the pool, which fails all jobs
+    # that didn't complete yet with BrokenProcessPool. These are run again in a new pool. If a pool breaks before any
+    # job completed, the remaining jobs are run one per pool, so only the job crashing its worker is yielded with the
+    # BrokenProcessPool exception.
+    remaining = list(range(len(jobs)))
+    isolate = False
+    while len(remaining) > 0:
+        unfinished = list()
+        n_completed = 0
+        for batch in ([[index] for index in remaining] if isolate else [remaining]):
+            with ProcessPoolExecutor(max_workers=max(min(n_workers, len(batch)), 1)) as executor:
+                futures = {executor.submit(function, *jobs[index]): index for index in batch}
+                for future in as_completed(futures):
+                    index = futures[future]
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool as e:
+                        if isolate:
+                            yield index, None, e
+                        else:
+                            unfinished.append(index)
+                        # end if
+                        continue
+                    except Exception as e:
+                        n_completed += 1
+                        yield index, None, e
+                        continue
+                    # end try
+                    n_completed += 1
+                    yield index, result, None
+                # end for
+            # end with
+        # end for
+
+        remaining = sorted(unfinished)
+        isolate = n_completed == 0
+    # end while
+# end def
@@ -0,0 +1,298 @@
+from __future__ import annotations
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+
+# Columnar representation of a score's notes and of the resulting ON/OFF toggles.
+# Missing values are stored as -1 (channel, program, instrument name index).
+NOTE_DTYPE = np.dtype([("start", "<f8"), ("duration", "<f8"), ("velocity", "<f8"),
+                       ("program", "<i2"), ("name", "<i2"), ("pitch", "u1"), ("channel", "i1")])
+TOGGLE_DTYPE = np.dtype([("time", "<f8"), ("velocity", "<f8"),
+                         ("program", "<i2"), ("name", "<i2"), ("state", "u1"), ("pitch", "u1"), ("channel", "i1"), ("pad", "u1")])
+TEMPO_DTYPE = np.dtype([("offset", "<f8"), ("qpm", "<f8")])  # Offset in quarter lengths, quarter notes per minute
+MEASURE_DTYPE = np.dtype([("offset", "<f8"), ("number", "<i4")])  # Start of each measure (of the first part), -1 if the number isn't numeric
+
+# Values of the state column (same as MidiTestPlay.NoteState)
+STATE_ON = 1
+STATE_OFF = 2
+
+
+class TempoMap:
+    # Maps offsets (in quarter lengths) to seconds, taking the tempo changes of a score into account. Before the first
+    # tempo change the default tempo is used. The mapping is piecewise linear, the seconds at the start of each
+    # segment are accumulated once, so mapping all toggles is a single vectorized lookup.
+
+    def __init__(self, tempos: Optional[np.ndarray] = None, default_qpm: float = 120., tempo_scale: float = 1.) -> None:
+        tempos = tempos if tempos is not None else np.zeros(0, dtype=TEMPO_DTYPE)
+
+        self._offsets = np.concatenate(([0.], tempos["offset"]))
+        self._qpm = np.concatenate(([default_qpm], tempos["qpm"])) * tempo_scale
+        self._seconds_per_quarter = 60. / self._qpm
+        self._segment_seconds = np.concatenate(([0.], np.cumsum(np.diff(self._offsets) * self._seconds_per_quarter[:-1])))
+    # end def
+
+    @staticmethod
+    def tempos_from_events(events: Iterable[Tuple[float, float]]) -> np.ndarray:
+        # Takes (offset, qpm) tuples in any order (e.g. the same tempo marks repeated in every part) and returns the
+        # sorted tempo changes. If there are several tempos at the same offset, the last one wins.
+        tempos = np.array([(float(offset), float(qpm)) for offset, qpm in events], dtype=TEMPO_DTYPE)
+        tempos = tempos[np.argsort(tempos["offset"], kind="stable")]
+
+        is_last = np.append(tempos["offset"][1:] != tempos["offset"][:-1], True) if len(tempos) > 0 else np.zeros(0, dtype=bool)
+
+        return tempos[is_last]
+    # end def
+
+    def seconds(self, offsets: np.ndarray) -> np.ndarray:
+        segment = np.maximum(np.searchsorted(self._offsets, offsets, side="right") - 1, 0)
+
+        return self._segment_seconds[segment] + (offsets - self._offsets[segment]) * self._seconds_per_quarter[segment]
+    # end def
+
+    def offsets(self, seconds: np.ndarray) -> np.ndarray:
+        # Inverse of seconds()
+        segment = np.maximum(np.searchsorted(self._segment_seconds, seconds, side="right") - 1, 0)
+
+        return self._offsets[segment] + (seconds - self._segment_seconds[segment]) / self._seconds_per_quarter[segment]
+    # end def
+# end class
+
+
+class Score:
+    # Notes of a score, stored in a NumPy structured array (see NOTE_DTYPE), the score's tempo changes (see
+    # TEMPO_DTYPE) and its measures (see MEASURE_DTYPE). All transformations are vectorized and return a new Score,
+    # the instrument names are shared.
+
+    def __init__(self, notes: np.ndarray, instrument_names: List[str], tempos: Optional[np.ndarray] = None,
+                 measures: Optional[np.ndarray] = None) -> None:
+        self._notes = notes
+        self._instrument_names = instrument_names
+        self._tempos = tempos if tempos is not None else np.zeros(0, dtype=TEMPO_DTYPE)
+        self._measures = measures if measures is not None else np.zeros(0, dtype=MEASURE_DTYPE)
+    # end def
+
+    def __len__(self) -> int:
+        return len(self._notes)
+    # end def
+
+    def __repr__(self) -> str:
+        return f"Score(notes={len(self._notes)}, instrument_names={self._instrument_names})"
+    # end def
+
+    def __str__(self) -> str:
+        return repr(self)
+    # end def
+
+    @property
+    def notes(self) -> np.ndarray:
+        return self._notes
+    # end def
+
+    @property
+    def instrument_names(self) -> List[str]:
+        return self._instrument_names
+    # end def
+
+    @property
+    def tempos(self) -> np.ndarray:
+        return self._tempos
+    # end def
+
+    @property
+    def measures(self) -> np.ndarray:
+        return self._measures
+    # end def
+
+    @classmethod
+    def from_notes(cls, notes: Iterable[Tuple], tempos: Iterable[Tuple[float, float]] = (),
+                   measures: Iterable[Tuple[float, Optional[int]]] = ()) -> Score:
+        # Takes (start, duration, pitch, velocity, channel, instrument, instrument_name) tuples, (offset, qpm) tuples
+        # and (offset, number) tuples
+        instrument_names = list()
+        name_indices = dict()
+
+        def name_index(name: Optional[str]) -> int:
+            if name is None:
+                return -1
+
+            index = name_indices.get(name)
+            if index is None:
+                index = name_indices[name] = len(instrument_names)
+                instrument_names.append(name)
+            # end if
+
+            return index
+        # end def
+
+        records = [(float(start), float(duration), velocity, -1 if instrument is None else instrument,
+                    name_index(instrument_name), pitch, -1 if channel is None else channel)
+                   for start, duration, pitch, velocity, channel, instrument, instrument_name in notes]
+
+        return cls(np.array(records, dtype=NOTE_DTYPE), instrument_names, TempoMap.tempos_from_events(tempos),
+                   np.array([(float(offset), -1 if number is None else number) for offset, number in measures], dtype=MEASURE_DTYPE))
+    # end def
+
+    def _replace(self, **columns: np.ndarray) -> Score:
+        notes = self._notes.copy()
+        for name, values in columns.items():
+            notes[name] = values
+        # end for
+
+        return Score(notes, self._instrument_names, self._tempos.copy(), self._measures.copy())
+    # end def
+
+    def sorted(self) -> Score:
+        # Stable, so notes with the same start keep their order
+        return Score(self._notes[np.argsort(self._notes["start"], kind="stable")], self._instrument_names, self._tempos,
+                     self._measures)
+    # end def
+
+    def scale_tempo(self, factor: float) -> Score:
+        # factor > 1 plays faster
+        score = self._replace(start=self._notes["start"] / factor, duration=self._notes["duration"] / factor)
+        score.tempos["offset"] /= factor
+        score.measures["offset"] /= factor
+
+        return score
+    # end def
+
+    def transpose(self, semitones: int) -> Score:
+        return self._replace(pitch=np.clip(self._notes["pitch"].astype(np.int16) + semitones, 0, 127))
+    # end def
+
+    def scale_velocity(self, factor: float) -> Score:
+        return self._replace(velocity=np.clip(self._notes["velocity"] * factor, 0., 1.))
+    # end def
+
+    def remap_channels(self, mapping: Dict[int, int]) -> Score:
+        lut = np.arange(16, dtype=np.int8)
+        for src, dst in mapping.items():
+            lut[src] = dst
+        # end for
+
+        channel = self._notes["channel"]
+
+        return self._replace(channel=np.where(channel >= 0, lut[np.clip(channel, 0, 15)], channel))
+    # end def
+
+    def toggles(self) -> np.ndarray:
+        # Creates an ON and an OFF toggle for each note and sorts them by time (OFF before ON at the same time)
+        notes = self.sorted().notes
+        toggles = np.zeros(2 * len(notes), dtype=TOGGLE_DTYPE)
+
+        for name in ("velocity", "program", "name", "pitch", "channel"):
+            toggles[name][0::2] = notes[name]
+            toggles[name][1::2] = notes[name]
+        # end for
+        toggles["time"][0::2] = notes["start"]
+        toggles["time"][1::2] = notes["start"] + notes["duration"]
+        toggles["state"][0::2] = STATE_ON
+        toggles["state"][1::2] = STATE_OFF
+
+        return toggles[np.lexsort((toggles["state"] == STATE_ON, toggles["time"]))]
+    # end def
+# end class
+
+
+class CompiledScore:
+    # Everything needed for playback, as stored in the score cache: the sorted toggles (see TOGGLE_DTYPE), the
+    # instrument names referenced by the toggles, the tempo changes (see TEMPO_DTYPE) and the measures (see
+    # MEASURE_DTYPE), which index the toggles for seeking.
+
+    def __init__(self, toggles: np.ndarray, instrument_names: List[str], tempos: np.ndarray,
+                 measures: Optional[np.ndarray] = None) -> None:
+        self._toggles = toggles
+        self._instrument_names = instrument_names
+        self._tempos = tempos
+        self._measures = measures if measures is not None else np.zeros(0, dtype=MEASURE_DTYPE)
+        # Measure number -> index of its first and its last occurrence (e.g. of written out repeats)
+        self._measure_index = dict()
+        for index, number in enumerate(self._measures["number"].tolist()):
+            self._measure_index[number] = (self._measure_index.get(number, (index,))[0], index)
+        # end for
+    # end def
+
+    @classmethod
+    def from_score(cls, score: Score) -> CompiledScore:
+        return cls(score.toggles(), score.instrument_names, score.tempos, score.measures)
+    # end def
+
+    @property
+    def toggles(self) -> np.ndarray:
+        return self._toggles
+    # end def
+
+    @property
+    def instrument_names(self) -> List[str]:
+        return self._instrument_names
+    # end def
+
+    @property
+    def tempos(self) -> np.ndarray:
+        return self._tempos
+    # end def
+
+    @property
+    def measures(self) -> np.ndarray:
+        return self._measures
+    # end def
+
+    def measure_offset(self, number: int, end: bool = False) -> float:
+        # Offset of the start (or the end) of the measure with the given number. If the number appears several times
+        # (e.g. written out repeats), the first one is used for the start and the last one for the end.
+        if number not in self._measure_index:
+            raise ValueError(f"There is no measure {number}.")
+        # end if
+        first, last = self._measure_index[number]
+
+        if not end:
+            return float(self._measures["offset"][first])
+        # end if
+        if last + 1 < len(self._measures):
+            return float(self._measures["offset"][last + 1])
+        # end if
+
+        return float(self._toggles["time"][-1]) if len(self._toggles) > 0 else float(self._measures["offset"][last])
+    # end def
+
+    def seek(self, offset: float) -> Tuple[int, Dict[int, int], List[Tuple[int, int, float]]]:
+        # Returns the index of the first toggle to play when starting at offset (found by binary search) and the state
+        # at that point: the program of each channel (channel -> program) and the notes still sounding
+        # ([(channel, pitch, velocity)]), which need to be sent before continuing with the toggle.
+        # Notes ending exactly at offset aren't sounding anymore, so their OFF toggles are skipped.
+        toggles = self._toggles
+        index = int(np.searchsorted(toggles["time"], offset, side="left"))
+        while index < len(toggles) and toggles["time"][index] == offset and toggles["state"][index] == STATE_OFF:
+            index += 1
+        # end while
+
+        # Program of each channel: the last one set before offset, or the first one if the channel starts later
+        programs = self.initial_programs()
+        played = toggles[:index]
+        played = played[(played["channel"] >= 0) & (played["program"] >= 0)]
+        channels, last = np.unique(played["channel"][::-1], return_index=True)
+        programs.update(zip(channels.tolist(), played["program"][::-1][last].tolist()))
+
+        # Sounding notes: more ONs than OFFs per channel and pitch, with the velocity of the last ON
+        played = toggles[:index]
+        keys = np.maximum(played["channel"], 0).astype(np.int32) * 128 + played["pitch"]
+        balance = np.bincount(keys, weights=np.where(played["state"] == STATE_ON, 1, -1), minlength=16 * 128)
+        ons = played[played["state"] == STATE_ON]
+        on_keys, last = np.unique((np.maximum(ons["channel"], 0).astype(np.int32) * 128 + ons["pitch"])[::-1], return_index=True)
+        velocities = dict(zip(on_keys.tolist(), ons["velocity"][::-1][last].tolist()))
+        sounding = [(key // 128, key % 128, velocities[key]) for key in np.flatnonzero(balance > 0).tolist()]
+
+        return index, programs, sounding
+    # end def
+
+    def initial_programs(self) -> Dict[int, int]:
+        # Program of each channel at its first note (channel -> program)
+        toggles = self._toggles[(self._toggles["channel"] >= 0) & (self._toggles["program"] >= 0)]
+        channels, first = np.unique(toggles["channel"], return_index=True)
+
+        return dict(zip(channels.tolist(), toggles["program"][first].tolist()))
+    # end def
+
+    def tempo_map(self, default_qpm: float = 120., tempo_scale: float = 1., use_score_tempo: bool = True) -> TempoMap:
+        return TempoMap(self._tempos if use_score_tempo else None, default_qpm, tempo_scale)
+    # end def
+# end class
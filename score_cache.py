@@ -0,0 +1,186 @@
+import hashlib
+import os
+import struct
+import tempfile
+from typing import Optional
+import numpy as np
+
+from score import CompiledScore, MEASURE_DTYPE, TEMPO_DTYPE, TOGGLE_DTYPE
+
+
+class ScoreCache:
+    # On-disk cache of compiled scores (the flattened and sorted list of note toggles).
+    # Entries are keyed by the content hash of the score file and the version of the parser that created them,
+    # so changing either one automatically invalidates the entry. The directory is bounded in size; the least recently
+    # used entries (by file modification time, which gets updated on every hit) are evicted first.
+    #
+    # File layout (little endian):
+    # * header: magic, format version, number of toggles, number of tempo changes, number of measures, number of
+    #   instrument names
+    # * toggles: array of TOGGLE_DTYPE records, which gets memory-mapped when loading
+    # * tempo changes: array of TEMPO_DTYPE records
+    # * measures: array of MEASURE_DTYPE records
+    # * instrument names: length-prefixed UTF-8 strings
+    _MAGIC = b"GNYC"
+    _FORMAT_VERSION = 4
+    _HEADER = struct.Struct("<4sHIIII")
+    _NAME_LENGTH = struct.Struct("<H")
+    _FILE_EXTENSION = ".gnyc"
+
+    def __init__(self, cache_dir: Optional[str] = None, max_size: int = 256 * 1024 * 1024, parser_version: str = "1") -> None:
+        self._cache_dir = cache_dir if cache_dir is not None else self.default_cache_dir()
+        self._max_size = max_size
+        self._parser_version = parser_version
+    # end def
+
+    @staticmethod
+    def default_cache_dir() -> str:
+        return os.environ.get("GIMME_NOTES_YA_CACHE_DIR",
+                              os.path.join(os.path.expanduser("~"), ".cache", "gimme_notes_ya"))
+    # end def
+
+    @property
+    def cache_dir(self) -> str:
+        return self._cache_dir
+    # end def
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size
+    # end def
+
+    def key(self, score_file: str) -> str:
+        h = hashlib.sha256()
+        h.update(f"{self._FORMAT_VERSION}:{self._parser_version}:".encode())
+        with open(score_file, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+            # end for
+        # end with
+
+        return h.hexdigest()
+    # end def
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self._cache_dir, key + self._FILE_EXTENSION)
+    # end def
+
+    def load(self, score_file: str) -> Optional[CompiledScore]:
+        path = self._entry_path(self.key(score_file))
+
+        try:
+            entry = self._decode(path)
+        except (OSError, ValueError, struct.error):
+            return None
+        # end try
+
+        # Mark the entry as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        # end try
+
+        return entry
+    # end def
+
+    def store(self, score_file: str, compiled_score: CompiledScore) -> None:
+        os.makedirs(self._cache_dir, exist_ok=True)
+        path = self._entry_path(self.key(score_file))
+
+        # Write to a temporary file first, so a concurrent reader never sees a partially written entry
+        fd, tmp_path = tempfile.mkstemp(dir=self._cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(self._encode(compiled_score))
+            # end with
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        # end try
+
+        self.evict()
+    # end def
+
+    def invalidate(self, score_file: str) -> None:
+        try:
+            os.unlink(self._entry_path(self.key(score_file)))
+        except FileNotFoundError:
+            pass
+        # end try
+    # end def
+
+    def evict(self) -> None:
+        # Remove the least recently used entries until the cache fits into its size limit
+        entries = list()
+        total_size = 0
+        for entry in os.scandir(self._cache_dir):
+            if entry.is_file() and entry.name.endswith(self._FILE_EXTENSION):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+            # end if
+        # end for
+
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self._max_size:
+                break
+            # end if
+
+            try:
+                os.unlink(path)
+                total_size -= size
+            except OSError:
+                pass
+            # end try
+        # end for
+    # end def
+
+    def _encode(self, compiled_score: CompiledScore) -> bytes:
+        toggles = np.ascontiguousarray(compiled_score.toggles, dtype=TOGGLE_DTYPE)
+        tempos = np.ascontiguousarray(compiled_score.tempos, dtype=TEMPO_DTYPE)
+        measures = np.ascontiguousarray(compiled_score.measures, dtype=MEASURE_DTYPE)
+        instrument_names = compiled_score.instrument_names
+
+        data = bytearray(self._HEADER.pack(self._MAGIC, self._FORMAT_VERSION, len(toggles), len(tempos), len(measures),
+                                           len(instrument_names)))
+        data += toggles.tobytes()
+        data += tempos.tobytes()
+        data += measures.tobytes()
+        for name in instrument_names:
+            name = name.encode()
+            data += self._NAME_LENGTH.pack(len(name)) + name
+        # end for
+
+        return bytes(data)
+    # end def
+
+    def _decode(self, path: str) -> CompiledScore:
+        toggles_start = self._HEADER.size
+
+        with open(path, "rb") as f:
+            magic, version, n_toggles, n_tempos, n_measures, n_names = self._HEADER.unpack(f.read(self._HEADER.size))
+            if magic != self._MAGIC or version != self._FORMAT_VERSION:
+                raise ValueError("Unsupported cache entry.")
+            # end if
+
+            f.seek(toggles_start + n_toggles * TOGGLE_DTYPE.itemsize)
+            tempos = np.frombuffer(f.read(n_tempos * TEMPO_DTYPE.itemsize), dtype=TEMPO_DTYPE)
+            measures = np.frombuffer(f.read(n_measures * MEASURE_DTYPE.itemsize), dtype=MEASURE_DTYPE)
+
+            instrument_names = list()
+            for _ in range(n_names):
+                length, = self._NAME_LENGTH.unpack(f.read(self._NAME_LENGTH.size))
+                instrument_names.append(f.read(length).decode())
+            # end for
+        # end with
+
+        # The toggles are not read but mapped into memory
+        toggles = np.memmap(path, dtype=TOGGLE_DTYPE, mode="r", offset=toggles_start, shape=(n_toggles,)) \
+            if n_toggles > 0 else np.zeros(0, dtype=TOGGLE_DTYPE)
+
+        return CompiledScore(toggles, instrument_names, tempos, measures)
+    # end def
+# end class
@@ -0,0 +1,300 @@
+import hashlib
+import os
+import sqlite3
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional, Tuple
+
+from musicxml_reader import musicxml_source
+from process_pool import imap_unordered
+from score_cache import ScoreCache
+
+# Tempo until the first tempo mark, used for the durations (MusicXML's default)
+DEFAULT_QPM = 120.
+
+
+class ScanStats:
+    def __init__(self) -> None:
+        self.n_files = 0
+        self.n_unchanged = 0  # Same modification time and size
+        self.n_rehashed = 0  # Modified or moved, but with a known content
+        self.n_indexed = 0  # Parsed
+        self.n_failed = 0
+        self.n_removed = 0  # Entries of files that don't exist anymore
+        self.seconds = 0.
+    # end def
+
+    def __repr__(self) -> str:
+        return f"ScanStats(n_files={self.n_files}, n_unchanged={self.n_unchanged}, n_rehashed={self.n_rehashed}, " \
+               f"n_indexed={self.n_indexed}, n_failed={self.n_failed}, n_removed={self.n_removed}, " \
+               f"seconds={self.seconds:.3f})"
+    # end def
+
+    def __str__(self) -> str:
+        return repr(self)
+    # end def
+# end class
+
+
+def read_header(path: str) -> Tuple[Optional[str], Optional[str], int]:
+    # Title, composer and number of parts of a MusicXML file, read from its header only (up to the first part)
+    titles = dict()
+    composer = None
+    n_parts = 0
+    for event, elem in ET.iterparse(musicxml_source(path), events=("start", "end")):
+        if event == "start":
+            if elem.tag == "part":
+                break
+            # end if
+            continue
+        # end if
+
+        if elem.tag in ("work-title", "movement-title") and elem.text is not None:
+            titles.setdefault(elem.tag, elem.text.strip())
+        elif elem.tag == "creator" and elem.get("type") == "composer" and elem.text is not None:
+            composer = composer or elem.text.strip()
+        elif elem.tag == "score-part":
+            n_parts += 1
+        # end if
+    # end for
+
+    return titles.get("work-title", titles.get("movement-title")), composer, n_parts
+# end def
+
+
+def file_hash(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+        # end for
+    # end with
+
+    return h.hexdigest()
+# end def
+
+
+def extract(path: str, parser: str = "music21") -> Dict[str, Any]:
+    # Runs in a worker process: parses the score the same way play does (see MidiTestPlay.parse_score) and returns the
+    # columns of its entry and its instruments [(name, program, channel, number of notes)]
+    import numpy as np
+    from midi_test import MidiTestPlay
+    from score import TempoMap
+
+    title, composer, n_parts = read_header(path)
+    score = MidiTestPlay.parse_score(path, parser)
+    notes = score.notes
+    quarter_length = float(np.max(notes["start"] + notes["duration"])) if len(notes) > 0 else 0.
+    tempos = score.tempos
+
+    instruments = dict()  # (name, program, channel) -> number of notes
+    names = score.instrument_names + [None]  # Index -1: no instrument name
+    for name, program, channel in zip(notes["name"].tolist(), notes["program"].tolist(), notes["channel"].tolist()):
+        key = (names[name], None if program < 0 else program, None if channel < 0 else channel)
+        instruments[key] = instruments.get(key, 0) + 1
+    # end for
+
+    return {"title": title, "composer": composer, "n_parts": n_parts, "n_notes": len(notes),
+            "quarter_length": quarter_length,
+            "duration": float(TempoMap(tempos, DEFAULT_QPM).seconds(np.array([quarter_length]))[0]),
+            "qpm": float(tempos["qpm"][0]) if len(tempos) > 0 else None,
+            "instruments": [key + (n_notes,) for key, n_notes in instruments.items()]}
+# end def
+
+
+class ScoreLibrary:
+    # Persistent index (SQLite) of the scores in one or more directories: title, composer, number of parts, notes,
+    # length and tempo of each score and the instruments (name, program, channel) it uses, so scores can be listed and
+    # searched without parsing them.
+    # Rescans are incremental: files with the same modification time and size are skipped without being read, the
+    # others are hashed (in parallel threads) and only parsed (in parallel processes) if their content is unknown,
+    # so touched, moved or copied files are picked up without parsing them again. Files that can't be parsed are
+    # remembered with their error until they change (not the ones crashing the worker process, which might have been
+    # caused by something else, e.g. running out of memory). The entries depend on the parser and its version
+    # (extractor); changing either one reindexes the files.
+    _SCHEMA_VERSION = 1
+    _COMMIT_INTERVAL = 50  # Number of parsed files per transaction
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self._path = path if path is not None else self.default_path()
+        os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+        self._db = sqlite3.connect(self._path)
+        self._create_schema()
+    # end def
+
+    @staticmethod
+    def default_path() -> str:
+        return os.path.join(ScoreCache.default_cache_dir(), "library.sqlite")
+    # end def
+
+    @property
+    def path(self) -> str:
+        return self._path
+    # end def
+
+    def close(self) -> None:
+        self._db.close()
+    # end def
+
+    def _create_schema(self) -> None:
+        if self._db.execute("PRAGMA user_version").fetchone()[0] != self._SCHEMA_VERSION:
+            self._db.executescript("DROP TABLE IF EXISTS scores; DROP TABLE IF EXISTS instruments;")
+        # end if
+        self._db.executescript(f"""
+            CREATE TABLE IF NOT EXISTS scores (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, hash TEXT,
+                extractor TEXT, error TEXT, title TEXT, composer TEXT, n_parts INTEGER, n_notes INTEGER,
+                quarter_length REAL, duration REAL, qpm REAL);
+            CREATE INDEX IF NOT EXISTS scores_hash ON scores (hash, extractor);
+            CREATE TABLE IF NOT EXISTS instruments (path TEXT, name TEXT, program INTEGER, channel INTEGER,
+                n_notes INTEGER);
+            CREATE INDEX IF NOT EXISTS instruments_path ON instruments (path);
+            PRAGMA user_version = {self._SCHEMA_VERSION};
+        """)
+    # end def
+
+    def _store(self, path: str, mtime: float, size: int, hash_: str, extractor: str, entry: Dict[str, Any],
+               error: Optional[str] = None) -> None:
+        self._db.execute("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (path, mtime, size, hash_, extractor, error, entry.get("title"), entry.get("composer"),
+                          entry.get("n_parts"), entry.get("n_notes"), entry.get("quarter_length"),
+                          entry.get("duration"), entry.get("qpm")))
+        self._db.execute("DELETE FROM instruments WHERE path = ?", (path,))
+        self._db.executemany("INSERT INTO instruments VALUES (?, ?, ?, ?, ?)",
+                             [(path,) + tuple(instrument) for instrument in entry.get("instruments", list())])
+    # end def
+
+    def _copy(self, path: str, mtime: float, size: int, source: str) -> None:
+        # Entry of a file with the same content as source (e.g. moved or copied)
+        self._db.execute("INSERT OR REPLACE INTO scores SELECT ?, ?, ?, hash, extractor, error, title, composer, "
+                         "n_parts, n_notes, quarter_length, duration, qpm FROM scores WHERE path = ?",
+                         (path, mtime, size, source))
+        if path != source:
+            self._db.execute("DELETE FROM instruments WHERE path = ?", (path,))
+            self._db.execute("INSERT INTO instruments SELECT ?, name, program, channel, n_notes FROM instruments "
+                             "WHERE path = ?", (path, source))
+        # end if
+    # end def
+
+    def scan(self, directory: str, extensions: Tuple[str, ...], parser: str = "music21", parser_version: int = 0,
+             n_jobs: int = 0) -> Tuple[ScanStats, List[Tuple[str, str]]]:
+        # Updates the entries of all score files in the directory (recursively). Returns the statistics and the files
+        # that couldn't be parsed [(path, error)].
+        stats = ScanStats()
+        start_time = time.perf_counter()
+        extractor = f"{parser}:{parser_version}"
+        n_jobs = n_jobs if n_jobs > 0 else os.cpu_count()
+        directory = os.path.abspath(directory)
+
+        files = dict()  # path -> (mtime, size)
+        for root, _, names in os.walk(directory):
+            for name in names:
+                if os.path.splitext(name)[1].lower() in extensions:
+                    path = os.path.join(root, name)
+                    st = os.stat(path)
+                    files[path] = (st.st_mtime, st.st_size)
+                # end if
+            # end for
+        # end for
+        stats.n_files = len(files)
+
+        # Entries of the directory (including the ones of files that don't exist anymore)
+        prefix = os.path.join(directory, "")
+        known = {path: (mtime, size, extractor_) for path, mtime, size, extractor_ in
+                 self._db.execute("SELECT path, mtime, size, extractor FROM scores WHERE substr(path, 1, ?) = ?",
+                                  (len(prefix), prefix))}
+        removed = [(path,) for path in known if path not in files]  # Deleted at the end, as moved files copy them
+
+        changed = sorted(path for path, (mtime, size) in files.items() if known.get(path) != (mtime, size, extractor))
+        stats.n_unchanged = stats.n_files - len(changed)
+
+        # The content of changed files might be known already (touched, moved or copied)
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            hashes = dict(zip(changed, executor.map(file_hash, changed)))
+        # end with
+        pending = dict()  # hash -> paths, files with the same content are only parsed once
+        for path in changed:
+            source = self._db.execute("SELECT path FROM scores WHERE hash = ? AND extractor = ? LIMIT 1",
+                                      (hashes[path], extractor)).fetchone()
+            if source is not None:
+                self._copy(path, *files[path], source[0])
+                stats.n_rehashed += 1
+            else:
+                pending.setdefault(hashes[path], list()).append(path)
+            # end if
+        # end for
+        self._db.commit()
+
+        failures = list()
+        jobs = list(pending.values())
+        for n, (index, entry, e) in enumerate(imap_unordered(extract, [(paths[0], parser) for paths in jobs], n_jobs), 1):
+            path, *copies = jobs[index]
+            if e is None:
+                self._store(path, *files[path], hashes[path], extractor, entry)
+                stats.n_indexed += 1
+            elif isinstance(e, BrokenProcessPool):
+                # Neither the file nor its copies are stored, so they get parsed again by the next scan
+                failures.append((path, f"worker process crashed ({type(e).__name__})"))
+                stats.n_failed += 1
+                continue
+            else:
+                error = f"{type(e).__name__}: {e}"
+                self._store(path, *files[path], hashes[path], extractor, dict(), error)
+                failures.append((path, error))
+                stats.n_failed += 1
+            # end if
+            for copy in copies:
+                self._copy(copy, *files[copy], path)
+                stats.n_rehashed += 1
+            # end for
+            if n % self._COMMIT_INTERVAL == 0:
+                self._db.commit()
+            # end if
+        # end for
+        self._db.executemany("DELETE FROM scores WHERE path = ?", removed)
+        self._db.executemany("DELETE FROM instruments WHERE path = ?", removed)
+        self._db.commit()
+        stats.n_removed = len(removed)
+        stats.seconds = time.perf_counter() - start_time
+
+        return stats, failures
+    # end def
+
+    def search(self, text: Optional[str] = None, directory: Optional[str] = None) -> List[Dict[str, Any]]:
+        # Entries (sorted by title) whose title, composer, path or one of whose instrument names contains text
+        # (case-insensitive), all entries without text. Each entry includes its instruments.
+        conditions = ["error IS NULL"]
+        parameters = list()
+        if directory is not None:
+            prefix = os.path.join(os.path.abspath(directory), "")
+            conditions.append("substr(path, 1, ?) = ?")
+            parameters += [len(prefix), prefix]
+        # end if
+        if text is not None:
+            # The text is matched literally, not as a pattern
+            pattern = "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            conditions.append("(title LIKE ? ESCAPE '\\' OR composer LIKE ? ESCAPE '\\' OR path LIKE ? ESCAPE '\\' OR "
+                              "path IN (SELECT path FROM instruments WHERE name LIKE ? ESCAPE '\\'))")
+            parameters += [pattern] * 4
+        # end if
+
+        where = " AND ".join(conditions)
+        cursor = self._db.execute("SELECT path, title, composer, n_parts, n_notes, quarter_length, duration, qpm "
+                                  f"FROM scores WHERE {where} ORDER BY title COLLATE NOCASE, path", parameters)
+        columns = [column[0] for column in cursor.description]
+        entries = [dict(zip(columns, row)) for row in cursor]
+
+        instruments = dict()  # path -> [(name, program, channel, n_notes)]
+        for path, *instrument in self._db.execute("SELECT path, name, program, channel, n_notes FROM instruments "
+                                                  f"WHERE path IN (SELECT path FROM scores WHERE {where}) "
+                                                  "ORDER BY path, n_notes DESC", parameters):
+            instruments.setdefault(path, list()).append(tuple(instrument))
+        # end for
+        for entry in entries:
+            entry["instruments"] = instruments.get(entry["path"], list())
+        # end for
+
+        return entries
+    # end def
+# end class
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The modules live in the repository's root directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "1"
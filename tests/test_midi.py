@@ -0,0 +1,313 @@
+import threading
+import time
+
+import pytest
+
+from midi import EventQueue, MessageFilter, MessageType, Midi, MidiDeviceType, MidiEvent, OverflowPolicy
+from midi_backend import LoopbackBackend, LoopbackPort
+
+
+def note(pitch: int, device_id: int = 0) -> MidiEvent:
+    return MidiEvent(0x90, pitch, 100, 0, 0, device_id)
+# end def
+
+
+def cc(controller: int, value: int, device_id: int = 0) -> MidiEvent:
+    return MidiEvent(0xb0, controller, value, 0, 0, device_id)
+# end def
+
+
+def messages(events):
+    return [(event.status, event.data1, event.data2) for event in events]
+# end def
+
+
+def put_in_thread(queue: EventQueue, events) -> threading.Thread:
+    thread = threading.Thread(target=queue.put_batch, args=(events,), daemon=True)
+    thread.start()
+    thread.join(0.1)  # Blocked by now
+
+    return thread
+# end def
+
+
+def test_drop_oldest():
+    queue = EventQueue(4, OverflowPolicy.DROP_OLDEST)
+    queue.put_batch([note(pitch) for pitch in range(6)])
+
+    assert [event.data1 for event in queue.get_batch(timeout=0)] == [2, 3, 4, 5]
+    assert (queue.n_events, queue.n_dropped, queue.max_size) == (6, 2, 4)
+    # The drained slots don't keep the events alive
+    assert queue._buffer == [None] * 4
+# end def
+
+
+def test_coalesce():
+    queue = EventQueue(4, OverflowPolicy.COALESCE)
+    queue.put_batch([cc(7, 1), cc(7, 2, device_id=1), note(60), cc(10, 1)])
+    # Full: a controller that is pending replaces the pending value in place, the same controller of another device
+    # and other messages don't
+    queue.put_batch([cc(7, 3), cc(10, 2), cc(7, 4, device_id=1)])
+
+    assert messages(queue.get_batch(timeout=0)) == [(0xb0, 7, 3), (0xb0, 7, 4), (0x90, 60, 100), (0xb0, 10, 2)]
+    assert (queue.n_coalesced, queue.n_dropped) == (3, 0)
+
+    # A value that was already taken by the consumer isn't replaced
+    queue.put_batch([cc(7, 5), note(61), note(62), note(63)])
+    queue.get_batch(timeout=0)
+    queue.put_batch([note(64), note(65), note(66), note(67), cc(7, 6)])
+    assert messages(queue.get_batch(timeout=0)) == [(0x90, 65, 100), (0x90, 66, 100), (0x90, 67, 100), (0xb0, 7, 6)]
+    assert (queue.n_coalesced, queue.n_dropped) == (3, 1)
+# end def
+
+
+def test_block():
+    queue = EventQueue(2, OverflowPolicy.BLOCK)
+    producer = put_in_thread(queue, [note(pitch) for pitch in range(4)])
+    assert producer.is_alive() and len(queue) == 2
+
+    received = queue.get_batch(timeout=1.)
+    producer.join(1.)
+    received += queue.get_batch(timeout=1.)
+
+    assert not producer.is_alive()
+    assert [event.data1 for event in received] == [0, 1, 2, 3]
+    assert queue.n_dropped == 0
+# end def
+
+
+def test_block_wakes_all_producers():
+    # Several inputs sharing one queue: draining it lets all of them continue
+    queue = EventQueue(2, OverflowPolicy.BLOCK)
+    queue.put_batch([note(0), note(1)])
+    producers = [put_in_thread(queue, [note(pitch, device_id=pitch)]) for pitch in (2, 3)]
+    assert all(producer.is_alive() for producer in producers)
+
+    queue.get_batch(timeout=0)
+    for producer in producers:
+        producer.join(1.)
+    # end for
+
+    assert not any(producer.is_alive() for producer in producers)
+    assert sorted(event.data1 for event in queue.get_batch(timeout=0)) == [2, 3]
+# end def
+
+
+def test_close_releases_blocked_producer():
+    queue = EventQueue(1, OverflowPolicy.BLOCK)
+    producer = put_in_thread(queue, [note(0), note(1)])
+    assert producer.is_alive()
+
+    queue.close()
+    producer.join(1.)
+
+    assert not producer.is_alive()
+    assert [event.data1 for event in queue.get_batch()] == [0]  # Doesn't wait once closed
+    assert queue.get_batch() == []
+# end def
+
+
+@pytest.mark.parametrize("collect_stats", [False, True])
+def test_input_stats_on_request(collect_stats):
+    backend = LoopbackBackend(1)
+    Midi.set_backend(backend)
+    received = list()
+    midi_input = Midi(backend.input_device_id(0), None, received.append, collect_stats=collect_stats)
+    backend.inject(0, [[0x90, 60, 100], [0x80, 60, 0]])
+    deadline = time.perf_counter() + 1.
+    while len(received) < 2 and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    # end while
+    midi_input.stop()
+
+    assert len(received) == 2
+    assert midi_input.input_stats.count == (2 if collect_stats else 0)
+# end def
+
+
+def raw(*messages):
+    # As read by pygame.midi.Input.read
+    return [[[*message, 0], timestamp] for timestamp, message in enumerate(messages)]
+# end def
+
+
+def test_filter_drops_clock_and_active_sensing():
+    message_filter = MessageFilter()
+    events = message_filter.apply(raw((0xf8, 0, 0), (0x90, 60, 100), (0xfe, 0, 0), (0xb0, 7, 100), (0xfa, 0, 0)))
+
+    assert [event[0][:3] for event in events] == [[0x90, 60, 100], [0xb0, 7, 100], [0xfa, 0, 0]]
+    assert (message_filter.n_messages, message_filter.n_dropped) == (5, 2)
+    assert MessageFilter(drop=()).accepts(0xf8)
+# end def
+
+
+def test_filter_channels():
+    # Only channel messages are restricted to the channels, system messages pass
+    message_filter = MessageFilter(channels=[0, 9])
+    events = message_filter.apply(raw((0x90, 60, 100), (0x91, 60, 100), (0x99, 36, 100), (0xb1, 7, 1), (0xf2, 0, 0)))
+
+    assert [event[0][0] for event in events] == [0x90, 0x99, 0xf2]
+# end def
+
+
+def test_filter_note_on_velocity_0_is_note_off():
+    # Note-ons with velocity 0 are rewritten before filtering, so they are dropped or accepted like note-offs
+    events = MessageFilter().apply(raw((0x93, 60, 0), (0x93, 60, 1)))
+    assert [event[0][:3] for event in events] == [[0x83, 60, 0], [0x93, 60, 1]]
+
+    events = MessageFilter(accept=(MessageType.NOTE_ON,)).apply(raw((0x90, 60, 100), (0x90, 60, 0), (0x80, 60, 0)))
+    assert [event[0][:3] for event in events] == [[0x90, 60, 100]]
+
+    events = MessageFilter(normalize_note_off=False).apply(raw((0x90, 60, 0)))
+    assert [event[0][:3] for event in events] == [[0x90, 60, 0]]
+# end def
+
+
+def test_filter_in_reader_thread():
+    # Like show mode: only notes get to the callback
+    backend = LoopbackBackend(1)
+    Midi.set_backend(backend)
+    received = list()
+    midi_input = Midi(backend.input_device_id(0), None, received.append,
+                      message_filter=MessageFilter(accept=(MessageType.NOTE_ON, MessageType.NOTE_OFF)))
+    backend.inject(0, [[0xfe, 0, 0], [0x90, 60, 100], [0xf8, 0, 0], [0xb0, 64, 127], [0x90, 60, 0]])
+    deadline = time.perf_counter() + 1.
+    while len(received) < 2 and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    # end while
+    midi_input.stop()
+
+    assert messages(received) == [(0x90, 60, 100), (0x80, 60, 0)]
+    assert midi_input.message_filter.n_dropped == 3
+# end def
+
+
+def test_channel_state_suppresses_repeated_messages():
+    # Programs and controllers are only sent when they change, until the state of the device is unknown again
+    backend = LoopbackBackend(1)
+    Midi.set_backend(backend)
+    port = backend.ports[0]
+    midi_output = Midi(None, backend.output_device_id(0), None)
+
+    def send_all() -> None:
+        midi_output.set_instrument(40, 1)
+        midi_output.set_instrument(40, 1)
+        midi_output.set_controller(7, 100, 1)
+        midi_output.set_controller(7, 100, 1)
+        midi_output.play_note(60, 100, 1, instrument=40)
+    # end def
+
+    def sent():
+        messages = [message[1:] for message in port.log]
+        port.log.clear()
+
+        return messages
+    # end def
+
+    send_all()
+    assert sent() == [(0xc1, 40, 0), (0xb1, 7, 100), (0x91, 60, 100)]
+    midi_output.write_short(0xc1, 41)  # Forwarded messages update the state as well
+    midi_output.set_instrument(41, 1)
+    assert sent() == [(0xc1, 41, 0)]
+
+    midi_output.invalidate_channel_state()
+    send_all()
+    assert sent() == [(0xc1, 40, 0), (0xb1, 7, 100), (0x91, 60, 100)]
+
+    # The devices get reopened if a rescan finds a different list of devices
+    backend.ports.append(LoopbackPort("Loopback 1", lambda: 0.))
+    assert Midi.registry.rescan()
+    send_all()
+    assert sent() == [(0xc1, 40, 0), (0xb1, 7, 100), (0x91, 60, 100)]
+    midi_output.stop()
+# end def
+
+
+class CountingBackend(LoopbackBackend):
+    # Counts the reinitializations, which close all open devices
+    def __init__(self, n_ports: int) -> None:
+        super().__init__(n_ports)
+        self.n_inits = 0
+    # end def
+
+    def init(self) -> None:
+        self.n_inits += 1
+    # end def
+# end class
+
+
+def test_find_device():
+    # An exact match of the name wins over a device containing it, which is found case-insensitively
+    backend = LoopbackBackend(11)
+    Midi.set_backend(backend)
+
+    assert Midi.find_device("Loopback 1").device_id == 2
+    assert Midi.find_device("Loopback 1", MidiDeviceType.INPUT).device_id == 3
+    assert Midi.find_device("loopback 10", MidiDeviceType.OUTPUT).device_id == 20
+    assert Midi.find_device("BACK 3", MidiDeviceType.INPUT).device_id == 7
+    assert Midi.find_device("Loopback 11") is None
+# end def
+
+
+def test_rescan_reopens_by_name_only_on_change():
+    backend = CountingBackend(2)
+    Midi.set_backend(backend)
+    midi_output = Midi(None, backend.output_device_id(1), None)
+    port = backend.ports[1]
+    midi_output.set_instrument(40)
+    n_inits = backend.n_inits
+
+    # Unchanged, the output stays open (with the programs set)
+    assert not Midi.registry.rescan()
+    assert backend.n_inits == n_inits
+    midi_output.set_instrument(40)
+    assert [message[1:] for message in port.log] == [(0xc0, 40, 0)]
+
+    # Another device in front of it: the output is reopened by its name under a new id
+    backend.ports.insert(0, LoopbackPort("USB MIDI", lambda: 0.))
+    assert Midi.registry.rescan()
+    assert backend.n_inits == n_inits + 1
+    assert midi_output.is_open and midi_output.output_device_name == "Loopback 1"
+    midi_output.set_instrument(40)
+    assert [message[1:] for message in port.log] == [(0xc0, 40, 0)] * 2
+    assert backend.ports[0].log == backend.ports[1].log == []
+
+    # Removed, the messages are dropped until the device is back
+    backend.ports.remove(port)
+    assert Midi.registry.rescan()
+    assert not midi_output.is_open
+    midi_output.play_note(60, 100)
+    backend.ports.append(port)
+    assert Midi.registry.rescan()
+    assert midi_output.is_open
+    midi_output.play_note(62, 100)
+    assert [message[1:] for message in port.log] == [(0xc0, 40, 0)] * 2 + [(0x90, 62, 100)]
+
+    # Forced, the devices are reopened in any case
+    n_inits = backend.n_inits
+    assert midi_output.reopen()
+    assert backend.n_inits == n_inits + 1
+    midi_output.stop()
+# end def
+
+
+def test_watch_calls_back_on_change():
+    backend = CountingBackend(1)
+    Midi.set_backend(backend)
+    changes = list()
+    Midi.registry.devices()
+    n_inits = backend.n_inits
+    Midi.registry.watch(0.01, changes.append)
+    time.sleep(0.1)
+    assert changes == [] and backend.n_inits == n_inits
+
+    backend.ports.append(LoopbackPort("Loopback 1", lambda: 0.))
+    deadline = time.perf_counter() + 1.
+    while len(changes) == 0 and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    # end while
+    Midi.registry.stop_watching()
+
+    assert [device.name for device in changes[0]] == ["Loopback 0"] * 2 + ["Loopback 1"] * 2
+    assert backend.n_inits == n_inits + 1
+# end def
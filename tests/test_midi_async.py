@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+from midi import Midi
+from midi_async import AsyncMidi, AsyncScheduler
+from midi_backend import LoopbackBackend
+from test_midi_test_play import play
+
+
+def test_events_and_send():
+    # Echoes the events of port 0's input to port 1's output
+    backend = LoopbackBackend(2)
+    Midi.set_backend(backend)
+    midi = AsyncMidi(Midi(backend.input_device_id(0), backend.output_device_id(1)))
+    messages = [[0x90, 60, 100], [0xb0, 64, 127], [0x80, 60, 0]]
+
+    async def echo() -> None:
+        async for event in midi.events():
+            await midi.send(event.status, event.data1, event.data2)
+            if len(backend.ports[1].log) == len(messages):
+                midi.midi.stop()
+            # end if
+        # end for
+    # end def
+
+    async def main() -> None:
+        task = asyncio.create_task(echo())
+        await asyncio.sleep(0.1)  # Subscribed
+        backend.inject(0, messages)
+        await asyncio.wait_for(task, 5.)
+    # end def
+
+    asyncio.run(main())
+
+    assert [list(message) for _, *message in backend.ports[1].log] == messages
+# end def
+
+
+def test_scheduler():
+    # Two playbacks sharing the loop, one dispatching single events, one batches
+    times = [0., 0.01, 0.01, 0.05]
+    events = list()  # (index, time since the start)
+    batches = list()  # (begin, end)
+
+    async def main() -> None:
+        start_time = time.perf_counter()
+        stats = await asyncio.gather(
+            AsyncScheduler().run(times, lambda index: events.append((index, time.perf_counter() - start_time))),
+            AsyncScheduler().run_batched(times, lambda begin, end: batches.append((begin, end)), 0.02))
+        assert [s.count for s in stats] == [len(times), len(times)]
+    # end def
+
+    asyncio.run(main())
+
+    assert [index for index, _ in events] == list(range(len(times)))
+    assert all(t >= times[index] for index, t in events)
+    assert [index for begin, end in batches for index in range(begin, end)] == list(range(len(times)))
+    assert len(batches) > 1
+# end def
+
+
+def test_run_async():
+    # Plays the same messages as run()
+    expected = [message for _, *message in play().ports[0].log]
+    log = play(run_async=True).ports[0].log
+
+    assert [message for _, *message in log] == expected
+    assert len(expected) == 8
+# end def
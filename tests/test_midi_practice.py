@@ -0,0 +1,59 @@
+import pytest
+
+from midi_practice import ScoreMatcher
+
+
+def test_match_within_tolerance():
+    matcher = ScoreMatcher([0., 1., 2.], [60, 62, 64], tolerance=0.1)
+
+    assert matcher.match(60, 0.05) == 0
+    assert matcher.match(62, 0.89) is None  # Too early
+    assert matcher.match(62, 0.95) == 1
+    assert matcher.match(64, 2.1) == 2  # The tolerance is inclusive
+    assert (matcher.stats.n_correct, matcher.stats.n_wrong, matcher.stats.n_missed) == (3, 1, 0)
+    assert matcher.stats.deviations.latencies == pytest.approx([0.05, -0.05, 0.1])
+# end def
+
+
+def test_wrong_note():
+    matcher = ScoreMatcher([0., 1.], [60, 62], tolerance=0.1)
+
+    assert matcher.match(61, 0.) is None
+    assert matcher.match(62, 0.) is None  # The right pitch at the wrong time
+    assert matcher.match(60, 0.) == 0
+    assert (matcher.stats.n_correct, matcher.stats.n_wrong) == (1, 2)
+# end def
+
+
+def test_missed_note():
+    matcher = ScoreMatcher([0., 1., 2.], [60, 62, 64], tolerance=0.1)
+    matcher.match(60, 0.)
+
+    assert matcher.expire(1.1) == []  # Still within the tolerance
+    assert matcher.expire(1.2) == [1]
+    assert matcher.match(62, 1.05) is None  # Expired notes can't be matched anymore
+    assert not matcher.done
+    assert matcher.expire(3.) == [2]
+    assert matcher.done
+    assert (matcher.stats.n_expected, matcher.stats.n_correct, matcher.stats.n_wrong, matcher.stats.n_missed) == (3, 1, 1, 2)
+# end def
+
+
+def test_repeated_pitch():
+    # Each played note matches the first open note of its pitch, so a repeated note played once too often is wrong
+    # and a skipped one is missed
+    matcher = ScoreMatcher([0., 0.1, 0.2, 0.3], [60, 60, 60, 60], tolerance=0.15)
+
+    assert matcher.match(60, 0.) == 0
+    assert matcher.match(60, 0.) == 1
+    assert matcher.match(60, 0.22) == 2
+    assert matcher.match(60, 0.24) == 3
+    assert matcher.match(60, 0.26) is None
+    assert matcher.expire(1.) == []
+    assert matcher.stats.n_wrong == 1
+
+    matcher = ScoreMatcher([0., 0.5, 1.], [60, 60, 60], tolerance=0.1)
+    assert matcher.match(60, 0.) == 0
+    assert matcher.match(60, 1.) == 2  # Skips the second note
+    assert matcher.expire(1.2) == [1]
+# end def
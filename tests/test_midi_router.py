@@ -0,0 +1,82 @@
+import pytest
+
+from midi import EventBatch, Midi, MessageType
+from midi_backend import LoopbackBackend
+from midi_router import ChannelMap, KeyRange, MessageTypes, Route, Transpose, VelocityCurve, parse_transforms
+
+
+def forward(transforms, messages):
+    # Forwards the messages through a route with the transforms to a loopback port and returns what was sent
+    backend = LoopbackBackend(1)
+    Midi.set_backend(backend)
+    output = Midi(None, backend.output_device_id(0), None)
+    try:
+        Route(output, transforms).forward(EventBatch([[[*message, 0], 0] for message in messages], 1))
+    finally:
+        output.stop()
+    # end try
+
+    return [(status, data1, data2) for _, status, data1, data2 in backend.ports[0].log]
+# end def
+
+
+def test_channel_map():
+    messages = [(0x90, 60, 100), (0x91, 60, 100), (0xb2, 7, 100)]
+
+    assert forward([ChannelMap({1: 3})], messages) == [(0x90, 60, 100), (0x93, 60, 100), (0xb2, 7, 100)]
+    assert forward(parse_transforms("channel=5"), messages) == [(0x95, 60, 100), (0x95, 60, 100), (0xb5, 7, 100)]
+# end def
+
+
+def test_transpose():
+    # Only the keys of note and poly aftertouch messages are transposed, keys moved out of the range are dropped
+    messages = [(0x90, 60, 100), (0x80, 60, 0), (0xa0, 60, 10), (0xb0, 60, 1), (0x90, 120, 100)]
+
+    assert forward([Transpose(12)], messages) == [(0x90, 72, 100), (0x80, 72, 0), (0xa0, 72, 10), (0xb0, 60, 1)]
+# end def
+
+
+def test_key_range():
+    messages = [(0x90, pitch, 100) for pitch in (47, 48, 60, 61)]
+
+    assert forward([KeyRange(48, 60)], messages) == [(0x90, 48, 100), (0x90, 60, 100)]
+# end def
+
+
+def test_velocity_curve():
+    # A note-on never becomes a note-off, the velocity of other messages isn't changed
+    messages = [(0x90, 60, 127), (0x90, 61, 64), (0x90, 62, 1), (0x90, 63, 0), (0x80, 60, 64)]
+
+    assert forward([VelocityCurve(1., 0.5)], messages) == [(0x90, 60, 64), (0x90, 61, 32), (0x90, 62, 1),
+                                                           (0x90, 63, 0), (0x80, 60, 64)]
+    assert forward([VelocityCurve(2.)], messages)[:3] == [(0x90, 60, 127), (0x90, 61, 32), (0x90, 62, 1)]
+# end def
+
+
+def test_message_types():
+    messages = [(0x90, 60, 100), (0x80, 60, 0), (0xb0, 7, 100), (0xc0, 1, 0), (0xe0, 0, 64), (0xf8, 0, 0)]
+
+    assert forward([MessageTypes([MessageType.CONTROL_CHANGE])], messages) == [(0xb0, 7, 100)]
+    assert forward(parse_transforms("types=note+pitchbend"), messages) == [(0x90, 60, 100), (0x80, 60, 0), (0xe0, 0, 64)]
+# end def
+
+
+def test_composition_order():
+    # Each transform applies to the output of the previous ones: a split point before a transpose selects the played
+    # keys, after it the transposed keys
+    messages = [(0x90, 50, 100), (0x90, 60, 100)]
+
+    assert forward(parse_transforms("keys=0-55,transpose=12"), messages) == [(0x90, 62, 100)]
+    assert forward(parse_transforms("transpose=12,keys=0-55"), messages) == []
+    # A channel map after a type filter still sees the filtered messages only
+    assert forward(parse_transforms("types=cc,channel=0:2"), [(0x90, 60, 100), (0xb0, 7, 1)]) == [(0xb2, 7, 1)]
+    assert forward(parse_transforms("channel=0:2,channel=2:3"), [(0x90, 60, 100)]) == [(0x93, 60, 100)]
+# end def
+
+
+@pytest.mark.parametrize("spec, name", [("types=note+sysex", "sysex"), ("speed=2", "speed")])
+def test_parse_errors(spec, name):
+    with pytest.raises(ValueError, match=name):
+        parse_transforms(spec)
+    # end with
+# end def
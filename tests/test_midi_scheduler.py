@@ -0,0 +1,99 @@
+import threading
+import time
+from typing import Optional
+
+from midi_scheduler import Scheduler
+from midi_trace import Instrumentation
+
+
+class FakeClock:
+    # Advances by step on every reading, so the scheduler can spin without sleeping
+    def __init__(self, step: float = 0.0001) -> None:
+        self.time = 0.
+        self._step = step
+    # end def
+
+    def __call__(self) -> float:
+        self.time += self._step
+        return self.time
+    # end def
+# end class
+
+
+def fake_scheduler(clock: Optional[FakeClock] = None, **kwargs) -> Scheduler:
+    # Spins for all of the waiting (never sleeps on the real clock)
+    return Scheduler(spin_time=float("inf"), clock=clock if clock is not None else FakeClock(), **kwargs)
+# end def
+
+
+def test_batched_dispatch_lead():
+    # Batches are dispatched ahead of their deadlines: that's recorded as lead time, not as (negative) lateness
+    instrumentation = Instrumentation()
+    times = [0.01 * (n + 1) for n in range(100)]
+    batches = list()
+    fake_scheduler(instrumentation=instrumentation).run_batched(times, lambda begin, end: batches.append((begin, end)),
+                                                                window=0.1, start_time=0.)
+
+    assert [index for begin, end in batches for index in range(begin, end)] == list(range(100))
+    lead = instrumentation.dispatch_lead
+    assert lead.count == 100 and instrumentation.scheduler_lateness.count == 0
+    assert 0. < lead.mean <= lead.max <= 0.1
+    assert lead.percentile(50.) > 0.
+# end def
+
+
+def test_events_dispatched_in_order_at_their_deadlines():
+    # Each event is dispatched at its deadline (the events of a chord together), never before
+    clock = FakeClock()
+    scheduler = fake_scheduler(clock)
+    times = [0.01, 0.02, 0.02, 0.02, 0.05, 0.1]
+    dispatched = list()
+    stats = scheduler.run(times, lambda index: dispatched.append((index, clock.time)), start_time=0.)
+
+    assert [index for index, _ in dispatched] == list(range(len(times)))
+    assert all(0. <= t - times[index] < 0.001 for index, t in dispatched)
+    assert stats.count == len(times)
+# end def
+
+
+def test_stop_from_callback():
+    # No event is dispatched after stop(), which doesn't carry over to the next run
+    clock = FakeClock()
+    scheduler = fake_scheduler(clock)
+    times = [0.01 * (n + 1) for n in range(10)]
+    dispatched = list()
+
+    def cb_event(index: int) -> None:
+        dispatched.append(index)
+        if index == 3:
+            scheduler.stop()
+        # end if
+    # end def
+
+    scheduler.run(times, cb_event, start_time=0.)
+    assert dispatched == [0, 1, 2, 3]
+
+    batches = list()
+    scheduler.run_batched(times, lambda begin, end: (batches.append((begin, end)), scheduler.stop()), window=0.03,
+                          start_time=clock())
+    assert len(batches) == 1 and batches[0][0] == 0
+
+    dispatched.clear()
+    scheduler.run(times[:3], dispatched.append, start_time=clock())
+    assert dispatched == [0, 1, 2]
+# end def
+
+
+def test_stop_interrupts_waiting():
+    # stop() from another thread ends the sleep until a distant deadline right away
+    scheduler = Scheduler()
+    dispatched = list()
+    timer = threading.Timer(0.05, scheduler.stop)
+    timer.start()
+    start_time = time.perf_counter()
+    scheduler.run([0., 10.], dispatched.append)
+    timer.join()
+
+    assert dispatched == [0]
+    assert time.perf_counter() - start_time < 1.
+# end def
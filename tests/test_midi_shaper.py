@@ -0,0 +1,68 @@
+import pytest
+
+from midi_shaper import MemoryOutput, OutputShaper
+
+
+def chord(timestamp: int, pitches, off: bool = False):
+    return [([0x80 if off else 0x90, pitch, 0 if off else 100], timestamp) for pitch in pitches]
+# end def
+
+
+def test_order():
+    output = MemoryOutput()
+    shaper = OutputShaper(output, bandwidth=1e9, running_status=True)
+    shaper.write(chord(0, [64, 60]) + [([0xc0, 5], 0)] + chord(0, [50], off=True))
+
+    # Note-offs (as note-ons with velocity 0) first, then the program change, then the note-ons by pitch
+    assert output.messages == [([0x90, 50, 0], 0), ([0xc0, 5], 0), ([0x90, 60, 100], 0), ([0x90, 64, 100], 0)]
+    assert shaper.stats.n_running_status == 1
+    assert shaper.stats.n_bytes == 3 + 2 + 3 + 2
+# end def
+
+
+def test_no_running_status_by_default():
+    # PortMidi and USB-MIDI send every status byte
+    shaper = OutputShaper(MemoryOutput(), bandwidth=1e9)
+    shaper.write(chord(0, [60, 64, 67]))
+
+    assert shaper.stats.n_running_status == 0
+    assert shaper.stats.n_bytes == 3 * 3
+# end def
+
+
+def test_bandwidth():
+    # Bursts of 100 note-ons every 50 ms would need far more than a DIN link's 3125 bytes/s
+    output = MemoryOutput()
+    shaper = OutputShaper(output)
+    for n in range(10):
+        shaper.write(chord(50 * n, range(10, 110)))
+    # end for
+
+    assert len(output.messages) == 1000
+    assert output.max_byte_rate(window=100) <= OutputShaper.BANDWIDTH_DIN * 1.05
+    assert shaper.stats.n_delayed > 0 and shaper.stats.max_delay > 0
+    # Each chord stays in order and no message is sent before its timestamp
+    assert [m[1] for m, _ in output.messages[:100]] == list(range(10, 110))
+    assert all(t >= 50 * (n // 100) for n, (_, t) in enumerate(output.messages))
+# end def
+
+
+def test_no_delay_below_bandwidth():
+    output = MemoryOutput()
+    shaper = OutputShaper(output)
+    for n in range(10):
+        shaper.write(chord(100 * n, [60 + n]) + chord(100 * n + 50, [60 + n], off=True))
+    # end for
+
+    assert shaper.stats.n_delayed == 0
+    assert [t for _, t in output.messages] == [50 * n for n in range(20)]
+# end def
+
+
+def test_memory_output_order():
+    output = MemoryOutput()
+    output.write(chord(10, [60]))
+    with pytest.raises(ValueError):
+        output.write(chord(5, [60]))
+    # end with
+# end def
@@ -0,0 +1,137 @@
+import contextlib
+import glob
+import io
+import os
+import shutil
+from typing import List
+
+import pytest
+
+import midi_file
+from conftest import ROOT
+from midi_file import MidiFileWriter, write_score
+from midi_test import MidiTestConvert, MidiTestPlay
+from score import STATE_ON, CompiledScore
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+SCORES = sorted(glob.glob(os.path.join(ROOT, "notes", "*.musicxml")))
+
+
+def read_messages(path: str) -> List[bytes]:
+    # The channel messages of a file written by MidiFileWriter
+    with open(path, "rb") as f:
+        data = f.read()
+    # end with
+    position = MidiFileWriter._HEADER.size + MidiFileWriter._TRACK_HEADER.size
+    _, track_length = MidiFileWriter._TRACK_HEADER.unpack_from(data, MidiFileWriter._HEADER.size)
+    assert position + track_length == len(data)
+
+    messages = list()
+    while position < len(data):
+        end = MidiFileWriter._parse_event(data, position)
+        while data[position] >= 0x80:  # Delta time
+            position += 1
+        # end while
+        if data[position + 1] < 0xf0:
+            messages.append(data[position + 1:end])
+        # end if
+        position = end
+    # end while
+
+    return messages
+# end def
+
+
+def convert(directory: str, output_directory: str, **kwargs) -> int:
+    with contextlib.redirect_stdout(io.StringIO()):
+        return MidiTestConvert(directory, output_directory, parser="stream", n_jobs=2, **kwargs).run()
+    # end with
+# end def
+
+
+def test_round_trip(tmp_path):
+    # Each note of the bundled scores is written as a note-on and a note-off
+    assert convert(os.path.join(ROOT, "notes"), str(tmp_path)) == 0
+
+    for musicxml_file in SCORES:
+        toggles = CompiledScore.from_score(MidiTestPlay.parse_score(musicxml_file, "stream")).toggles
+        messages = read_messages(str(tmp_path / (os.path.splitext(os.path.basename(musicxml_file))[0] + ".mid")))
+        n_note_ons = sum(1 for message in messages if message[0] & 0xf0 == 0x90)
+        n_note_offs = sum(1 for message in messages if message[0] & 0xf0 == 0x80)
+
+        assert n_note_ons == n_note_offs == int((toggles["state"] == STATE_ON).sum()) > 0
+    # end for
+# end def
+
+
+def test_incremental_and_failures(tmp_path):
+    # A broken score is reported without stopping the others, up-to-date files are skipped
+    directory = tmp_path / "scores"
+    (directory / "sub").mkdir(parents=True)
+    shutil.copy(os.path.join(DATA, "two_parts.musicxml"), directory / "sub" / "two_parts.musicxml")
+    with open(directory / "broken.musicxml", "w") as f:
+        f.write("<score-partwise>")
+    # end with
+
+    assert convert(str(directory), str(tmp_path / "out")) == 1
+    assert sorted(os.listdir(tmp_path / "out")) == ["sub"]
+    assert os.listdir(tmp_path / "out" / "sub") == ["two_parts.mid"]
+
+    mtime = os.path.getmtime(tmp_path / "out" / "sub" / "two_parts.mid")
+    os.utime(tmp_path / "out" / "sub" / "two_parts.mid", (mtime + 10, mtime + 10))
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        MidiTestConvert(str(directory), str(tmp_path / "out"), parser="stream").run()
+    # end with
+    assert "1 up to date, converting 1" in output.getvalue()
+# end def
+
+
+def test_write_score_removes_temporary_file(tmp_path, monkeypatch):
+    compiled_score = CompiledScore.from_score(MidiTestPlay.parse_score(os.path.join(DATA, "two_parts.musicxml"), "stream"))
+    path = str(tmp_path / "score.mid")
+
+    def write_event(self, delta_ticks: int, event: bytes) -> None:
+        # Fails in the middle of the notes
+        if event[0] & 0xf0 == 0x80:
+            raise OSError("No space left on device")
+        # end if
+        original_write_event(self, delta_ticks, event)
+    # end def
+
+    original_write_event = midi_file.MidiFileWriter.write_event
+    monkeypatch.setattr(midi_file.MidiFileWriter, "write_event", write_event)
+    with pytest.raises(OSError):
+        write_score(path, compiled_score)
+    # end with
+    monkeypatch.undo()
+
+    assert os.listdir(tmp_path) == []
+    assert write_score(path, compiled_score) == 8
+    assert os.listdir(tmp_path) == ["score.mid"]
+# end def
+
+
+@pytest.mark.parametrize("n_cut, n_messages", [(0, 10), (1, 9), (3, 9), (4, 9), (6, 8)],
+                         ids=["complete", "in_data", "after_delta_time", "at_event_end", "in_previous_event"])
+def test_recover(tmp_path, n_cut, n_messages):
+    # A file that didn't get closed and got cut off in the middle of an event (each message takes 4 bytes with its
+    # delta time) keeps all complete events
+    path = str(tmp_path / "recording.mid")
+    messages = [bytes((0x90 if n % 2 == 0 else 0x80, 60 + n // 2, 100 if n % 2 == 0 else 0)) for n in range(10)]
+    writer = MidiFileWriter(path)
+    writer.write_event(0, midi_file.tempo_event(120.))
+    for message in messages:
+        writer.write_event(10, message)
+    # end for
+    writer.flush()
+    writer._file.close()  # Crashed before close()
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - n_cut)
+    # end with
+
+    assert MidiFileWriter.recover(path) == 1 + n_messages
+    assert read_messages(path) == messages[:n_messages]
+    # Recovering a recovered file doesn't change it
+    assert MidiFileWriter.recover(path) == 2 + n_messages
+    assert read_messages(path) == messages[:n_messages]
+# end def
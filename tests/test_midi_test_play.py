@@ -0,0 +1,206 @@
+import asyncio
+import contextlib
+import io
+import os
+import signal
+import threading
+from typing import List, Optional, Set, Tuple
+
+import numpy as np
+import pytest
+
+from conftest import ROOT
+from midi import Midi
+from midi_backend import LoopbackBackend
+from midi_test import MidiTestPlay
+from score import CompiledScore, TempoMap
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+SOUND_TEMPO = os.path.join(DATA, "sound_tempo.musicxml")
+# Piano (channel 0, program 0) and Violin (channel 1, program 40), 2 measures of 4/4 at 120 qpm
+TWO_PARTS = os.path.join(DATA, "two_parts.musicxml")
+# A single part at 180 qpm, measures of 3 quarters, the loop of measures 5 - 8 starts with a note
+SALTARELLO = os.path.join(ROOT, "notes", "Saltarello.musicxml")
+
+
+def play(run_async: bool = False, musicxml_file: str = SOUND_TEMPO, n_ports: int = 1, tempo_scale: float = 10.,
+         **kwargs) -> LoopbackBackend:
+    # Plays a score (the test score takes 0.9 s) to the first port of a loopback backend
+    backend = LoopbackBackend(n_ports)
+    Midi.set_backend(backend)
+    with contextlib.redirect_stdout(io.StringIO()):  # Device list etc.
+        midi_test_play = MidiTestPlay(backend.output_device_id(0), musicxml_file, use_cache=False, parser="stream",
+                                      tempo_scale=tempo_scale, **kwargs)
+        if run_async:
+            asyncio.run(midi_test_play.run_async())
+        else:
+            midi_test_play.run()
+        # end if
+    # end with
+
+    return backend
+# end def
+
+
+@pytest.mark.parametrize("run_async", [False, True])
+@pytest.mark.parametrize("kwargs", [dict(), dict(latency=200), dict(latency=200, bandwidth=100.)],
+                         ids=["immediate", "latency", "bandwidth"])
+def test_all_messages_sent_on_return(run_async, kwargs):
+    # The timestamped messages are only sent by PortMidi at their timestamp + latency, which might be after the
+    # scheduler is done
+    port = play(run_async, **kwargs).ports[0]
+
+    assert len(port.log) == 8  # Note-on and note-off of each note
+    assert len(port.read(len(port.log) + 1)) == len(port.log)
+# end def
+
+
+def received(port) -> List[Tuple[float, int, int, int]]:
+    # (time in s, status, data1, data2) of the messages sent through the port, at their due time
+    return [(due / 1000., *message[:3]) for message, due in port.read(len(port.log) + 1)]
+# end def
+
+
+def note_ons(messages, pitch: Optional[int] = None) -> List[float]:
+    return [t for t, status, data1, data2 in messages if status & 0xf0 == 0x90 and data2 > 0 and pitch in (None, data1)]
+# end def
+
+
+def sounding(messages) -> Set[Tuple[int, int]]:
+    # The notes (channel, pitch) still sounding after the messages
+    notes = set()
+    for _, status, data1, data2 in messages:
+        if status & 0xf0 == 0x90 and data2 > 0:
+            notes.add((status & 0x0f, data1))
+        elif status & 0xf0 in (0x80, 0x90):
+            notes.discard((status & 0x0f, data1))
+        # end if
+    # end for
+
+    return notes
+# end def
+
+
+@pytest.mark.parametrize("route", ["Violin", "channel=1"])
+def test_routes(route):
+    # The violin is routed to port 1, the rest is played on the default output (port 0). Each output gets the program
+    # of its channels once.
+    ports = play(musicxml_file=TWO_PARTS, n_ports=2, routes=[f"{route}|{LoopbackBackend.output_device_id(1)}"]).ports
+    piano, violin = received(ports[0]), received(ports[1])
+
+    assert {status & 0x0f for _, status, _, _ in piano} == {0}
+    assert [(status, data1) for _, status, data1, _ in piano if status & 0xf0 == 0xc0] == [(0xc0, 0)]
+    assert [data1 for _, status, data1, data2 in piano if status == 0x90 and data2 > 0] == [60, 62, 64, 65, 67]
+    assert {status & 0x0f for _, status, _, _ in violin} == {1}
+    assert [(status, data1) for _, status, data1, _ in violin if status & 0xf0 == 0xc0] == [(0xc1, 40)]
+    assert [data1 for _, status, data1, data2 in violin if status == 0x91 and data2 > 0] == [55, 57, 59]
+    assert sounding(piano) == sounding(violin) == set()
+# end def
+
+
+@pytest.mark.parametrize("kwargs", [dict(), dict(latency=100)], ids=["immediate", "latency"])
+def test_delay_compensation(kwargs):
+    # Port 1 has a delay of 50 ms, so port 0 gets delayed by 50 ms to stay aligned. Repeated, the delayed events of
+    # the first pass must not delay the second pass.
+    length = 0.8  # 8 quarters at 120 * 5 qpm
+    ports = play(musicxml_file=TWO_PARTS, n_ports=2, tempo_scale=5., repeat=2,
+                 routes=[f"Violin|{LoopbackBackend.output_device_id(1)}|50"], **kwargs).ports
+    piano, violin = received(ports[0]), received(ports[1])
+
+    # The notes played at the same time in the score: at 0, 2 and 4 quarters of each pass
+    piano_ons = [t for n, t in enumerate(note_ons(piano)) if n % 5 in (0, 2, 4)]
+    violin_ons = note_ons(violin)
+    assert len(piano_ons) == len(violin_ons) == 6
+    assert [p - v for p, v in zip(piano_ons, violin_ons)] == pytest.approx([0.05] * 6, abs=0.02)
+    # Both passes have the same period
+    assert [t - violin_ons[0] for t in violin_ons] == pytest.approx([0., 0.2, 0.4, length, length + 0.2, length + 0.4], abs=0.02)
+    assert sounding(piano) == sounding(violin) == set()
+# end def
+
+
+@pytest.mark.parametrize("kwargs", [dict(), dict(latency=100)], ids=["immediate", "latency"])
+def test_loop(kwargs):
+    # A-B loop of measures 5 - 8 played 3 times: every pass plays the same notes at the same times and all notes get
+    # turned off, both at the end of each pass and at the end
+    compiled_score = CompiledScore.from_score(MidiTestPlay.parse_score(SALTARELLO, "stream"))
+    start, end = TempoMap(compiled_score.tempos, tempo_scale=10.).seconds(
+        np.array([compiled_score.measure_offset(5), compiled_score.measure_offset(8, end=True)]))
+    period = end - start
+
+    messages = received(play(musicxml_file=SALTARELLO, start_measure=5, end_measure=8, repeat=3, **kwargs).ports[0])
+    ons = note_ons(messages)
+    assert len(ons) % 3 == 0
+    n = len(ons) // 3
+    passes = [[t - ons[0] - k * period for t in ons[k * n:(k + 1) * n]] for k in range(3)]
+    assert passes[0][0] == 0.
+    assert passes[1] == pytest.approx(passes[0], abs=0.02)
+    assert passes[2] == pytest.approx(passes[0], abs=0.02)
+    # The messages before the first note-on of the next pass (the note-offs at the end of a pass come first)
+    first_ons = [i for i, (_, status, _, data2) in enumerate(messages) if status & 0xf0 == 0x90 and data2 > 0][n::n]
+    for i in first_ons:
+        assert sounding(messages[:i]) == set()
+    # end for
+    assert sounding(messages) == set()
+# end def
+
+
+def interrupt_after(seconds: float) -> threading.Timer:
+    # Ctrl+C
+    timer = threading.Timer(seconds, os.kill, (os.getpid(), signal.SIGINT))
+    timer.start()
+
+    return timer
+# end def
+
+
+@pytest.mark.parametrize("run_async", [False, True])
+@pytest.mark.parametrize("kwargs", [dict(), dict(latency=500, lookahead=500), dict(latency=500, lookahead=500, bandwidth=3125.)],
+                         ids=["immediate", "latency", "bandwidth"])
+def test_interrupted_endless_loop(run_async, kwargs):
+    # Ctrl+C in the middle of an endless loop releases all notes, also the ones already queued with a latency: the
+    # lookahead is longer than the time between the notes, so there are always note-ons queued.
+    timer = interrupt_after(0.55)
+    if run_async:
+        # Like main(): with the default handler, asyncio.run() cancels the playback and passes on the interruption
+        previous_handler = signal.signal(signal.SIGINT, signal.default_int_handler)
+        try:
+            with pytest.raises(KeyboardInterrupt):
+                play(True, musicxml_file=SALTARELLO, tempo_scale=1., start_measure=5, end_measure=8, repeat=0, **kwargs)
+            # end with
+        finally:
+            signal.signal(signal.SIGINT, previous_handler)
+        # end try
+        port = Midi.registry.backend.ports[0]
+    else:
+        port = play(musicxml_file=SALTARELLO, tempo_scale=1., start_measure=5, end_measure=8, repeat=0, **kwargs).ports[0]
+    # end if
+    timer.join()
+    messages = received(port)
+
+    assert len(messages) == len(port.log)  # All sent on return
+    assert len(note_ons(messages)) > 0
+    assert sounding(messages) == set()
+# end def
+
+
+@pytest.mark.parametrize("kwargs", [dict(), dict(latency=100)], ids=["immediate", "latency"])
+def test_programs_sent_once(kwargs):
+    # Played again, the programs are already set on the output, unless they were sent as timestamped messages (which
+    # the output's channel state doesn't keep track of)
+    backend = LoopbackBackend(1)
+    Midi.set_backend(backend)
+    with contextlib.redirect_stdout(io.StringIO()):
+        midi_test_play = MidiTestPlay(backend.output_device_id(0), TWO_PARTS, use_cache=False, parser="stream",
+                                      tempo_scale=10., **kwargs)
+        midi_test_play.run()
+        first = received(backend.ports[0])
+        midi_test_play.run()
+        second = received(backend.ports[0])
+    # end with
+    programs = [(status, data1) for _, status, data1, _ in first if status & 0xf0 == 0xc0]
+
+    assert sorted(programs) == [(0xc0, 0), (0xc1, 40)]
+    assert [(status, data1) for _, status, data1, _ in second if status & 0xf0 == 0xc0] == \
+           ([] if len(kwargs) == 0 else programs)
+    assert note_ons(second) and len(note_ons(second)) == len(note_ons(first))
+# end def
@@ -0,0 +1,124 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+from conftest import ROOT
+
+# Runs thru mode on the loopback backend (input of port 0 to the output of port 1) with one note injected
+_THRU = """
+import sys
+from midi import Midi
+from midi_backend import LoopbackBackend
+
+backend = LoopbackBackend(2)
+Midi.set_backend(backend)
+
+from midi_test import MidiTestThru
+
+thru = MidiTestThru(LoopbackBackend.input_device_id(0), LoopbackBackend.output_device_id(1),
+                    record_file=sys.argv[1] if len(sys.argv) > 1 else None)
+backend.inject(0, [[0x90, 60, 100], [0x80, 60, 0]])
+print("ready", flush=True)
+thru.run(show_stats=True)
+"""
+
+# The same for show mode, which runs the Tk main loop
+_SHOW = """
+import sys
+from midi import Midi
+from midi_backend import LoopbackBackend
+
+backend = LoopbackBackend(2)
+Midi.set_backend(backend)
+
+from midi_test import MidiTestShow
+
+show = MidiTestShow(LoopbackBackend.input_device_id(0), LoopbackBackend.output_device_id(1), record_file=sys.argv[1])
+backend.inject(0, [[0x90, 60, 100], [0x80, 60, 0]])
+print("ready", flush=True)
+show.run(show_stats=True)
+"""
+
+
+def has_display() -> bool:
+    try:
+        import tkinter
+        tkinter.Tk().destroy()
+    except Exception:
+        return False
+    # end try
+
+    return True
+# end def
+
+
+def run_until_interrupted(script: str, *args: str) -> str:
+    # Starts a mode in a subprocess, interrupts it like Ctrl+C does and returns its output
+    process = subprocess.Popen([sys.executable, "-c", script, *args], cwd=ROOT, stdout=subprocess.PIPE, text=True,
+                               env=dict(os.environ, PYTHONPATH=ROOT))
+    output = list()
+    for line in process.stdout:
+        output.append(line)
+        if line.startswith("ready"):
+            break
+        # end if
+    # end for
+    time.sleep(0.5)  # Let the note pass through
+    process.send_signal(signal.SIGINT)
+    output.append(process.communicate(timeout=10)[0])
+    assert process.returncode == 0, "".join(output)
+
+    return "".join(output)
+# end def
+
+
+def test_interrupt_shuts_down():
+    output = run_until_interrupted(_THRU)
+
+    # The statistics are only printed by the shutdown after Ctrl+C
+    assert "Histogram(input latency" in output
+    assert "RouteStats" in output
+    assert "MidiEvent" not in output  # Only printed with print_events
+# end def
+
+
+def check_recording(path: str) -> None:
+    import music21 as m21
+    from midi_file import MidiFileWriter
+
+    # Complete file: the track length matches the data and ends with the end of track
+    with open(path, "rb") as f:
+        data = f.read()
+    # end with
+    header = MidiFileWriter._HEADER.size
+    _, track_length = MidiFileWriter._TRACK_HEADER.unpack_from(data, header)
+    assert track_length == len(data) - header - MidiFileWriter._TRACK_HEADER.size
+    assert data.endswith(MidiFileWriter._END_OF_TRACK)
+
+    notes = list(m21.converter.parse(path).recurse().notes)
+    assert [note.pitch.midi for note in notes] == [60]
+# end def
+
+
+def test_interrupt_finalizes_recording(tmp_path):
+    path = str(tmp_path / "session.mid")
+    output = run_until_interrupted(_THRU, path)
+
+    assert "Recorded 2 events" in output
+    check_recording(path)
+# end def
+
+
+@pytest.mark.skipif(not has_display(), reason="Tk needs a display")
+def test_show_interrupt_finalizes_recording(tmp_path):
+    path = str(tmp_path / "session.mid")
+    output = run_until_interrupted(_SHOW, path)
+
+    assert "Recorded 2 events" in output
+    assert "Histogram(input latency" in output
+    check_recording(path)
+# end def
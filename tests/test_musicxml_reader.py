@@ -0,0 +1,28 @@
+import glob
+import os
+
+import music21 as m21
+import pytest
+
+from conftest import ROOT
+from midi_test import MidiTestPlay
+from musicxml_reader import MusicXmlReader
+
+SCORES = sorted(glob.glob(os.path.join(ROOT, "notes", "*.musicxml")))
+
+
+def key(note: MidiTestPlay.Note):
+    return (float(note.start), float(note.duration), note.pitch, round(note.velocity, 6), note.channel, note.instrument,
+            note.instrument_name)
+# end def
+
+
+@pytest.mark.parametrize("musicxml_file", SCORES, ids=os.path.basename)
+def test_same_notes_as_music21(musicxml_file):
+    # The streaming parser extracts the same notes and measures as the music21 based extraction
+    xml_data = m21.converter.parse(musicxml_file)
+    reader = MusicXmlReader(musicxml_file)
+
+    assert sorted(map(key, reader.notes(MidiTestPlay.Note))) == sorted(map(key, MidiTestPlay._xml_to_list(xml_data)))
+    assert [(float(offset), number) for offset, number in reader.measures] == MidiTestPlay._xml_to_measures(xml_data)
+# end def
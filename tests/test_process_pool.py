@@ -0,0 +1,35 @@
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+from process_pool import imap_unordered
+
+
+def square(n: int) -> int:
+    if n == 3:
+        raise ValueError(n)
+    elif n == 5:
+        os._exit(1)  # Crashes the worker process, like a segfault
+    # end if
+
+    return n * n
+# end def
+
+
+def test_results_and_exceptions():
+    results = {index: (result, e) for index, result, e in imap_unordered(square, [(n,) for n in range(5)], 2)}
+
+    assert {index: result for index, (result, e) in results.items() if e is None} == {0: 0, 1: 1, 2: 4, 4: 16}
+    assert isinstance(results[3][1], ValueError)
+# end def
+
+
+def test_crashed_worker():
+    # Only the job crashing its worker fails, the other ones are run again in a new pool
+    results = {index: (result, e) for index, result, e in imap_unordered(square, [(n,) for n in range(10)], 4)}
+
+    assert sorted(results) == list(range(10))
+    assert {index: result for index, (result, e) in results.items() if e is None} == \
+           {n: n * n for n in range(10) if n not in (3, 5)}
+    assert isinstance(results[3][1], ValueError)
+    assert isinstance(results[5][1], BrokenProcessPool)
+# end def
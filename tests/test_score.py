@@ -0,0 +1,76 @@
+import random
+
+import numpy as np
+import pytest
+
+from score import Score
+
+
+def random_score(n_notes: int = 200, seed: int = 1) -> Score:
+    # Unsorted notes with pitches and velocities up to the limits, some without channel or program
+    rng = random.Random(seed)
+    notes = [(rng.randrange(0, 64) / 4., rng.randrange(1, 8) / 4., rng.randrange(0, 128), rng.random(),
+              rng.choice([None, 0, 1, 9, 15]), rng.choice([None, 0, 40]), rng.choice([None, "Piano", "Violin"]))
+             for _ in range(n_notes)]
+
+    return Score.from_notes(notes, tempos=[(0., 120.), (8., 90.)], measures=[(0., 1), (4., 2), (8., 3)])
+# end def
+
+
+def test_scale_tempo():
+    score = random_score()
+    scaled = score.scale_tempo(2.)
+
+    assert scaled.notes["start"].tolist() == [note["start"] / 2. for note in score.notes]
+    assert scaled.notes["duration"].tolist() == [note["duration"] / 2. for note in score.notes]
+    assert scaled.tempos.tolist() == [(0., 120.), (4., 90.)]
+    assert scaled.measures["offset"].tolist() == [0., 2., 4.]
+    # The original is unchanged
+    assert score.tempos.tolist() == [(0., 120.), (8., 90.)]
+# end def
+
+
+@pytest.mark.parametrize("semitones", [0, 7, -12, 100])
+def test_transpose(semitones):
+    # Pitches moved out of the range are clipped, all other columns and the order are kept
+    score = random_score()
+    transposed = score.transpose(semitones)
+
+    assert transposed.notes["pitch"].tolist() == [min(max(int(note["pitch"]) + semitones, 0), 127) for note in score.notes]
+    for name in ("start", "duration", "velocity", "program", "name", "channel"):
+        assert transposed.notes[name].tolist() == score.notes[name].tolist()
+    # end for
+# end def
+
+
+@pytest.mark.parametrize("factor", [0.5, 1., 3.])
+def test_scale_velocity(factor):
+    # Clipped to 1 (127)
+    score = random_score()
+    scaled = score.scale_velocity(factor)
+
+    assert scaled.notes["velocity"].tolist() == pytest.approx([min(note["velocity"] * factor, 1.) for note in score.notes])
+    assert scaled.notes["velocity"].max() <= 1.
+    assert ((scaled.notes["velocity"] * 127).astype(int) <= 127).all()
+# end def
+
+
+def test_remap_channels():
+    # Notes without channel (-1) keep it, unmapped channels are kept, the order is kept
+    score = random_score()
+    mapping = {0: 2, 9: 0, 15: 15}
+    remapped = score.remap_channels(mapping)
+
+    assert remapped.notes["channel"].tolist() == [mapping.get(note["channel"], note["channel"]) for note in score.notes]
+    assert remapped.notes[["start", "pitch", "velocity"]].tolist() == score.notes[["start", "pitch", "velocity"]].tolist()
+# end def
+
+
+def test_transforms_compose():
+    score = random_score()
+    composed = score.transpose(12).scale_velocity(0.5).remap_channels({1: 3}).sorted()
+
+    assert np.all(np.diff(composed.notes["start"]) >= 0)
+    assert composed.notes.tolist() == score.sorted().transpose(12).scale_velocity(0.5).remap_channels({1: 3}).notes.tolist()
+    assert composed.instrument_names == score.instrument_names
+# end def
@@ -0,0 +1,115 @@
+import os
+from typing import Set
+
+import numpy as np
+import pytest
+
+from score import CompiledScore, Score
+from score_cache import ScoreCache
+
+
+def compiled_score() -> CompiledScore:
+    notes = [(0., 1., 60, 0.5, 0, 0, "Piano"), (1., 1., 64, 0.75, 1, 40, "Violin"), (1., 2., 67, 1., 1, 40, "Violin")]
+
+    return CompiledScore.from_score(Score.from_notes(notes, tempos=[(0., 120.), (2., 90.)], measures=[(0., 1), (2., 2)]))
+# end def
+
+
+def score_file(tmp_path, name: str, content: str = "") -> str:
+    # Only the content of the file matters for the key of its entry
+    path = os.path.join(tmp_path, name)
+    with open(path, "w") as f:
+        f.write(f"<score-partwise>{name}{content}</score-partwise>")
+    # end with
+
+    return path
+# end def
+
+
+def entries(cache: ScoreCache) -> Set[str]:
+    return set(os.listdir(cache.cache_dir)) if os.path.isdir(cache.cache_dir) else set()
+# end def
+
+
+def test_hit_after_store(tmp_path):
+    cache = ScoreCache(os.path.join(tmp_path, "cache"))
+    path = score_file(tmp_path, "a")
+    assert cache.load(path) is None
+
+    expected = compiled_score()
+    cache.store(path, expected)
+    loaded = cache.load(path)
+
+    assert loaded is not None
+    assert np.array_equal(loaded.toggles, expected.toggles)
+    assert np.array_equal(loaded.tempos, expected.tempos)
+    assert np.array_equal(loaded.measures, expected.measures)
+    assert loaded.instrument_names == expected.instrument_names
+# end def
+
+
+def test_miss_after_change(tmp_path):
+    cache_dir = os.path.join(tmp_path, "cache")
+    path = score_file(tmp_path, "a")
+    ScoreCache(cache_dir).store(path, compiled_score())
+
+    assert ScoreCache(cache_dir, parser_version="2").load(path) is None
+    assert ScoreCache(cache_dir).load(path) is not None
+    score_file(tmp_path, "a", content=" ")
+    assert ScoreCache(cache_dir).load(path) is None
+# end def
+
+
+def test_lru_eviction(tmp_path):
+    # Room for 2 entries: storing a third one evicts the least recently used. The names and the size of the entries
+    # are taken from an unbounded cache.
+    paths = [score_file(tmp_path, name) for name in "abc"]
+    unbounded_cache = ScoreCache(os.path.join(tmp_path, "unbounded"))
+    entry_names = list()
+    for path in paths:
+        previous_entries = entries(unbounded_cache)
+        unbounded_cache.store(path, compiled_score())
+        entry_names += entries(unbounded_cache) - previous_entries
+    # end for
+    entry_size = os.path.getsize(os.path.join(unbounded_cache.cache_dir, entry_names[0]))
+
+    cache = ScoreCache(os.path.join(tmp_path, "cache"), max_size=2 * entry_size)
+    for path in paths[:2]:
+        cache.store(path, compiled_score())
+    # end for
+    # Stored long ago (the modification times might not be distinct otherwise), then a gets used
+    for n, entry_name in enumerate(entry_names[:2]):
+        os.utime(os.path.join(cache.cache_dir, entry_name), (1000. * (n + 1), 1000. * (n + 1)))
+    # end for
+    assert cache.load(paths[0]) is not None
+    cache.store(paths[2], compiled_score())
+
+    assert entries(cache) == {entry_names[0], entry_names[2]}
+    assert cache.load(paths[0]) is not None
+    assert cache.load(paths[1]) is None
+    assert cache.load(paths[2]) is not None
+# end def
+
+
+@pytest.mark.parametrize("failing", ["_encode", "replace"])
+def test_no_partial_entry_on_failed_write(tmp_path, monkeypatch, failing):
+    cache = ScoreCache(os.path.join(tmp_path, "cache"))
+    path = score_file(tmp_path, "a")
+
+    def fail(*args, **kwargs):
+        raise OSError("No space left on device")
+    # end def
+
+    if failing == "replace":
+        monkeypatch.setattr(os, "replace", fail)
+    else:
+        monkeypatch.setattr(cache, failing, fail)
+    # end if
+    with pytest.raises(OSError):
+        cache.store(path, compiled_score())
+    # end with
+    monkeypatch.undo()
+
+    assert entries(cache) == set()
+    assert cache.load(path) is None
+# end def
@@ -0,0 +1,96 @@
+import os
+import shutil
+
+import pytest
+
+from score_library import ScoreLibrary
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+EXTENSIONS = (".musicxml",)
+
+
+@pytest.fixture
+def library(tmp_path):
+    # Library of a directory with the two test scores
+    directory = tmp_path / "scores"
+    directory.mkdir()
+    for name in ("sound_tempo.musicxml", "two_parts.musicxml"):
+        shutil.copy(os.path.join(DATA, name), directory / name)
+    # end for
+    library = ScoreLibrary(str(tmp_path / "library.sqlite"))
+    yield library, directory
+    library.close()
+# end def
+
+
+def scan(library: ScoreLibrary, directory) -> dict:
+    stats, failures = library.scan(str(directory), EXTENSIONS, parser="stream", n_jobs=2)
+
+    return {"unchanged": stats.n_unchanged, "rehashed": stats.n_rehashed, "indexed": stats.n_indexed,
+            "failed": stats.n_failed, "removed": stats.n_removed, "failures": [os.path.basename(path) for path, _ in failures]}
+# end def
+
+
+def paths(library: ScoreLibrary, text=None):
+    return sorted(os.path.basename(entry["path"]) for entry in library.search(text))
+# end def
+
+
+def test_incremental_scan(library):
+    library, directory = library
+    nothing = {"unchanged": 0, "rehashed": 0, "indexed": 0, "failed": 0, "removed": 0, "failures": []}
+    assert scan(library, directory) == dict(nothing, indexed=2)
+    assert paths(library) == ["sound_tempo.musicxml", "two_parts.musicxml"]
+    entry, = library.search("Violin")
+    assert (entry["n_parts"], entry["n_notes"], entry["duration"]) == (2, 8, pytest.approx(4.))
+
+    # Unchanged files aren't read
+    assert scan(library, directory) == dict(nothing, unchanged=2)
+
+    # Touched: the content is known
+    os.utime(directory / "two_parts.musicxml", (1e9, 1e9))
+    assert scan(library, directory) == dict(nothing, unchanged=1, rehashed=1)
+
+    # Moved: the entry (including the instruments) is copied
+    os.rename(directory / "two_parts.musicxml", directory / "moved.musicxml")
+    assert scan(library, directory) == dict(nothing, unchanged=1, rehashed=1, removed=1)
+    assert paths(library, "Violin") == ["moved.musicxml"]
+
+    # Modified: parsed again
+    with open(directory / "moved.musicxml", "a") as f:
+        f.write("\n")
+    # end with
+    assert scan(library, directory) == dict(nothing, unchanged=1, indexed=1)
+
+    # Removed
+    os.remove(directory / "sound_tempo.musicxml")
+    assert scan(library, directory) == dict(nothing, unchanged=1, removed=1)
+    assert paths(library) == ["moved.musicxml"]
+# end def
+
+
+def test_failed_file_is_remembered(library):
+    library, directory = library
+    with open(directory / "broken.musicxml", "w") as f:
+        f.write("<score-partwise>")
+    # end with
+
+    assert scan(library, directory)["failures"] == ["broken.musicxml"]
+    assert paths(library) == ["sound_tempo.musicxml", "two_parts.musicxml"]
+    # Not parsed again until it changes
+    assert scan(library, directory)["unchanged"] == 3
+
+    shutil.copy(os.path.join(DATA, "sound_tempo.musicxml"), directory / "broken.musicxml")
+    assert scan(library, directory)["rehashed"] == 1  # Same content as sound_tempo.musicxml
+    assert "broken.musicxml" in paths(library)
+# end def
+
+
+def test_search_is_literal(library):
+    library, directory = library
+    scan(library, directory)
+
+    assert paths(library, "%") == []
+    assert paths(library, "two_p") == ["two_parts.musicxml"]
+    assert paths(library, "TWO") == ["two_parts.musicxml"]  # Case-insensitive
+# end def
@@ -0,0 +1,36 @@
+import glob
+import os
+
+import numpy as np
+import pytest
+
+from conftest import ROOT
+from midi_test import MidiTestPlay
+from score import TempoMap
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+# A metronome mark (60), a <sound tempo="120"/> without a mark at the start of measure 2 and an "a tempo" (60) in the
+# middle of measure 3
+SOUND_TEMPO = os.path.join(DATA, "sound_tempo.musicxml")
+
+
+def seconds_timeline(musicxml_file: str, parser: str, default_qpm: float = 90.) -> np.ndarray:
+    score = MidiTestPlay.parse_score(musicxml_file, parser)
+    offsets = np.unique(np.concatenate((score.notes["start"], score.notes["start"] + score.notes["duration"])))
+
+    return TempoMap(score.tempos, default_qpm).seconds(offsets)
+# end def
+
+
+@pytest.mark.parametrize("parser", ["music21", "stream"])
+def test_sound_tempo(parser):
+    # The notes start at 0, 4, 8 and 10 and the score ends at 12 (in quarter lengths)
+    assert list(seconds_timeline(SOUND_TEMPO, parser)) == pytest.approx([0., 4., 6., 7., 9.])
+# end def
+
+
+@pytest.mark.parametrize("musicxml_file", [SOUND_TEMPO] + sorted(glob.glob(os.path.join(ROOT, "notes", "*.musicxml"))),
+                         ids=os.path.basename)
+def test_parsers_agree(musicxml_file):
+    assert seconds_timeline(musicxml_file, "stream") == pytest.approx(seconds_timeline(musicxml_file, "music21"))
+# end def